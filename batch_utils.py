@@ -0,0 +1,145 @@
+import numpy as np
+from keras.utils import Sequence
+
+def encode_chars(texts):
+    '''Encode an iterable of strings as one array of char indices: uint8 while
+    there are at most 256 distinct chars, wider when a stray symbol pushes past.
+    Returns (data, chars) where chars[i] is the char with index i'''
+    books = []
+    for text in texts:
+        codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+        book_chars, book_idxs = np.unique(codes, return_inverse=True)
+        books.append((book_chars, book_idxs.astype(np.min_scalar_type(max(len(book_chars) - 1, 0)))))
+
+    all_codes = np.unique(np.concatenate([book_chars for book_chars, _ in books]))
+    dtype = np.min_scalar_type(max(len(all_codes) - 1, 0))
+    if dtype != np.uint8:
+        print('{} distinct chars, encoded as {}'.format(len(all_codes), dtype))
+
+    data = np.empty(sum(len(book_idxs) for _, book_idxs in books), dtype=dtype)
+    offset = 0
+    for book_chars, book_idxs in books:
+        data[offset:offset + len(book_idxs)] = np.searchsorted(all_codes, book_chars).astype(dtype)[book_idxs]
+        offset += len(book_idxs)
+
+    return data, [chr(code) for code in all_codes]
+
+def sliding_windows(data, maxlen, step=1):
+    '''Zero-copy (n_windows, maxlen) view of every window that has a next element'''
+    n_windows = (len(data) - maxlen - 1) // step + 1
+    stride = data.strides[0]
+    return np.lib.stride_tricks.as_strided(data, shape=(n_windows, maxlen), strides=(stride * step, stride), writeable=False)
+
+def split_windows(n_windows, validation_split):
+    # hold out the last windows like keras' validation_split does
+    n_train = int(n_windows * (1 - validation_split))
+    return np.arange(n_train), np.arange(n_train, n_windows)
+
+def one_hot(idxs, n_classes):
+    out = np.zeros(idxs.shape + (n_classes,), dtype=np.bool_)
+    out.reshape(-1, n_classes)[np.arange(idxs.size), idxs.ravel()] = True
+    return out
+
+class WindowBatches(Sequence):
+    '''Batches of (x, y) over the step-spaced windows of data, cut from a strided
+    view so only the rows of the requested batch are copied. y holds the index of
+    the element after each window, shaped for sparse_categorical_crossentropy'''
+    def __init__(self, data, maxlen, step, batch_size, window_idxs=None, shuffle=True):
+        self.windows = sliding_windows(data, maxlen, step)
+        self.next_idxs = data[maxlen::step]
+        self.batch_size = batch_size
+        self.window_idxs = np.arange(len(self.windows)) if window_idxs is None else np.array(window_idxs)
+        self.shuffle = shuffle
+        self.on_epoch_end()
+
+    def __len__(self):
+        return (len(self.window_idxs) + self.batch_size - 1) // self.batch_size
+
+    def batch(self, i):
+        batch = self.window_idxs[i * self.batch_size:(i + 1) * self.batch_size]
+        return self.windows[batch], self.next_idxs[batch]
+
+    def __getitem__(self, i):
+        x, y = self.batch(i)
+        return x, y[:, None]
+
+    def on_epoch_end(self):
+        # shuffling permutes the window order, never the data
+        if self.shuffle:
+            np.random.shuffle(self.window_idxs)
+
+class OneHotWindows(WindowBatches):
+    '''WindowBatches with x and y expanded to one-hot only when requested'''
+    def __init__(self, data, maxlen, step, n_classes, batch_size, window_idxs=None, shuffle=True):
+        self.n_classes = n_classes
+        super(OneHotWindows, self).__init__(data, maxlen, step, batch_size, window_idxs, shuffle)
+
+    def __getitem__(self, i):
+        x, y = self.batch(i)
+        return one_hot(x, self.n_classes), one_hot(y, self.n_classes)
+
+def bucket_widths(lengths, buckets):
+    '''The smallest bucket that fits each length; longer ones get the last bucket'''
+    buckets = np.asarray(buckets)
+    return buckets[np.minimum(np.searchsorted(buckets, lengths), len(buckets) - 1)]
+
+class CharWindows(WindowBatches):
+    '''WindowBatches for a char-level word encoder: x holds each word's char ids
+    from word_chars, (batch, maxlen, width). Windows are grouped by bucket of
+    their longest word, so a batch is padded to its bucket's width rather than
+    to the longest word in the vocab'''
+    def __init__(self, data, maxlen, step, batch_size, word_chars, word_lengths, buckets, window_idxs=None, shuffle=True):
+        self.word_chars = word_chars
+        self.window_widths = bucket_widths(sliding_windows(word_lengths[data], maxlen, step).max(axis=1), buckets)
+        super(CharWindows, self).__init__(data, maxlen, step, batch_size, window_idxs, shuffle)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def batch(self, i):
+        width, batch = self.batches[i]
+        return self.word_chars[:, :width][self.windows[batch]], self.next_idxs[batch]
+
+    def on_epoch_end(self):
+        super(CharWindows, self).on_epoch_end()
+        # a stable sort keeps the shuffled order within each bucket
+        idxs = self.window_idxs[np.argsort(self.window_widths[self.window_idxs], kind='stable')]
+        widths = self.window_widths[idxs]
+        self.batches = []
+        for width in np.unique(widths):
+            bucket = idxs[widths == width]
+            self.batches.extend((width, bucket[start:start + self.batch_size]) for start in range(0, len(bucket), self.batch_size))
+        if self.shuffle:
+            self.batches = [self.batches[i] for i in np.random.permutation(len(self.batches))]
+
+class LabelInputBatches(WindowBatches):
+    '''WindowBatches for models that take the targets as a second input and
+    output their own loss, like softmax_heads.training_model'''
+    def __getitem__(self, i):
+        x, y = self.batch(i)
+        return [x, y[:, None]], np.zeros((len(y), 1), dtype=np.float32)
+
+class LaneBatches(Sequence):
+    '''Batches for truncated backprop through time. data is cut into batch_size
+    contiguous lanes and batch i is the i-th bptt-long chunk of every lane, so a
+    stateful model carries each lane's state from one batch into the next.
+    Must be fed in order: fit_generator(..., shuffle=False)'''
+    def __init__(self, data, batch_size, bptt, n_classes=None, x_transform=None):
+        lane_len = (len(data) - 1) // batch_size
+        self.inputs = data[:lane_len * batch_size].reshape(batch_size, lane_len)
+        self.targets = data[1:lane_len * batch_size + 1].reshape(batch_size, lane_len)
+        self.bptt = bptt
+        self.n_classes = n_classes
+        self.x_transform = x_transform
+
+    def __len__(self):
+        return self.inputs.shape[1] // self.bptt
+
+    def __getitem__(self, i):
+        chunk = slice(i * self.bptt, (i + 1) * self.bptt)
+        x, y = self.inputs[:, chunk], self.targets[:, chunk]
+        if self.x_transform is not None:
+            x = self.x_transform(x)
+        if self.n_classes is not None:
+            return one_hot(x, self.n_classes), one_hot(y, self.n_classes)
+        return x, y[..., None]
@@ -0,0 +1,192 @@
+import numpy as np
+
+import instrument
+from sampling import filter_log_probs, sample_without_replacement, scale_prediction
+
+_hash_multiplier = np.uint64(0x9E3779B97F4A7C15)
+
+def ngram_hashes(tokens, n):
+    '''64-bit hash of every n consecutive tokens along the last axis; element i
+    covers tokens i .. i + n - 1'''
+    tokens = np.asarray(tokens)
+    hashes = np.zeros(tokens.shape[:-1] + (tokens.shape[-1] - n + 1,), dtype=np.uint64)
+    for i in range(n):
+        hashes *= _hash_multiplier # wraps around mod 2**64
+        hashes += tokens[..., i:tokens.shape[-1] - n + 1 + i].astype(np.uint64) + np.uint64(1)
+    return hashes
+
+def _added(tokens, token):
+    # followers values are tuples, so tables copied for sibling beams can share them
+    return tokens if token in tokens else tokens + (token,)
+
+class BeamSearch(object):
+    '''Beams kept as rows of one preallocated int32 array with float64 log-prob scores.
+
+    Call windows() for the model input, then step() with the model's predictions
+    for those windows. Rows stay sorted best first. top_k and top_p restrict each
+    beam's next token to its k most likely, or its nucleus of mass p.
+
+    no_repeat_ngram=n stops a beam from repeating any n-gram (n >= 2) it already
+    contains, and frequency_penalty subtracts that much log-prob per earlier use
+    of a token. Both keep their history per beam and follow the parents step()
+    returns: followers[b] maps the hash of every n - 1 tokens in beam b to the
+    tokens that came after them, so blocking is one lookup of the beam's last
+    n - 1 tokens; penalties[b] is frequency_penalty times how often beam b used
+    each token. A beam extended by several new beams has its followers copied
+    for all but one of them.'''
+    def __init__(self, init_sentence, maxlen, n_words, beam_width, diversity, sample=True, top_k=None, top_p=None,
+                 no_repeat_ngram=0, frequency_penalty=0.):
+        init_sentence = np.asarray(init_sentence)
+        self.maxlen = maxlen
+        self.beam_width = beam_width
+        self.diversity = diversity
+        self.sample = sample
+        self.top_k = top_k
+        self.top_p = top_p
+
+        self.sentences = np.zeros((beam_width, len(init_sentence) + n_words), dtype=np.int32)
+        self.sentences[0, :len(init_sentence)] = init_sentence
+        self.scores = np.zeros(1)
+        self.length = len(init_sentence)
+
+        if no_repeat_ngram == 1 or no_repeat_ngram < 0:
+            raise ValueError('no_repeat_ngram must be 0 (off) or at least 2')
+        self.no_repeat_ngram = no_repeat_ngram
+        self.followers = None
+        if no_repeat_ngram:
+            prefix = no_repeat_ngram - 1
+            followers = {}
+            if self.length > prefix:
+                for prefix_hash, token in zip(ngram_hashes(init_sentence[:-1], prefix).tolist(), init_sentence[prefix:].tolist()):
+                    followers[prefix_hash] = _added(followers.get(prefix_hash, ()), token)
+            self.followers = [followers]
+        self.frequency_penalty = frequency_penalty
+        self.penalties = None # (beam_width, vocab_size), allocated once the vocab size is known
+
+    @property
+    def n_beams(self):
+        return len(self.scores)
+
+    def windows(self):
+        return self.sentences[:self.n_beams, self.length - self.maxlen:self.length]
+
+    def last_tokens(self):
+        return self.sentences[:self.n_beams, self.length - 1]
+
+    def _candidates(self, log_preds):
+        '''(beam, token) pairs allowed to compete for the next step, flattened'''
+        vocab_size = log_preds.shape[1]
+        if not self.sample:
+            return np.arange(log_preds.size)
+
+        # beam_width tokens per beam, drawn without replacement
+        picked = sample_without_replacement(log_preds, self.beam_width)
+        return (picked + vocab_size * np.arange(len(log_preds))[:, None]).ravel()
+
+    def step(self, preds):
+        '''Extend every beam with preds (n_beams, vocab). Returns the parent row
+        of each new beam so callers can reorder any per-beam state'''
+        vocab_size = preds.shape[1]
+        log_preds = self._penalize_repeats(filter_log_probs(scale_prediction(preds, self.diversity), self.top_k, self.top_p))
+        candidates, candidate_scores = self._scored(log_preds)
+        if not len(candidates):
+            # top-k/top-p and the n-gram block left no token: look outside the cut
+            candidates, candidate_scores = self._scored(self._penalize_repeats(scale_prediction(preds, self.diversity)))
+        if not len(candidates):
+            # every token would repeat an n-gram: allow repeats for this step rather than lose every beam
+            candidates, candidate_scores = self._scored(self._penalize_repeats(scale_prediction(preds, self.diversity), block_repeats=False))
+        if not len(candidates):
+            raise ValueError('No beam has a next token with nonzero probability')
+
+        n_new = min(self.beam_width, len(candidates))
+        best = np.argpartition(-candidate_scores, n_new - 1)[:n_new]
+        best = best[np.argsort(-candidate_scores[best], kind='stable')]
+        parents, tokens = np.divmod(candidates[best], vocab_size)
+
+        self.sentences[:n_new, :self.length] = self.sentences[parents, :self.length]
+        self.sentences[:n_new, self.length] = tokens
+        self.length += 1
+        self._update_history(parents, tokens)
+
+        scores = candidate_scores[best]
+        self.scores = scores - np.logaddexp.reduce(scores) # avoid going to zero
+        return parents
+
+    def _scored(self, log_preds):
+        '''Candidates and their scores, without the ones log_preds rules out'''
+        candidates = self._candidates(log_preds)
+        candidate_scores = (self.scores[:, None] + log_preds).ravel()[candidates]
+        valid = np.isfinite(candidate_scores)
+        return candidates[valid], candidate_scores[valid]
+
+    def _penalize_repeats(self, log_preds, block_repeats=True):
+        if self.penalties is None and self.frequency_penalty:
+            # float32 like the predictions, so subtracting doesn't upcast the whole matrix
+            self.penalties = np.zeros((self.beam_width, log_preds.shape[1]), dtype=np.float32)
+            np.add.at(self.penalties[0], self.sentences[0, :self.length], self.frequency_penalty)
+        if self.penalties is not None:
+            log_preds -= self.penalties[:self.n_beams]
+
+        if self.followers is not None and self.length >= self.no_repeat_ngram - 1 and block_repeats:
+            # a token that followed a beam's last n - 1 tokens before would complete a repeated n-gram
+            beams, tokens = [], []
+            for beam, prefix_hash in enumerate(self._prefix_hashes(self.n_beams, self.length)):
+                blocked = self.followers[beam].get(prefix_hash, ())
+                beams.extend([beam] * len(blocked))
+                tokens.extend(blocked)
+            if beams:
+                log_preds[beams, tokens] = -np.inf
+        return log_preds
+
+    def _prefix_hashes(self, n_beams, end):
+        '''Hash of the n - 1 tokens before end in each of the first n_beams rows'''
+        prefix = self.no_repeat_ngram - 1
+        return ngram_hashes(self.sentences[:n_beams, end - prefix:end], prefix)[:, 0].tolist()
+
+    def _update_history(self, parents, tokens):
+        n_new = len(parents)
+        if self.penalties is not None:
+            self.penalties[:n_new] = self.penalties[parents]
+            self.penalties[np.arange(n_new), tokens] += self.frequency_penalty
+        if self.followers is not None:
+            # the last new beam of each parent takes over its table; copies for the
+            # others are made before any table is extended
+            parents = parents.tolist()
+            owner = {parent: child for child, parent in enumerate(parents)}
+            followers = [self.followers[parent] if owner[parent] == child else dict(self.followers[parent])
+                         for child, parent in enumerate(parents)]
+            if self.length > self.no_repeat_ngram - 1:
+                for table, prefix_hash, token in zip(followers, self._prefix_hashes(n_new, self.length - 1), tokens.tolist()):
+                    table[prefix_hash] = _added(table.get(prefix_hash, ()), token)
+            self.followers = followers
+
+    def best(self):
+        return self.sentences[0, :self.length]
+
+class WindowPredictor(object):
+    '''Runs predict over the last maxlen tokens of every beam on each step'''
+    def __init__(self, predict):
+        self.predict = predict
+
+    def start(self, init_sentence):
+        pass
+
+    def __call__(self, search):
+        return self.predict(search.windows())
+
+    def reorder(self, parents):
+        pass
+
+def beam_search(predictor, init_sentence, maxlen, n_words, beam_width, diversity, sample=True, progress=iter, top_k=None, top_p=None,
+                no_repeat_ngram=0, frequency_penalty=0.):
+    '''Returns the best sentence (seed included) after n_words steps.
+    predictor is a WindowPredictor or anything with the same start/__call__/reorder methods'''
+    search = BeamSearch(init_sentence, maxlen, n_words, beam_width, diversity, sample, top_k, top_p,
+                        no_repeat_ngram, frequency_penalty)
+    predictor.start(search.windows()[0])
+    steps = instrument.StepTimer('beam_steps', beam_width=beam_width)
+    for i in progress(range(n_words)):
+        predictor.reorder(search.step(predictor(search)))
+        steps.tick()
+    steps.close()
+    return search.best()
@@ -0,0 +1,83 @@
+'''
+Epoch time of parallel_train at 1/2/4/8 workers on a fixed synthetic token
+stream (strong scaling: the workers split the same data), with a word LSTM
+the size of --units. The first epoch warms up and isn't counted.
+
+    python benchmarks/parallel_scaling.py --workers 1 2 4 8 --transport shm socket
+'''
+
+from __future__ import print_function
+import argparse, json, os, sys, tempfile, time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import parallel_train
+
+def scaling_worker(comm, args, times_file):
+    from keras.models import Sequential
+    from keras.layers import Embedding, LSTM, Dense
+    from batch_utils import WindowBatches
+
+    words = np.random.RandomState(0).randint(args.vocab_size, size=args.tokens).astype(np.int32)
+    lo, hi = parallel_train.shard(len(words), comm.rank, comm.size)
+    batches = WindowBatches(words[lo:hi], args.maxlen, args.step, args.batch_size)
+
+    model = Sequential([
+        Embedding(args.vocab_size, 64, input_length=args.maxlen),
+        LSTM(args.units),
+        Dense(args.vocab_size, activation='softmax'),
+    ])
+    model.compile(loss='sparse_categorical_crossentropy', optimizer='rmsprop')
+
+    ends = [time.time()]
+    def on_epoch_end(epoch):
+        ends.append(time.time())
+        with open(times_file, 'w') as f:
+            json.dump(list(np.diff(ends)), f)
+
+    parallel_train.fit(comm, model, batches, args.epochs, args.sync_every, on_epoch_end=on_epoch_end)
+
+def run(n_workers, transport, args):
+    times_file = os.path.join(tempfile.mkdtemp(), 'epochs.json')
+    start = time.time()
+    parallel_train.run(scaling_worker, n_workers, (args, times_file), transport=transport, address=args.address)
+    with open(times_file) as f:
+        epochs = json.load(f)
+    return {
+        'workers': n_workers,
+        'transport': transport,
+        'seconds': time.time() - start,
+        'epoch_seconds': float(np.median(epochs[1:] or epochs)),
+    }
+
+parser = argparse.ArgumentParser(description='benchmark data-parallel training')
+parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+parser.add_argument('--transport', type=str, nargs='+', default=['shm'], choices=parallel_train.transports)
+parser.add_argument('--address', type=str, default='127.0.0.1:6000')
+parser.add_argument('--tokens', type=int, default=200000)
+parser.add_argument('--vocab_size', type=int, default=2000)
+parser.add_argument('--units', type=int, default=128)
+parser.add_argument('--maxlen', type=int, default=30)
+parser.add_argument('--step', type=int, default=3)
+parser.add_argument('--batch_size', type=int, default=256)
+parser.add_argument('--epochs', type=int, default=3)
+parser.add_argument('--sync_every', type=int, default=10)
+parser.add_argument('--output', type=str, default=None, help='Write results as JSON to this file')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    results = []
+    for transport in args.transport:
+        for n_workers in args.workers:
+            result = run(n_workers, transport, args)
+            baseline = next((r['epoch_seconds'] for r in results if r['transport'] == transport and r['workers'] == 1), None)
+            result['speedup'] = baseline / result['epoch_seconds'] if baseline else None
+            print('{transport:>6} {workers:>2} workers: {epoch_seconds:8.2f} s/epoch'.format(**result) +
+                  (', {:.2f}x'.format(result['speedup']) if result['speedup'] else ''))
+            results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,71 @@
+'''
+Micro-benchmarks for sampling.py at char (100) and word (20k) vocab sizes,
+against the per-row loop it replaced (float64 cast, np.log, multinomial,
+argmax for every row).
+
+    python benchmarks/sampling.py --batch_sizes 1 30 128
+'''
+
+from __future__ import print_function
+import argparse, json, os, sys, timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import sampling
+
+def multinomial_loop(preds, temperature):
+    # the old gru_text_generation.sample, once per row
+    out = []
+    for row in preds:
+        row = np.log(row.astype('float64')) / temperature
+        row = np.exp(row)
+        out.append(np.argmax(np.random.multinomial(1, row / np.sum(row), 1)))
+    return out
+
+def random_preds(batch_size, vocab_size, seed=0):
+    # peaked like a trained model's softmax, float32 like predict's output
+    logits = np.random.RandomState(seed).standard_normal((batch_size, vocab_size)) * 3.
+    preds = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return (preds / preds.sum(axis=1, keepdims=True)).astype(np.float32)
+
+def cases(args):
+    return [
+        ('multinomial loop', lambda preds: multinomial_loop(preds, args.temperature)),
+        ('inverse cdf', lambda preds: sampling.sample(preds, args.temperature)),
+        ('gumbel', lambda preds: sampling.sample(preds, args.temperature, method='gumbel')),
+        ('top-k 40', lambda preds: sampling.sample(preds, args.temperature, k=40)),
+        ('nucleus 0.9', lambda preds: sampling.sample(preds, args.temperature, p=0.9)),
+        ('beam candidates', lambda preds: sampling.sample_without_replacement(sampling.scale_prediction(preds, args.temperature), preds.shape[0])),
+    ]
+
+def run(vocab_size, batch_size, args):
+    preds = random_preds(batch_size, vocab_size)
+    results = []
+    for name, fn in cases(args):
+        runs = timeit.repeat(lambda: fn(preds), number=args.number, repeat=args.repeat)
+        results.append({'case': name, 'vocab_size': vocab_size, 'batch_size': batch_size,
+                        'usec_per_call': min(runs) / args.number * 1e6})
+    return results
+
+parser = argparse.ArgumentParser(description='benchmark batched sampling')
+parser.add_argument('--vocab_sizes', type=int, nargs='+', default=[100, 20000])
+parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 30, 128])
+parser.add_argument('--temperature', type=float, default=0.8)
+parser.add_argument('--number', type=int, default=20, help='Calls per timing')
+parser.add_argument('--repeat', type=int, default=5, help='Timings per case; the fastest is reported')
+parser.add_argument('--output', type=str, default=None, help='Write results as JSON to this file')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    results = []
+    for vocab_size in args.vocab_sizes:
+        for batch_size in args.batch_sizes:
+            for result in run(vocab_size, batch_size, args):
+                print('{case:>16} vocab {vocab_size:>6} batch {batch_size:>4}: {usec_per_call:10.1f} usec'.format(**result))
+                results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,83 @@
+'''
+Concurrent load against serve.py, all on localhost: starts the server in this
+process, fires --concurrency clients at it at once and reports generated
+tokens/sec along with the server's batching metrics.
+
+    python benchmarks/serve_load.py bundles/gru_char_rnn --concurrency 1 8 64
+'''
+
+from __future__ import print_function
+import argparse, asyncio, json, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from serve import Server
+
+async def http(port, method, path, payload=None):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    body = json.dumps(payload).encode('utf8') if payload is not None else b''
+    writer.write('{} {} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {}\r\n\r\n'.format(method, path, len(body)).encode('latin1') + body)
+    response = await reader.read() # the server closes the connection when done
+    writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    return head, body
+
+def dechunk(body):
+    text = b''
+    while body:
+        size, _, body = body.partition(b'\r\n')
+        size = int(size, 16)
+        text, body = text + body[:size], body[size + 2:]
+    return text.decode('utf8')
+
+async def load(port, args):
+    payload = {'seed': args.seed, 'length': args.length, 'temperature': args.temperature, 'beam_width': args.beam_width}
+    start = time.time()
+    responses = await asyncio.gather(*[http(port, 'POST', '/generate', payload) for i in range(args.concurrency)])
+    elapsed = time.time() - start
+    for head, body in responses:
+        if not head.startswith(b'HTTP/1.1 200'):
+            raise RuntimeError(head.decode('latin1'))
+    print('sample:', repr(dechunk(responses[0][1])[:80]))
+    return elapsed
+
+async def main(args):
+    results = []
+    for concurrency in args.concurrency_levels:
+        server = Server(args.bundle, args.max_rows, args.window / 1000.)
+        listener = await server.start('127.0.0.1', 0)
+        port = listener.sockets[0].getsockname()[1]
+        args.concurrency = concurrency
+        elapsed = await load(port, args)
+        metrics = json.loads((await http(port, 'GET', '/metrics'))[1].decode('utf8'))
+        listener.close()
+
+        result = {
+            'concurrency': concurrency,
+            'seconds': elapsed,
+            'tokens_per_sec': concurrency * args.length / elapsed,
+            'mean_batch_rows': metrics['mean_batch_rows'],
+            'mean_first_token_ms': metrics['mean_first_token_ms'],
+        }
+        print('{concurrency:>4} clients: {tokens_per_sec:9.1f} tokens/sec, {mean_batch_rows:6.1f} rows per step, '
+              'first token after {mean_first_token_ms:7.1f} ms'.format(**result))
+        results.append(result)
+    return results
+
+parser = argparse.ArgumentParser(description='load test the generation server on localhost')
+parser.add_argument('bundle', type=str, help='Generation bundle directory with a weights.npz')
+parser.add_argument('--concurrency', dest='concurrency_levels', type=int, nargs='+', default=[1, 8, 64])
+parser.add_argument('--length', type=int, default=100)
+parser.add_argument('--seed', type=str, default='')
+parser.add_argument('--temperature', type=float, default=1.0)
+parser.add_argument('--beam_width', type=int, default=1)
+parser.add_argument('--max_rows', type=int, default=256)
+parser.add_argument('--window', type=float, default=5.)
+parser.add_argument('--output', type=str, default=None, help='Write results as JSON to this file')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    results = asyncio.run(main(args))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
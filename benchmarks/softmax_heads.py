@@ -0,0 +1,92 @@
+'''
+Compares the dense, sampled and adaptive softmax output heads on a synthetic
+Zipf-distributed token stream: training samples/sec and held-out perplexity
+(computed with the full softmax every head exposes at inference).
+
+    python benchmarks/softmax_heads.py --vocab_sizes 20000 50000 100000
+'''
+
+from __future__ import print_function
+import argparse, json, os, sys, time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from keras.layers import Embedding, LSTM
+from keras.models import Sequential
+
+import softmax_heads
+from batch_utils import WindowBatches, LabelInputBatches
+
+def zipf_tokens(n_tokens, vocab_size, seed=0):
+    rng = np.random.RandomState(seed)
+    ranks = np.arange(1, vocab_size + 1)
+    probs = 1.0 / ranks
+    return rng.choice(vocab_size, size=n_tokens, p=probs / probs.sum()).astype(np.int32)
+
+def perplexity(model, batches, n_batches):
+    log_probs = []
+    for i in range(min(n_batches, len(batches))):
+        x, y = batches.batch(i)
+        preds = model.predict_on_batch(x)
+        log_probs.append(np.log(np.maximum(preds[np.arange(len(y)), y], 1e-12)))
+    return float(np.exp(-np.mean(np.concatenate(log_probs))))
+
+def run(head, vocab_size, args):
+    data = zipf_tokens(args.tokens, vocab_size)
+    n_train = int(len(data) * 0.9)
+    counts = np.bincount(data[:n_train], minlength=vocab_size)
+
+    model = Sequential([
+                Embedding(vocab_size, args.embedding_dim, input_length=args.maxlen),
+                LSTM(args.hidden),
+                softmax_heads.output_layer(head, counts)
+        ])
+    if softmax_heads.is_label_head(model):
+        train_model = softmax_heads.training_model(model)
+        train_batches = LabelInputBatches(data[:n_train], args.maxlen, args.step, args.batch_size)
+    else:
+        model.compile(loss='sparse_categorical_crossentropy', optimizer='rmsprop')
+        train_model = model
+        train_batches = WindowBatches(data[:n_train], args.maxlen, args.step, args.batch_size)
+    val_batches = WindowBatches(data[n_train:], args.maxlen, args.step, args.batch_size, shuffle=False)
+
+    train_model.train_on_batch(*train_batches[0]) # build the graph outside the timing
+    start = time.time()
+    for i in range(1, args.batches + 1):
+        train_model.train_on_batch(*train_batches[i % len(train_batches)])
+    elapsed = time.time() - start
+
+    return {
+        'head': head,
+        'vocab_size': vocab_size,
+        'samples_per_sec': args.batches * args.batch_size / elapsed,
+        'perplexity': perplexity(model, val_batches, args.val_batches),
+    }
+
+parser = argparse.ArgumentParser(description='benchmark word model output heads')
+parser.add_argument('--vocab_sizes', type=int, nargs='+', default=[20000, 50000, 100000])
+parser.add_argument('--heads', type=str, nargs='+', default=softmax_heads.heads)
+parser.add_argument('--tokens', type=int, default=2000000, help='Length of the synthetic token stream')
+parser.add_argument('--batches', type=int, default=200, help='Timed training batches per run')
+parser.add_argument('--val_batches', type=int, default=20)
+parser.add_argument('--batch_size', type=int, default=256)
+parser.add_argument('--maxlen', type=int, default=30)
+parser.add_argument('--step', type=int, default=3)
+parser.add_argument('--embedding_dim', type=int, default=300)
+parser.add_argument('--hidden', type=int, default=512)
+parser.add_argument('--output', type=str, default=None, help='Write results as JSON to this file')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    results = []
+    for vocab_size in args.vocab_sizes:
+        for head in args.heads:
+            result = run(head, vocab_size, args)
+            print('{head:>9} vocab {vocab_size:>6}: {samples_per_sec:9.1f} samples/sec, perplexity {perplexity:.1f}'.format(**result))
+            results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,284 @@
+'''
+Times the hot paths of the training and generation pipeline on a synthetic
+Henty-like corpus and a fake GloVe file, both generated into --workdir, so it
+runs without the Gutenberg books, the Stanford parser or the real vectors.
+
+    python benchmarks/suite.py --output bench/$(git rev-parse --short HEAD).json
+    python benchmarks/suite.py --compare bench/abc1234.json
+
+Each stage reports seconds and a throughput; a stage whose imports are missing
+(keras for the model stages) is recorded as skipped. The corpus is generated
+from --seed, so runs with the same flags time the same data.
+'''
+
+from __future__ import print_function
+import argparse, io, json, os, platform, shutil, subprocess, sys, textwrap, time, traceback
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import book_utils
+import token_cache
+
+author = 'George Alfred Henty'
+
+def fake_vocab(rng, n_words):
+    # lowercase letter strings with roughly English word lengths, most common first
+    lengths = np.clip(rng.poisson(4.5, size=n_words), 1, 14)
+    letters = np.array(list('etaoinshrdlcumwfgypbvkjxqz'))
+    letter_probs = 1.0 / np.arange(1, 27) ** 0.7
+    vocab = set()
+    while len(vocab) < n_words:
+        for length in lengths:
+            vocab.add(''.join(rng.choice(letters, size=length, p=letter_probs / letter_probs.sum())))
+    return np.array(sorted(vocab, key=lambda word: (len(word), word))[:n_words], dtype=object)
+
+def synthetic_book(rng, vocab, n_words):
+    '''Zipf-distributed words in sentences, with dialogue, wrapped into
+    paragraphs the way the Gutenberg text files are'''
+    probs = 1.0 / np.arange(1, len(vocab) + 1)
+    words = vocab[rng.choice(len(vocab), size=n_words, p=probs / probs.sum())]
+    sentence_ends = np.cumsum(rng.geometric(1 / 15., size=n_words // 5 + 1))
+    sentence_ends = sentence_ends[sentence_ends < n_words]
+
+    paragraphs, sentences = [], []
+    for start, end in zip(np.concatenate([[0], sentence_ends]), np.concatenate([sentence_ends, [n_words]])):
+        if end <= start:
+            continue
+        sentence = ' '.join(words[start:end])
+        sentence = sentence[0].upper() + sentence[1:] + rng.choice(['.', '.', '.', '?', '!'])
+        if rng.random_sample() < 0.2:
+            sentence = '"' + sentence[:-1] + ',"' + ' he said.'
+        sentences.append(sentence)
+        if rng.random_sample() < 0.2:
+            paragraphs.append(textwrap.fill(' '.join(sentences), 70))
+            sentences = []
+    paragraphs.append(textwrap.fill(' '.join(sentences), 70))
+    return '\n\n'.join(paragraphs) + '\n'
+
+def write_corpus(workdir, args):
+    corpus_dir = os.path.join(workdir, 'Gutenberg')
+    done_file = os.path.join(corpus_dir, '.done')
+    if os.path.exists(done_file):
+        with open(done_file) as f:
+            if json.load(f) == [args.books, args.words_per_book, args.vocab, args.seed]:
+                return corpus_dir
+        shutil.rmtree(corpus_dir)
+    os.makedirs(corpus_dir)
+    rng = np.random.RandomState(args.seed)
+    vocab = fake_vocab(rng, args.vocab)
+    for i in range(args.books):
+        with open(os.path.join(corpus_dir, '{}___Book {}.txt'.format(author, i)), 'w') as f:
+            f.write(synthetic_book(rng, vocab, args.words_per_book))
+    with open(done_file, 'w') as f:
+        json.dump([args.books, args.words_per_book, args.vocab, args.seed], f)
+    return corpus_dir
+
+def write_glove(workdir, args, dim):
+    '''A GloVe-format text file covering most of the synthetic vocab plus filler words'''
+    glove_path = os.path.join(workdir, 'glove.fake.{}d.txt'.format(dim))
+    if not os.path.exists(glove_path):
+        rng = np.random.RandomState(args.seed)
+        words = list(fake_vocab(rng, args.vocab)[:int(args.vocab * 0.9)])
+        words += ['filler{}'.format(i) for i in range(args.glove_words - len(words))]
+        with open(glove_path + '.tmp', 'w', encoding='utf8') as f:
+            for start in range(0, len(words), 1000):
+                vectors = rng.standard_normal((len(words[start:start + 1000]), dim)).astype(np.float32)
+                for word, vector in zip(words[start:start + 1000], vectors):
+                    f.write(word + ' ' + ' '.join('%.5f' % value for value in vector) + '\n')
+        os.replace(glove_path + '.tmp', glove_path)
+    return glove_path
+
+def timed(fn, *args, **kwargs):
+    start = time.time()
+    result = fn(*args, **kwargs)
+    return result, time.time() - start
+
+class Suite(object):
+    def __init__(self, args):
+        self.args = args
+        self.workdir = args.workdir
+        self.state = {}
+        self.results = {}
+
+    def stage(self, name, fn):
+        if self.args.stages and name not in self.args.stages:
+            return
+        print('-----', name)
+        try:
+            result = fn()
+        except ImportError as e:
+            result = {'skipped': str(e)}
+        except KeyError as e: # a stage this one builds on was skipped
+            result = {'skipped': 'needs ' + str(e)}
+        except Exception as e:
+            traceback.print_exc()
+            result = {'error': repr(e)}
+        print(json.dumps(result))
+        self.results[name] = result
+
+    def corpus_load(self):
+        file_names = book_utils.get_file_names_written_by(author)
+        texts, seconds = timed(book_utils.get_files_contents, file_names)
+        self.state['text'] = '\n'.join(texts)
+        megabytes = sum(len(text) for text in texts) / 2.**20
+        return {'seconds': seconds, 'books': len(texts), 'megabytes': megabytes, 'mb_per_sec': megabytes / seconds}
+
+    def tokenize(self):
+        import embedding_utils
+        (words, word_index, idx_to_word), seconds = timed(embedding_utils.tokenize_words, self.state['text'], self.args.vocab_size)
+        return {'seconds': seconds, 'tokens': len(words), 'tokens_per_sec': len(words) / seconds}
+
+    def tokenize_books(self):
+        # through the per-book token cache: cold re-tokenizes every book, warm only loads arrays
+        import embedding_utils
+        shutil.rmtree(token_cache.cache_dir, ignore_errors=True)
+        file_names = book_utils.get_file_names_written_by(author)
+        _, cold = timed(embedding_utils.tokenize_books, file_names, self.args.vocab_size)
+        (words, word_index, idx_to_word), warm = timed(embedding_utils.tokenize_books, file_names, self.args.vocab_size)
+        self.state['words'], self.state['word_index'], self.state['idx_to_word'] = words, word_index, idx_to_word
+        return {'cold_seconds': cold, 'warm_seconds': warm, 'tokens': len(words), 'cold_tokens_per_sec': len(words) / cold}
+
+    def embedding_matrix(self):
+        import embedding_utils
+        base = os.path.splitext(embedding_utils.glove_path)[0]
+        for cached in (base + '.npy', base + '.vocab'):
+            if os.path.exists(cached):
+                os.remove(cached)
+        _, cold = timed(embedding_utils.get_embedding_matrix, self.state['word_index'])
+        matrix, warm = timed(embedding_utils.get_embedding_matrix, self.state['word_index'])
+        return {'cold_seconds': cold, 'warm_seconds': warm, 'shape': list(matrix.shape)}
+
+    def word_batches(self):
+        import word_rnn_generation
+        batches = word_rnn_generation.get_chunk(self.state['words'])
+        n = min(self.args.batches, len(batches))
+        _, seconds = timed(lambda: [batches[i] for i in range(n)])
+        samples = n * word_rnn_generation.batch_size
+        return {'seconds': seconds, 'batches': n, 'samples_per_sec': samples / seconds}
+
+    def char_cnn_batches(self):
+        import char_cnn_model
+        char_cnn_model.set_vocab([self.state['idx_to_word'][idx] for idx in range(len(self.state['idx_to_word']))])
+        batches = char_cnn_model.get_chunk(self.state['words'])
+        n = min(self.args.batches, len(batches))
+        xs, seconds = timed(lambda: [batches[i][0] for i in range(n)])
+        samples = sum(len(x) for x in xs)
+        return {'seconds': seconds, 'batches': n, 'samples_per_sec': samples / seconds,
+                'mean_batch_mb': sum(x.nbytes for x in xs) / n / 2.**20}
+
+    def train_step(self):
+        import word_rnn_generation
+        word_rnn_generation.load_corpus(self.args.vocab_size)
+        model = word_rnn_generation.build_model(False)
+        batches = word_rnn_generation.get_chunk(word_rnn_generation.words)
+        model.train_on_batch(*batches[0]) # graph building is not the steady state
+        _, seconds = timed(lambda: [model.train_on_batch(*batches[i % len(batches)]) for i in range(1, self.args.train_steps + 1)])
+        self.state['word_model'] = model
+        samples = self.args.train_steps * word_rnn_generation.batch_size
+        return {'seconds': seconds, 'steps': self.args.train_steps, 'samples_per_sec': samples / seconds}
+
+    def generate_chars(self):
+        import gru_text_generation
+        data, chars = gru_text_generation.load_corpus()
+        bundle = os.path.join(self.workdir, 'bundles', 'gru_char_rnn')
+        gru_text_generation.export(gru_text_generation.build_model(len(chars)), data, chars, bundle)
+        self.state['char_bundle'] = bundle
+        _, seconds = timed(gru_text_generation.generate, self.args.chars, stream=io.StringIO(), bundle=bundle)
+        return {'seconds': seconds, 'chars': self.args.chars, 'chars_per_sec': self.args.chars / seconds}
+
+    def beam_search(self):
+        import word_rnn_generation
+        model = self.state['word_model']
+        bundle = os.path.join(self.workdir, 'bundles', 'word_rnn')
+        word_rnn_generation.export(model, bundle)
+        self.state['word_bundle'] = bundle
+        result = {}
+        for beam_width in self.args.beam_widths:
+            _, seconds = timed(word_rnn_generation.beam_search, model, self.args.words, beam_width, 1.6, io.StringIO())
+            result['beam_{}_words_per_sec'.format(beam_width)] = self.args.words / seconds
+        return result
+
+    def numpy_generate(self):
+        # the same bundles through the TF-free runtime (generate.py)
+        import generate
+        from bundle_utils import load_bundle
+        result = {}
+        meta = load_bundle(self.state['char_bundle'])
+        _, seconds = timed(generate.generate_chars, meta, self.args.chars, 0.6, io.StringIO())
+        result['chars_per_sec'] = self.args.chars / seconds
+        meta = load_bundle(self.state['word_bundle'])
+        for beam_width in self.args.beam_widths:
+            _, seconds = timed(generate.generate_words, meta, self.args.words, beam_width, 1.6, io.StringIO())
+            result['beam_{}_words_per_sec'.format(beam_width)] = self.args.words / seconds
+        return result
+
+    def run(self):
+        for name in stages:
+            self.stage(name, getattr(self, name))
+        return self.results
+
+stages = ['corpus_load', 'tokenize', 'tokenize_books', 'embedding_matrix', 'word_batches', 'char_cnn_batches',
+          'train_step', 'generate_chars', 'beam_search', 'numpy_generate']
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline):
+    # ratio of every throughput against the baseline run, < 1 is a slowdown
+    for name, result in results['stages'].items():
+        for key, value in result.items():
+            old = baseline['stages'].get(name, {}).get(key)
+            if key.endswith('per_sec') and isinstance(old, (int, float)) and old:
+                print('{:>18} {:>28}: {:10.1f} vs {:10.1f}  x{:.2f}'.format(name, key, value, old, value / old))
+
+parser = argparse.ArgumentParser(description='benchmark the pipeline on a synthetic corpus')
+parser.add_argument('--workdir', type=str, default='bench/work', help='Where the synthetic corpus, fake GloVe, caches and bundles go (reused across runs)')
+parser.add_argument('--stages', type=str, nargs='+', default=None, choices=stages, help='Only run these stages')
+parser.add_argument('--books', type=int, default=20, help='Synthetic books; Henty wrote about 90')
+parser.add_argument('--words_per_book', type=int, default=120000)
+parser.add_argument('--vocab', type=int, default=40000, help='Distinct words in the synthetic corpus')
+parser.add_argument('--glove_words', type=int, default=60000, help='Lines in the fake GloVe file')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--vocab_size', type=int, default=20000, help='vocab_size passed to tokenize_words and word_rnn_generation.load_corpus')
+parser.add_argument('--batches', type=int, default=20, help='Batches built by the batch stages')
+parser.add_argument('--train_steps', type=int, default=5)
+parser.add_argument('--chars', type=int, default=500, help='Chars generated by the generate stages')
+parser.add_argument('--words', type=int, default=50, help='Words generated per beam search')
+parser.add_argument('--beam_widths', type=int, nargs='+', default=[1, 10, 30])
+parser.add_argument('--output', type=str, default=None, help='Write results as JSON to this file')
+parser.add_argument('--compare', type=str, default=None, help='Print throughput ratios against an earlier --output file')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    os.makedirs(args.workdir, exist_ok=True)
+    args.workdir = os.path.abspath(args.workdir)
+
+    print('Writing synthetic corpus...')
+    book_utils.path = write_corpus(args.workdir, args) + os.sep
+    book_utils.index_file = os.path.join(args.workdir, 'cache', 'books.json') # not the real corpus' index
+    token_cache.cache_dir = os.path.join(args.workdir, 'cache', 'tokens')
+    try:
+        import embedding_utils
+        embedding_utils.glove_path = write_glove(args.workdir, args, embedding_utils.EMBEDDING_DIM)
+    except ImportError:
+        pass # the stages that need embedding_utils report the missing import themselves
+
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'config': vars(args),
+        'stages': Suite(args).run(),
+    }
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
@@ -1,16 +1,164 @@
+import codecs
+import json
+import mmap
 import os
+import re
+import time
+
+import instrument
 
 path = os.path.expanduser('~/Code/dl/datasets/Gutenberg/')
 
+# One entry per book: author, title, size, mtime and the byte offsets of the text
+# between the Project Gutenberg header and footer. Rebuilt only for files whose
+# size or mtime changed, and only looked at again when the directory changes.
+index_file = 'cache/books.json'
+
+_index = {}
+
+_header = re.compile(br'^\*\*\* ?START OF (?:THE|THIS) PROJECT GUTENBERG[^\n]*\n', re.M | re.I)
+_footer = re.compile(br'^(?:\*\*\* ?END OF (?:THE|THIS) PROJECT GUTENBERG|End of (?:the )?Project Gutenberg)', re.M | re.I)
+
+def _body_offsets(file_name):
+    # searched through a memory map, so indexing never holds a whole book
+    with open(path + file_name, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return 0, 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            header = _header.search(data)
+            start = header.end() if header else 0
+            footer = _footer.search(data, start)
+            return start, footer.start() if footer else len(data)
+
+def _index_entry(file_name, stat):
+    author, _, title = os.path.splitext(file_name)[0].partition('___')
+    start, end = _body_offsets(file_name)
+    return {'author': author, 'title': title, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'start': start, 'end': end}
+
+def get_index(refresh=False):
+    '''{file name: index entry} for every book under path'''
+    dir_mtime = os.stat(path).st_mtime_ns
+    cached = _index.get(path)
+    if cached is None:
+        try:
+            with open(index_file, encoding='utf8') as f:
+                cached = json.load(f)
+        except (IOError, ValueError):
+            cached = None
+        if cached is not None and cached['path'] != path:
+            cached = None
+    if cached is not None and cached['dir_mtime_ns'] == dir_mtime and not refresh:
+        _index[path] = cached
+        return cached['books']
+
+    old_books = cached['books'] if cached else {}
+    books = {}
+    file_names = [file_name for file_name in sorted(os.listdir(path)) if not file_name.startswith('.')]
+    with instrument.phase('index_books', books=len(file_names)) as indexing:
+        rescanned = 0
+        for file_name in file_names:
+            stat = os.stat(path + file_name)
+            entry = old_books.get(file_name)
+            if entry is None or [entry['size'], entry['mtime_ns']] != [stat.st_size, stat.st_mtime_ns]:
+                entry = _index_entry(file_name, stat)
+                rescanned += 1
+            books[file_name] = entry
+        indexing.fields['rescanned'] = rescanned # books whose header and footer were searched again
+
+    _index[path] = {'path': path, 'dir_mtime_ns': dir_mtime, 'books': books}
+    os.makedirs(os.path.dirname(os.path.abspath(index_file)), exist_ok=True)
+    with open(index_file + '.tmp', 'w', encoding='utf8') as f:
+        json.dump(_index[path], f)
+    os.replace(index_file + '.tmp', index_file)
+    return books
+
 def get_all_file_names():
-    return os.listdir(path)
+    return list(get_index())
 
 def get_file_names_written_by(author):
-    all_files = get_all_file_names()
-    return [file_name for file_name in all_files if file_name.startswith(author)]
+    return [file_name for file_name, book in get_index().items() if book['author'].startswith(author)]
+
+def held_out_file_name(author):
+    '''The author's book that training leaves out, for evaluating on unseen text'''
+    return sorted(get_file_names_written_by(author))[-1]
+
+def get_training_file_names(author):
+    '''What the training scripts read: every book of the author's except
+    held_out_file_name(author), so quantize.py can measure perplexity on text
+    the model never saw. Models trained before this saw that book too'''
+    held_out = held_out_file_name(author)
+    return [file_name for file_name in get_file_names_written_by(author) if file_name != held_out]
+
+def get_book(file_name, stat=None):
+    '''Index entry of one book, re-read if the file changed since it was indexed'''
+    book = get_index().get(file_name)
+    if book is None:
+        raise KeyError('{} is not in {}'.format(file_name, path))
+    # a book rewritten in place doesn't touch the directory's mtime
+    stat = stat or os.stat(path + file_name)
+    if [book['size'], book['mtime_ns']] != [stat.st_size, stat.st_mtime_ns]:
+        with instrument.phase('index_book', file_name=file_name):
+            book = get_index()[file_name] = _index_entry(file_name, stat)
+    return book
+
+def _body_range(f, file_name):
+    book = get_book(file_name, os.fstat(f.fileno()))
+    return book['start'], book['end']
+
+def _universal_newlines(text):
+    # what open() in text mode would have returned
+    return text.replace('\r\n', '\n').replace('\r', '\n')
 
 def get_file_contents(file_name):
-    return open(path + file_name).read()
+    '''Text of one book without the Project Gutenberg header and license'''
+    with instrument.phase('read_book', file_name=file_name), open(path + file_name, 'rb') as f:
+        start, end = _body_range(f, file_name)
+        f.seek(start)
+        return _universal_newlines(f.read(end - start).decode('utf8'))
+
+def stream_file_contents(file_name, chunk_size=1 << 20):
+    '''get_file_contents in chunks of about chunk_size bytes, for books too big to hold'''
+    decoder = codecs.getincrementaldecoder('utf8')()
+    read_seconds = 0. # only the reads; a phase would also time the consumer between chunks
+    with open(path + file_name, 'rb') as f:
+        start, end = _body_range(f, file_name)
+        f.seek(start)
+        remaining = end - start
+        pending_cr = ''
+        while remaining > 0:
+            read_start = time.time()
+            data = f.read(min(chunk_size, remaining))
+            read_seconds += time.time() - read_start
+            if not data:
+                break
+            remaining -= len(data)
+            text = pending_cr + decoder.decode(data, final=remaining <= 0)
+            # a \r\n split across chunks must not become two newlines
+            pending_cr = '\r' if text.endswith('\r') and remaining > 0 else ''
+            text = text[:-1] if pending_cr else text
+            yield _universal_newlines(text)
+        if pending_cr:
+            yield '\n'
+    instrument.record('stream_book', file_name=file_name, bytes=end - start, read_seconds=read_seconds)
 
 def get_files_contents(file_names):
     return [get_file_contents(file_name) for file_name in file_names]
+
+def iter_files_contents(file_names):
+    '''Like get_files_contents, but only one book is in memory at a time'''
+    for file_name in file_names:
+        yield get_file_contents(file_name)
+
+def shard_file_names(file_names, n_shards, shard):
+    '''The file names worker shard of n_shards should read. Books are dealt
+    largest first to the shard with the fewest bytes so far, so shards get
+    about the same amount of text; every worker computes the same split'''
+    index = get_index()
+    length = lambda file_name: index[file_name]['end'] - index[file_name]['start']
+    totals = [0] * n_shards
+    shards = [[] for _ in range(n_shards)]
+    for file_name in sorted(file_names, key=lambda file_name: (-length(file_name), file_name)):
+        smallest = totals.index(min(totals))
+        shards[smallest].append(file_name)
+        totals[smallest] += length(file_name)
+    return sorted(shards[shard])
@@ -0,0 +1,38 @@
+import json
+import os
+import random
+
+import numpy_inference
+
+# A generation bundle is a directory holding everything generate mode needs:
+#   model.h5     the trained keras model (config and weights)
+#   bundle.json  vocabulary, model settings and a pool of seed windows
+#   weights.npz  the same model for numpy_inference, when its layers allow
+# so generating never has to read the corpus, the tokenizer or GloVe, and
+# generate.py can run from weights.npz without TensorFlow.
+
+def sample_seeds(data, length, n_seeds=200):
+    '''Random windows of data to start generation from, as lists of ints'''
+    starts = random.sample(range(len(data) - length), min(n_seeds, len(data) - length))
+    return [[int(idx) for idx in data[start:start + length]] for start in starts]
+
+def export_bundle(path, model, meta):
+    os.makedirs(path, exist_ok=True)
+    model.save(os.path.join(path, 'model.h5'))
+    try:
+        numpy_inference.export_npz(model, os.path.join(path, 'weights.npz'))
+    except ValueError as e:
+        print('Skipping weights.npz:', e)
+    tmp = os.path.join(path, 'bundle.json.tmp')
+    with open(tmp, 'w', encoding='utf8') as f:
+        json.dump(meta, f)
+    os.replace(tmp, os.path.join(path, 'bundle.json'))
+    print('Exported generation bundle to', path)
+
+def load_bundle(path):
+    '''The bundle's metadata, with model_file pointing at its keras model'''
+    with open(os.path.join(path, 'bundle.json'), encoding='utf8') as f:
+        meta = json.load(f)
+    meta['model_file'] = os.path.join(path, 'model.h5')
+    meta['weights_file'] = os.path.join(path, 'weights.npz')
+    return meta
@@ -1,87 +1,137 @@
 from __future__ import print_function
 from keras.models import Sequential, load_model
-from keras.layers import Dense, Activation, LSTM, BatchNormalization, Dropout, TimeDistributed, Conv1D, MaxPooling1D, Flatten
+from keras.layers import Dense, Activation, LSTM, BatchNormalization, Dropout, TimeDistributed, Conv1D, Embedding, GlobalMaxPooling1D
 from keras.optimizers import RMSprop
-from keras.utils import to_categorical
 import numpy as np
 from progressbar import ProgressBar
 import random, sys, argparse, operator, gc
 from time import sleep
 
+import instrument
 from book_utils import *
 from embedding_utils import *
+import beam_utils
+from batch_utils import CharWindows, LaneBatches, bucket_widths
+from model_utils import StatefulPredictor, tbptt_copy, ResetStates, Throughput
+from bundle_utils import export_bundle, load_bundle, sample_seeds
 
-file_names = get_file_names_written_by('George Alfred Henty')
-text = ''.join(get_files_contents(file_names))
-
+model_file_name = 'char_cnn.h5'
+bundle_path = 'bundles/char_cnn'
 max_word_len = 50
-words, char_index, idx_to_char = tokenize_words_to_chars(text, max_word_length=max_word_len)
-
-# TODO: probably have a more random way of doing the train/val split
+# batches are padded to the smallest of these that fits their longest word
+word_len_buckets = [8, 12, 16, 24, max_word_len]
+char_embedding_dim = 16
+vocab_size = 20000
 val_split = 0.05
-train_words = words[:int((1 - val_split) * len(words))]
-val_words = words[int(val_split * len(words)):]
 
 maxlen = 30
 step = 3
 batch_size = 512
-# Derived using formula for length of range at stackoverflow.com/questions/31839032
-total_train_samples = (len(train_words) - maxlen - 1) // step + 1
-total_val_samples = (len(val_words) - maxlen - 1) // step + 1
-def get_chunk(data):
-    # cut the text in semi-redundant sequences of maxlen words
-    words_idx = 0
-
-    # I derived this using the formula for the length of a range and wolfram alpha. It should work
-    words_per_batch = (batch_size - 1) * step + maxlen + 1
-    while True:
-        if (words_idx + 1) * words_per_batch >= len(data): words_idx = 0
-        words_batch = data[words_idx * words_per_batch : (words_idx + 1) * words_per_batch]
-        sentences = []
-        next_chars = []
-
-        for i in range(0, words_per_batch - maxlen, step):
-            sentences.append(words_batch[i: i + maxlen])
-            next_chars.append(words_batch[i + maxlen])
-        import pdb; pdb.set_trace()
-
-        x = np.array([to_categorical(sentence, num_classes=len(char_index)) for sentence in sentences])
-        y = to_categorical(next_chars, num_classes=len(char_index))
-
-        yield (x, y)
-
-        words_idx += 1
+workers = 4
+
+def set_vocab(vocab):
+    global idx_to_word, word_index, word_chars, word_lengths, char_index, idx_to_char, n_char_classes
+    idx_to_word = dict(enumerate(vocab))
+    word_index = {word: idx for idx, word in idx_to_word.items()}
+    word_chars, char_index, idx_to_char = words_to_chars(idx_to_word, max_word_length=max_word_len)
+    word_lengths = (word_chars != len(char_index)).sum(axis=1)
+    n_char_classes = len(char_index) + 1 # +1 for the padding char
+
+def load_corpus():
+    global words, train_words, val_words, seeds
+    file_names = get_training_file_names('George Alfred Henty')
+    words, _, corpus_idx_to_word = tokenize_books(file_names, vocab_size)
+    set_vocab([corpus_idx_to_word[idx] for idx in range(len(corpus_idx_to_word))])
+    seeds = sample_seeds(words, maxlen)
+
+    # TODO: probably have a more random way of doing the train/val split
+    train_words = words[:int((1 - val_split) * len(words))]
+    val_words = words[int(val_split * len(words)):]
+
+def load_generation_bundle(path):
+    # everything generate mode needs, without touching the corpus
+    global seeds, model_file_name
+    meta = load_bundle(path)
+    set_vocab(meta['vocab'])
+    seeds = meta['seeds']
+    model_file_name = meta['model_file']
+
+def export(model):
+    export_bundle(bundle_path, model, {
+        'kind': 'char_cnn',
+        'vocab': [idx_to_word[idx] for idx in range(len(idx_to_word))],
+        'maxlen': maxlen,
+        'max_word_len': max_word_len,
+        'seeds': seeds,
+    })
+
+def get_chunk(data, shuffle=True):
+    # semi-redundant sequences of maxlen words as char ids, bucketed by their
+    # longest word, with integer targets for sparse_categorical_crossentropy
+    return CharWindows(data, maxlen, step, batch_size, word_chars, word_lengths, word_len_buckets, shuffle=shuffle)
+
+def chars_to_input(sentences):
+    # char ids padded to the bucket of the longest word in these sentences
+    sentences = np.asarray(sentences)
+    width = bucket_widths(word_lengths[sentences].max(), word_len_buckets)
+    return word_chars[:, :width][sentences]
 
 def build_model(load_weights):
     # build the model
     print('Build model...')
     if load_weights:
-        return load_model('gru_char_rnn.h5')
+        model = load_model(model_file_name)
+        if len(model.input_shape) == 4:
+            raise ValueError('{} reads one-hot chars; retrain it to read char ids'.format(model_file_name))
+        return model
     else:
         model = Sequential([
-                    TimeDistributed(Conv1D(300, 5, activation='relu'), input_shape=(maxlen, max_word_len, len(char_index))),
-                    TimeDistributed(MaxPooling1D()),
-                    TimeDistributed(Flatten()),
+                    # char ids in, (maxlen, word length) with the word length set by each batch's bucket
+                    Embedding(n_char_classes, char_embedding_dim, input_shape=(maxlen, None)),
+                    TimeDistributed(Conv1D(300, 5, activation='relu')),
+                    TimeDistributed(GlobalMaxPooling1D()),
                     LSTM(1024, return_sequences=True),
                     LSTM(1024),
-                    Dense(len(char_index), activation='softmax')
+                    Dense(len(word_index), activation='softmax')
             ])
-        model.compile(loss='categorical_crossentropy', optimizer='rmsprop', metrics=['acc'])
+        model.compile(loss='sparse_categorical_crossentropy', optimizer='rmsprop', metrics=['acc'])
         model.summary()
         return model
 
-def train(n_iter, n_chars, beam_width):
+def train(n_iter, n_chars, beam_width, bptt=0):
     # train the model, output generated text after each iteration
     model = build_model(False)
+    if bptt:
+        # a stateful copy reads the words as batch_size contiguous lanes, so each
+        # word is seen once per epoch and context isn't capped at maxlen
+        tbptt_model = tbptt_copy(model, batch_size, bptt)
+        tbptt_model.compile(loss='sparse_categorical_crossentropy', optimizer='rmsprop', metrics=['acc'])
+        lanes = LaneBatches(train_words, batch_size, bptt, x_transform=chars_to_input)
+
     for iteration in range(1, n_iter + 1):
         print()
         print('-' * 50)
         print('Iteration', iteration)
-        model.fit_generator(get_chunk(train_words),
-                            total_train_samples // batch_size,
-                            epochs=1,
-                            validation_data=get_chunk(val_words),
-                            validation_steps=total_val_samples // batch_size)
+        if bptt:
+            with instrument.phase('fit', iteration=iteration):
+                tbptt_model.fit_generator(lanes,
+                                          len(lanes),
+                                          epochs=1,
+                                          shuffle=False,
+                                          callbacks=[ResetStates(), Throughput()])
+            model.set_weights(tbptt_model.get_weights())
+        else:
+            train_batches = get_chunk(train_words)
+            val_batches = get_chunk(val_words, shuffle=False)
+            with instrument.phase('fit', iteration=iteration):
+                model.fit_generator(train_batches,
+                                    len(train_batches),
+                                    epochs=1,
+                                    validation_data=val_batches,
+                                    validation_steps=len(val_batches),
+                                    workers=workers,
+                                    use_multiprocessing=True,
+                                    callbacks=[Throughput()])
 
         for diversity in [1.2, 1.4, 1.6, 1.8]:
             print()
@@ -89,73 +139,59 @@ def train(n_iter, n_chars, beam_width):
             print()
     
     print('Saving model...')
-    model.save('gru_char_rnn.h5')
+    with instrument.phase('save'):
+        model.save(model_file_name)
+        export(model)
     return model
 
-def scale_prediction(prediction, temperature):
-    '''stolen from pender/chatbot-rnn chatbot.py'''
-    if (temperature == 1.0): return prediction # Temperature 1.0 makes no change
-    np.seterr(divide='ignore')
-    scaled_prediction = np.log(prediction) / temperature
-    scaled_prediction = scaled_prediction - np.logaddexp.reduce(scaled_prediction)
-    scaled_prediction = np.exp(scaled_prediction)
-    np.seterr(divide='warn')
-    return (scaled_prediction / np.sum(scaled_prediction)) # renormalize
-
-def beam_search(model, n_words, beam_width, diversity, stream):
+def beam_search(model, n_words, beam_width, diversity, stream, sample=True, stateful=True, no_repeat_ngram=0, frequency_penalty=0.):
     print('----- diversity:', diversity)
-    start_index = random.randint(0, len(words) - maxlen - 1)
-    init_sentence = np.array(words[start_index: start_index + maxlen])
-    init_sentence = np.concatenate((init_sentence, np.zeros(n_words)))
-
-    beams = [{ 'sentence': init_sentence, 'proba': 1.0 }]
+    init_sentence = random.choice(seeds)
+    if stateful:
+        predictor = StatefulPredictor(model, beam_width, to_input=lambda tokens: chars_to_input(tokens[:, None]))
+    else:
+        predictor = beam_utils.WindowPredictor(lambda x_pred: model.predict(chars_to_input(x_pred), verbose=0, batch_size=256))
 
     print('Generating with beam search...')
-    bar = ProgressBar()
-    for i in bar(range(n_words)):
-        new_beams = []
-
-        x_pred = np.array([beam['sentence'][i:i + maxlen] for beam in beams])
-        all_preds = model.predict(x_pred, verbose=0, batch_size=256)
-        for preds, beam in zip(all_preds, beams):
-            beam['preds'] = preds
-
-        for idx, beam in enumerate(beams):
-            sentence = beam['sentence']
-            preds = scale_prediction(beam['preds'], diversity)
+    with instrument.phase('beam_search', beam_width=beam_width, diversity=diversity, stateful=stateful):
+        best = beam_utils.beam_search(predictor, init_sentence, maxlen, n_words, beam_width, diversity,
+                                      sample=sample, progress=ProgressBar(),
+                                      no_repeat_ngram=no_repeat_ngram, frequency_penalty=frequency_penalty)
 
-            best_idxs = np.random.choice(len(preds), size=beam_width, replace=False, p=preds)
-
-            for pred_idx in best_idxs:
-                new_sentence = np.copy(sentence)
-                new_sentence[maxlen + i] = pred_idx
-                new_beams.append({
-                                    'sentence': new_sentence,
-                                    'proba': beam['proba'] * preds[pred_idx]
-                                })
-
-        beams = list(reversed(sorted(new_beams, key=lambda beam: beam['proba'])))
-        beams = beams[:beam_width]
-        sum_probs = sum([beam['proba'] for beam in beams])
-        for beam in beams: beam['proba'] /= sum_probs # avoid going to zero
-
-    stream.write(detokenize(beams[0]['sentence'], idx_to_char))
+    stream.write(detokenize(best, idx_to_word))
 
 parser = argparse.ArgumentParser(description='train/generate text with char rnn')
-parser.add_argument('--mode', type=str, default='train', help='Either "train" or "generate"')
+parser.add_argument('--mode', type=str, default='train', help='Either "train", "generate" or "export" (bundle the saved model)')
 parser.add_argument('--iter', type=int, default=10, help='Number of training iterations')
 parser.add_argument('--words', type=int, default=80, help='Number of words for  beam search')
 parser.add_argument('--diversity', type=float, default=1.6, help='Temperature for beam search')
 parser.add_argument('--beam_width', type=int, default=30, help='Beam width for beam search')
-
-FLAGS = parser.parse_args()
+parser.add_argument('--deterministic', dest='sample', action='store_false', help='Keep the highest scoring beams instead of sampling them')
+parser.add_argument('--windowed', dest='stateful', action='store_false', help='Re-read the last maxlen words of each beam every step instead of carrying the recurrent state')
+parser.add_argument('--no_repeat_ngram', type=int, default=0, help='Never let a beam repeat an n-gram of this many words (0 to allow repeats)')
+parser.add_argument('--frequency_penalty', type=float, default=0., help='Log-probability subtracted from a word for each time its beam already used it')
+parser.add_argument('--bundle', type=str, default=bundle_path, help='Generation bundle to write in train/export mode and read in generate mode')
+parser.add_argument('--bptt', type=int, default=0, help='Train statefully over contiguous text with truncated BPTT of this many steps (0 to train on overlapping windows)')
+parser.set_defaults(sample=True, stateful=True)
+instrument.add_arguments(parser, 'logs/char_cnn_model.jsonl')
 
 if __name__ == '__main__':
+    FLAGS = parser.parse_args()
+    instrument.configure_from(FLAGS)
+    bundle_path = FLAGS.bundle
     if FLAGS.mode == 'train':
-        trained_model = train(FLAGS.iter, FLAGS.words, FLAGS.beam_width)
-        beam_search(trained_model, 1000, FLAGS.beam_width, FLAGS.diversity, open('./generated_words.md', 'w'))
+        load_corpus()
+        with instrument.phase('train'):
+            trained_model = train(FLAGS.iter, FLAGS.words, FLAGS.beam_width, FLAGS.bptt)
+        beam_search(trained_model, 1000, FLAGS.beam_width, FLAGS.diversity, open('./generated_words.md', 'w'), FLAGS.sample, FLAGS.stateful,
+                    FLAGS.no_repeat_ngram, FLAGS.frequency_penalty)
     elif FLAGS.mode == 'generate':
-        beam_search(build_model(True), FLAGS.words, FLAGS.beam_width, FLAGS.diversity, open('./generated_words.md', 'w'))
+        load_generation_bundle(FLAGS.bundle)
+        beam_search(build_model(True), FLAGS.words, FLAGS.beam_width, FLAGS.diversity, open('./generated_words.md', 'w'), FLAGS.sample, FLAGS.stateful,
+                    FLAGS.no_repeat_ngram, FLAGS.frequency_penalty)
+    elif FLAGS.mode == 'export':
+        load_corpus()
+        export(build_model(True))
     else:
         print('Unrecognized mode', FLAGS.mode)
         raise TypeError
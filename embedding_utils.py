@@ -2,13 +2,16 @@ import os
 from collections import Counter
 
 import numpy as np
-from keras.layers import Embedding
-from keras.preprocessing.sequence import pad_sequences
 
-def tokenize_words(text, vocab_size):
-    open('/tmp/in.txt', 'w').write(text)
-    os.system('~/Code/dl/datasets/stanford-parser-full-2017-06-09/tokenize.sh')
-    tokens = open('/tmp/out.txt').read().replace('\n', ' \n ').split(' ')
+import instrument
+from book_utils import shard_file_names
+from token_cache import load_tokens
+from tokenizer import tokenize, detokenize_tokens
+
+# keras is only imported by the functions that need it, so tokenizing and the
+# embedding matrix work (and benchmark) without it
+
+def index_words(tokens, vocab_size):
     print('Total tokens in dataset', len(tokens))
 
     top_tokens = [tok for (tok, cnt) in Counter(tokens).most_common(vocab_size - 1)] # -1 for UNK
@@ -21,13 +24,50 @@ def tokenize_words(text, vocab_size):
     idx_to_word = {v: k for k, v in word_index.items()} 
     return (sequences, word_index, idx_to_word)
 
-def tokenize_words_to_chars(text, max_word_length=50):
-    open('/tmp/in.txt', 'w').write(text)
-    os.system('~/Code/dl/datasets/stanford-parser-full-2017-06-09/tokenize.sh')
-    tokens = open('/tmp/out.txt').read().split()
+def tokenize_words(text, vocab_size):
+    return index_words(tokenize(text), vocab_size)
+
+def _book_vocabulary(file_names, vocab_size, processes=None):
+    '''(per-book token table ids, table id -> word id, word_index, count of each word id)
+    over every book in file_names'''
+    with instrument.phase('load_tokens', books=len(file_names)):
+        books, table, counts = load_tokens(file_names, processes)
+    print('Total tokens in dataset', counts.sum())
+
+    # same ordering as Counter.most_common: by count, ties in order of first appearance
+    seen = np.flatnonzero(counts)
+    top_ids = seen[np.argsort(-counts[seen], kind='stable')][:vocab_size - 1] # -1 for UNK
+    word_index = {table[idx]: i for i, idx in enumerate(top_ids)}
+    unk_index = len(word_index)
+    word_index['<UNK>'] = unk_index
+    print('Found {} unique tokens.'.format(len(word_index)))
+
+    remap = np.full(len(table), unk_index, dtype=np.int32)
+    remap[top_ids] = np.arange(len(top_ids), dtype=np.int32)
+    word_counts = np.bincount(remap, weights=counts, minlength=len(word_index)).astype(np.int64)
+    return books, remap, word_index, word_counts
+
+def tokenize_books(file_names, vocab_size, processes=None):
+    books, remap, word_index, _ = _book_vocabulary(file_names, vocab_size, processes)
+    sequences = remap[np.concatenate(books)]
+    idx_to_word = {v: k for k, v in word_index.items()}
+    return (sequences, word_index, idx_to_word)
+
+def tokenize_book_shard(file_names, vocab_size, n_shards, shard, processes=None):
+    '''tokenize_books for one worker of n_shards: only the words of its books
+    (book_utils.shard_file_names), with the vocabulary and the returned count of
+    each word id taken over every book, so all workers agree on them'''
+    books, remap, word_index, word_counts = _book_vocabulary(file_names, vocab_size, processes)
+    shard_names = set(shard_file_names(file_names, n_shards, shard))
+    sequences = remap[np.concatenate([ids for file_name, ids in zip(file_names, books) if file_name in shard_names])]
+    idx_to_word = {v: k for k, v in word_index.items()}
+    return (sequences, word_index, idx_to_word, word_counts)
+
+def index_chars(tokens, max_word_length=50):
+    from keras.preprocessing.sequence import pad_sequences
     print('Total tokens in dataset', len(tokens))
 
-    char_index = {tok: idx for (idx, tok) in enumerate(set(text))}
+    char_index = {tok: idx for (idx, tok) in enumerate(sorted(set(''.join(tokens))))}
     print('Found {} unique chars.'.format(len(char_index)))
 
     sequences = [[char_index[char] for char in word] for word in tokens]
@@ -36,32 +76,91 @@ def tokenize_words_to_chars(text, max_word_length=50):
     idx_to_char = {v: k for k, v in char_index.items()} 
     return (sequences, char_index, idx_to_char)
 
+def tokenize_words_to_chars(text, max_word_length=50):
+    return index_chars(tokenize(text, preserve_lines=False), max_word_length)
+
+def words_to_chars(idx_to_word, max_word_length=50):
+    '''Padded char ids for every word in the vocabulary, indexed by word id'''
+    char_index = {tok: idx for (idx, tok) in enumerate(sorted(set(''.join(idx_to_word.values()))))}
+    print('Found {} unique chars.'.format(len(char_index)))
+
+    word_chars = np.full((len(idx_to_word), max_word_length), len(char_index), dtype=np.int32)
+    for idx, word in idx_to_word.items():
+        chars = [char_index[char] for char in word[:max_word_length]]
+        word_chars[idx, :len(chars)] = chars
+
+    idx_to_char = {v: k for k, v in char_index.items()}
+    return (word_chars, char_index, idx_to_char)
+
 def detokenize(words, idx_to_word):
-    word_list = [idx_to_word[idx] for idx in words]
-    open('/tmp/in.txt', 'w').write(' '.join(word_list))
-    os.system('~/Code/dl/datasets/stanford-parser-full-2017-06-09/detokenize.sh')
-    return open('/tmp/out.txt').read()
+    return detokenize_tokens([idx_to_word[idx] for idx in words])
 
-def get_embedding_layer(word_index, input_length, trainable=False):
-    EMBEDDING_DIM = 300
-    embeddings_index = {}
-    f = open(os.path.expanduser('~/Code/dl/datasets/glove.42B.300d.txt'))
-    for line in f:
-        values = line.split()
-        word = values[0]
-        coefs = np.asarray(values[1:], dtype='float32')
-        embeddings_index[word] = coefs
-    f.close()
-    
-    print('Found %s word vectors.' % len(embeddings_index))
-    
-    embedding_matrix = np.random.normal(size=(len(word_index) + 1, EMBEDDING_DIM))
+glove_path = os.path.expanduser('~/Code/dl/datasets/glove.42B.300d.txt')
+EMBEDDING_DIM = 300
+
+def convert_glove(txt_path=None, dim=EMBEDDING_DIM):
+    # one-time conversion of the GloVe text file into a float32 matrix that can be
+    # memory-mapped, plus a vocab file whose line number is the matrix row
+    txt_path = txt_path or glove_path
+    base = os.path.splitext(txt_path)[0]
+    vocab_path, matrix_path = base + '.vocab', base + '.npy'
+
+    n_rows = 0
+    with open(txt_path, encoding='utf8') as f:
+        for line in f:
+            n_rows += 1
+
+    matrix = np.lib.format.open_memmap(matrix_path + '.tmp', mode='w+', dtype=np.float32, shape=(n_rows, dim))
+    with open(txt_path, encoding='utf8') as f, open(vocab_path + '.tmp', 'w', encoding='utf8') as vocab:
+        for row, line in enumerate(f):
+            # some GloVe "words" contain spaces, so split the vector off the right
+            values = line.rstrip('\n').rsplit(' ', dim)
+            vocab.write(values[0] + '\n')
+            matrix[row] = np.asarray(values[1:], dtype=np.float32)
+    matrix.flush()
+    del matrix
+
+    os.replace(matrix_path + '.tmp', matrix_path)
+    os.replace(vocab_path + '.tmp', vocab_path)
+    print('Converted {} word vectors to {}'.format(n_rows, matrix_path))
+    return vocab_path, matrix_path
+
+def get_embedding_matrix(word_index, txt_path=None, dim=EMBEDDING_DIM):
+    txt_path = txt_path or glove_path # read at call time, so glove_path can be pointed elsewhere
+    base = os.path.splitext(txt_path)[0]
+    vocab_path, matrix_path = base + '.vocab', base + '.npy'
+    if not (os.path.exists(vocab_path) and os.path.exists(matrix_path)):
+        with instrument.phase('convert_glove'):
+            convert_glove(txt_path, dim)
+
+    # only look up the rows for words we actually have
+    wanted = {word.lower() for word in word_index}
+    rows = {}
+    with open(vocab_path, encoding='utf8') as f:
+        for row, word in enumerate(f):
+            word = word[:-1]
+            if word in wanted and word not in rows:
+                rows[word] = row
+
+    vectors = np.load(matrix_path, mmap_mode='r')
+    print('Found %s word vectors.' % vectors.shape[0])
+
+    embedding_matrix = np.random.normal(size=(len(word_index) + 1, dim)).astype(np.float32)
+    idxs, found_rows = [], []
     for word, i in word_index.items():
-        embedding_vector = embeddings_index.get(word.lower())
-        if embedding_vector is not None:
-            # words not found in embedding index will be all-zeros.
-            embedding_matrix[i] = embedding_vector
-    
+        row = rows.get(word.lower())
+        if row is not None:
+            idxs.append(i)
+            found_rows.append(row)
+
+    # gather in row order so the memmap is read sequentially
+    order = np.argsort(found_rows)
+    embedding_matrix[np.asarray(idxs, dtype=np.int64)[order]] = vectors[np.asarray(found_rows, dtype=np.int64)[order]]
+    return embedding_matrix
+
+def get_embedding_layer(word_index, input_length, trainable=False):
+    from keras.layers import Embedding
+    embedding_matrix = get_embedding_matrix(word_index)
     embedding_layer = Embedding(len(word_index) + 1,
                                 EMBEDDING_DIM,
                                 weights=[embedding_matrix],
@@ -69,4 +168,3 @@ def get_embedding_layer(word_index, input_length, trainable=False):
                                 trainable=trainable)
 
     return embedding_layer
-
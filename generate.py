@@ -0,0 +1,66 @@
+'''
+Generate from an exported bundle with the numpy runtime: no TensorFlow or
+keras import, so it starts in well under a second.
+
+    python numpy_inference.py bundles/gru_char_rnn   # older bundles only
+    python generate.py bundles/gru_char_rnn --length 400
+    python generate.py bundles/1024_512_batchnorm --length 80 --beam_width 30
+'''
+
+from __future__ import print_function
+import argparse, random, sys
+
+import beam_utils
+import sampling
+from bundle_utils import load_bundle
+from numpy_inference import NumpyModel, NumpyPredictor, quantize_dtypes
+from quantize import quantized_file
+from tokenizer import detokenize_tokens
+
+def generate_chars(meta, n_chars, diversity, stream, top_k=None, top_p=None):
+    chars = meta['chars']
+    model = NumpyModel(meta['weights_file'], batch_size=1)
+    seed = random.choice(meta['seeds'])
+    stream.write(''.join(chars[idx] for idx in seed))
+    for idx in seed[:-1]:
+        model.step([idx])
+
+    next_index = seed[-1]
+    for i in range(n_chars):
+        next_index = sampling.sample(model.step([next_index])[0], diversity, top_k, top_p)
+        stream.write(chars[next_index])
+        stream.flush()
+
+def generate_words(meta, n_words, beam_width, diversity, stream, sample=True, top_k=None, top_p=None,
+                   no_repeat_ngram=0, frequency_penalty=0.):
+    predictor = NumpyPredictor(meta['weights_file'], beam_width)
+    best = beam_utils.beam_search(predictor, random.choice(meta['seeds']), meta['maxlen'], n_words,
+                                  beam_width, diversity, sample=sample, top_k=top_k, top_p=top_p,
+                                  no_repeat_ngram=no_repeat_ngram, frequency_penalty=frequency_penalty)
+    stream.write(detokenize_tokens(meta['vocab'][idx] for idx in best))
+
+parser = argparse.ArgumentParser(description='generate text from a bundle without TensorFlow')
+parser.add_argument('bundle', type=str, help='Generation bundle directory (see bundle_utils)')
+parser.add_argument('--length', type=int, default=400, help='Number of chars or words to generate')
+parser.add_argument('--diversity', type=float, default=None, help='Sampling temperature (default 0.6 for chars, 1.6 for words)')
+parser.add_argument('--beam_width', type=int, default=30, help='Beam width for word bundles')
+parser.add_argument('--top_k', type=int, default=None, help='Only sample among the k most likely next tokens')
+parser.add_argument('--top_p', type=float, default=None, help='Only sample among the most likely next tokens holding this much probability (nucleus sampling)')
+parser.add_argument('--no_repeat_ngram', type=int, default=0, help='Never let a beam repeat an n-gram of this many words (0 to allow repeats)')
+parser.add_argument('--frequency_penalty', type=float, default=0., help='Log-probability subtracted from a word for each time its beam already used it')
+parser.add_argument('--quantized', type=str, default=None, choices=quantize_dtypes, help='Use weights written by quantize.py')
+parser.add_argument('--deterministic', dest='sample', action='store_false', help='Keep the highest scoring beams instead of sampling them')
+
+if __name__ == '__main__':
+    FLAGS = parser.parse_args()
+    meta = load_bundle(FLAGS.bundle)
+    if FLAGS.quantized:
+        meta['weights_file'] = quantized_file(meta, FLAGS.quantized)
+    if meta['kind'] == 'char':
+        generate_chars(meta, FLAGS.length, FLAGS.diversity or 0.6, sys.stdout, FLAGS.top_k, FLAGS.top_p)
+    elif meta['kind'] == 'word':
+        generate_words(meta, FLAGS.length, FLAGS.beam_width, FLAGS.diversity or 1.6, sys.stdout, FLAGS.sample,
+                       FLAGS.top_k, FLAGS.top_p, FLAGS.no_repeat_ngram, FLAGS.frequency_penalty)
+    else:
+        sys.exit('generate.py does not support {} bundles'.format(meta['kind']))
+    print()
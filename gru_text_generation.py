@@ -10,7 +10,7 @@ has at least ~100k characters. ~1M is better.
 '''
 
 from __future__ import print_function
-from keras.models import Sequential
+from keras.models import Sequential, load_model
 from keras.layers import Dense, Activation
 from keras.layers import GRU
 from keras.optimizers import Adam
@@ -20,64 +20,85 @@ import random
 import sys
 import argparse
 
+import instrument
+import parallel_train
 from book_utils import *
+from batch_utils import encode_chars, sliding_windows, split_windows, OneHotWindows, LaneBatches
+from model_utils import stateful_copy, tbptt_copy, ResetStates, Throughput
+from bundle_utils import export_bundle, load_bundle, sample_seeds
+from sampling import sample
 
-file_names = get_file_names_written_by('George Alfred Henty')
-text = ''.join(get_files_contents(file_names))[:4000000]
-print('corpus length:', len(text))
-
-chars = sorted(list(set(text)))
-print('total chars:', len(chars))
-char_indices = dict((c, i) for i, c in enumerate(chars))
-indices_char = dict((i, c) for i, c in enumerate(chars))
-
-# cut the text in semi-redundant sequences of maxlen characters
 maxlen = 40
 step = 3
-sentences = []
-next_chars = []
-for i in range(0, len(text) - maxlen, step):
-    sentences.append(text[i: i + maxlen])
-    next_chars.append(text[i + maxlen])
-print('nb sequences:', len(sentences))
-
-print('Vectorization...')
-x = np.zeros((len(sentences), maxlen, len(chars)), dtype=np.bool)
-y = np.zeros((len(sentences), len(chars)), dtype=np.bool)
-for i, sentence in enumerate(sentences):
-    for t, char in enumerate(sentence):
-        x[i, t, char_indices[char]] = 1
-    y[i, char_indices[next_chars[i]]] = 1
-
-
-# build the model
-print('Build model...')
-model = Sequential()
-model.add(GRU(256, input_shape=(maxlen, len(chars)), return_sequences=True, dropout=0.25, recurrent_dropout=0.1))
-model.add(GRU(128, dropout=0.3, recurrent_dropout=0.1))
-model.add(Dense(len(chars), activation='softmax'))
-
-model.compile(loss='categorical_crossentropy', optimizer='adam', metrics=['acc'])
-
-def sample(preds, temperature=1.0):
-    # helper function to sample an index from a probability array
-    preds = np.asarray(preds).astype('float64')
-    preds = np.log(preds) / temperature
-    exp_preds = np.exp(preds)
-    preds = exp_preds / np.sum(exp_preds)
-    probas = np.random.multinomial(1, preds, 1)
-    return np.argmax(probas)
-
-def train(n_iter):
+batch_size = 256
+model_file_name = 'gru_char_rnn.h5'
+bundle_path = 'bundles/gru_char_rnn'
+
+def load_corpus():
+    file_names = get_training_file_names('George Alfred Henty')
+    with instrument.phase('load_corpus', books=len(file_names)):
+        data, chars = encode_chars(iter_files_contents(file_names))
+    print('corpus length:', len(data))
+    print('total chars:', len(chars))
+    return data, chars
+
+def build_model(n_chars):
+    print('Build model...')
+    model = Sequential()
+    model.add(GRU(256, input_shape=(maxlen, n_chars), return_sequences=True, dropout=0.25, recurrent_dropout=0.1))
+    model.add(GRU(128, dropout=0.3, recurrent_dropout=0.1))
+    model.add(Dense(n_chars, activation='softmax'))
+
+    model.compile(loss='categorical_crossentropy', optimizer='adam', metrics=['acc'])
+    return model
+
+def export(model, data, chars, bundle=None):
+    export_bundle(bundle or bundle_path, model, {
+        'kind': 'char',
+        'chars': chars,
+        'maxlen': maxlen,
+        'seeds': sample_seeds(data, maxlen),
+    })
+
+def train(n_iter, bptt=0):
+    data, chars = load_corpus()
+    model = build_model(len(chars))
+
+    # cut the text in semi-redundant sequences of maxlen characters
+    n_windows = len(sliding_windows(data, maxlen, step))
+    print('nb sequences:', n_windows)
+    train_idxs, val_idxs = split_windows(n_windows, 0.05)
+
+    if bptt:
+        # truncated BPTT: a stateful copy reads the corpus as batch_size contiguous
+        # lanes, so each char is seen once per epoch and context isn't capped at maxlen
+        tbptt_model = tbptt_copy(model, batch_size, bptt)
+        tbptt_model.compile(loss='categorical_crossentropy', optimizer='adam', metrics=['acc'])
+        lanes = LaneBatches(data, batch_size, bptt, n_classes=len(chars))
+
     # train the model, output generated text after each iteration
     for iteration in range(1, n_iter):
         print()
         print('-' * 50)
         print('Iteration', iteration)
-        model.fit(x, y,
-                  batch_size=256,
-                  epochs=2,
-                  validation_split=0.05)
+        if bptt:
+            with instrument.phase('fit', iteration=iteration):
+                tbptt_model.fit_generator(lanes,
+                                          len(lanes),
+                                          epochs=2,
+                                          shuffle=False,
+                                          callbacks=[ResetStates(), Throughput()])
+            model.set_weights(tbptt_model.get_weights())
+        else:
+            train_batches = OneHotWindows(data, maxlen, step, len(chars), batch_size, train_idxs)
+            val_batches = OneHotWindows(data, maxlen, step, len(chars), batch_size, val_idxs, shuffle=False)
+            with instrument.phase('fit', iteration=iteration):
+                model.fit_generator(train_batches,
+                                    len(train_batches),
+                                    epochs=2,
+                                    validation_data=val_batches,
+                                    validation_steps=len(val_batches),
+                                    callbacks=[Throughput()])
     
         for diversity in [0.2, 0.5, 1.0, 1.2]:
             print()
@@ -86,45 +107,90 @@ def train(n_iter):
             print()
     
     print('Saving model...')
-    model.save('gru_char_rnn.h5')
-
-def generate(n_chars, diversity=0.6, stream=sys.stdout):
-    model.load_weights('gru_char_rnn.h5')
-    start_index = random.randint(0, len(text) - maxlen - 1)
-    
-    generated = ''
-    sentence = text[start_index: start_index + maxlen]
-    generated += sentence
+    with instrument.phase('save'):
+        model.save(model_file_name)
+        export(model, data, chars)
+
+def parallel_worker(comm, n_iter, sync_every, model_file, bundle):
+    # one rank of train_parallel: the same windows train() uses, split into
+    # a contiguous slice per rank
+    data, chars = load_corpus()
+    model = build_model(len(chars))
+    train_idxs, _ = split_windows(len(sliding_windows(data, maxlen, step)), 0.05)
+    lo, hi = parallel_train.shard(len(train_idxs), comm.rank, comm.size)
+    batches = OneHotWindows(data, maxlen, step, len(chars), batch_size, train_idxs[lo:hi])
+
+    def checkpoint(epoch):
+        print('Saving model...')
+        model.save(model_file)
+        export(model, data, chars, bundle)
+
+    # train() runs n_iter - 1 iterations of 2 epochs
+    parallel_train.fit(comm, model, batches, 2 * (n_iter - 1), sync_every, on_epoch_end=checkpoint)
+
+def train_parallel(n_iter, n_workers, sync_every=10, **run_args):
+    parallel_train.run(parallel_worker, n_workers, (n_iter, sync_every, model_file_name, bundle_path), **run_args)
+
+def generate(n_chars, diversity=0.6, stream=sys.stdout, bundle=bundle_path):
+    meta = load_bundle(bundle)
+    chars = meta['chars']
+    # one char per step, carrying the GRU state instead of re-reading a 40 char window
+    step_model = stateful_copy(load_model(meta['model_file']), batch_size=1)
+
+    seed = random.choice(meta['seeds'])
+    sentence = ''.join(chars[idx] for idx in seed)
     print('----- Generating with seed: "' + sentence + '"')
-    stream.write(generated)
-    
+    stream.write(sentence)
+
+    x_pred = np.zeros((1, 1, len(chars)), dtype=np.float32)
+    for idx in seed[:-1]:
+        x_pred[0, 0, idx] = 1.
+        step_model.predict_on_batch(x_pred)
+        x_pred[0, 0, idx] = 0.
+
+    next_index = seed[-1]
+    steps = instrument.StepTimer('generate_steps', diversity=diversity)
     for i in range(n_chars):
-        x_pred = np.zeros((1, maxlen, len(chars)))
-        for t, char in enumerate(sentence):
-            x_pred[0, t, char_indices[char]] = 1.
-    
-        preds = model.predict(x_pred, verbose=0)[0]
+        x_pred[0, 0, next_index] = 1.
+        preds = step_model.predict_on_batch(x_pred)[0]
+        x_pred[0, 0, next_index] = 0.
+
         next_index = sample(preds, diversity)
-        next_char = indices_char[next_index]
-    
-        generated += next_char
-        sentence = sentence[1:] + next_char
+        next_char = chars[next_index]
     
         stream.write(next_char)
         stream.flush()
+        steps.tick()
+    steps.close()
 
 parser = argparse.ArgumentParser(description='train/generate text with GRU char rnn')
-parser.add_argument('--mode', type=str, default='train', help='Either "train" or "generate"')
+parser.add_argument('--mode', type=str, default='train', help='Either "train", "generate" or "export" (bundle an existing gru_char_rnn.h5)')
 parser.add_argument('--iter', type=int, default=60, help='Number of training iterations')
 parser.add_argument('--chars', type=int, default=1000, help='Number of characters to generate')
-
-FLAGS = parser.parse_args()
+parser.add_argument('--bundle', type=str, default=bundle_path, help='Generation bundle to write in train/export mode and read in generate mode')
+parser.add_argument('--bptt', type=int, default=0, help='Train statefully over contiguous text with truncated BPTT of this many steps (0 to train on overlapping windows)')
+parallel_train.add_arguments(parser)
+instrument.add_arguments(parser, 'logs/gru_text_generation.jsonl')
 
 if __name__ == '__main__':
-    if FLAGS.mode == 'train':
-        train(FLAGS.iter)
+    FLAGS = parser.parse_args()
+    instrument.configure_from(FLAGS)
+    bundle_path = FLAGS.bundle
+    if FLAGS.mode == 'train' and (FLAGS.parallel > 1 or FLAGS.ranks):
+        if FLAGS.bptt:
+            raise ValueError('--parallel trains on windows, not with --bptt')
+        with instrument.phase('train', workers=FLAGS.parallel):
+            train_parallel(FLAGS.iter, FLAGS.parallel, FLAGS.sync_every,
+                           transport=FLAGS.transport, address=FLAGS.address, ranks=FLAGS.ranks)
+    elif FLAGS.mode == 'train':
+        with instrument.phase('train'):
+            train(FLAGS.iter, FLAGS.bptt)
     elif FLAGS.mode == 'generate':
-        generate(FLAGS.chars, stream=open('./generated.md', 'w'))
+        with instrument.phase('generate'):
+            generate(FLAGS.chars, stream=open('./generated.md', 'w'), bundle=FLAGS.bundle)
+    elif FLAGS.mode == 'export':
+        data, chars = load_corpus()
+        export(load_model(model_file_name), data, chars)
     else:
         print('Unrecognized mode', FLAGS.mode)
         raise TypeError
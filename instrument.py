@@ -0,0 +1,140 @@
+'''
+Per-phase timing and memory records, written as one JSON object per line.
+
+    with instrument.phase('tokenize', books=len(file_names)):
+        ...
+
+records wall and CPU seconds, RSS at the end and peak RSS during the phase.
+Phases nest ('train/fit'); StepTimer summarizes per-step latency of a loop, and
+model_utils.Throughput logs samples/sec from keras. Nothing is written until
+configure() is given a log path. One phase can also be profiled with cProfile
+or tracemalloc, dumped next to the log.
+'''
+
+from __future__ import print_function
+import json, os, sys, time
+
+log_path = None
+profile_phase = None
+profile_kind = 'cprofile'
+
+_stack = []
+
+def configure(path=None, profile=None, kind='cprofile'):
+    global log_path, profile_phase, profile_kind
+    log_path, profile_phase, profile_kind = path, profile, kind
+    if log_path:
+        os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+        record('run_start', argv=sys.argv, pid=os.getpid())
+
+def add_arguments(parser, default_log):
+    parser.add_argument('--log', type=str, default=default_log, help='Append per-phase timing and memory records to this JSONL file ("" to disable)')
+    parser.add_argument('--profile', type=str, default=None, help='Profile the phase with this name (e.g. fit, beam_search)')
+    parser.add_argument('--profile_kind', type=str, default='cprofile', choices=['cprofile', 'tracemalloc'])
+
+def configure_from(flags):
+    configure(flags.log or None, flags.profile, flags.profile_kind)
+
+def record(event, **fields):
+    if not log_path:
+        return
+    fields = dict(event=event, time=time.time(), **fields)
+    with open(log_path, 'a') as f:
+        f.write(json.dumps(fields, default=str) + '\n')
+
+def _memory_kb(field):
+    # current (VmRSS) or peak (VmHWM) resident set size from /proc, None elsewhere
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except IOError:
+        return None
+
+def _reset_peak():
+    # Linux lets a process reset its VmHWM so the next reading is this phase's peak
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except IOError:
+        return False
+
+class phase(object):
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.path = '/'.join([outer.name for outer in _stack] + [self.name])
+        self.peak_kb = 0
+        if log_path and _stack: # the reset below would lose the outer phase's peak so far
+            _stack[-1].peak_kb = max(_stack[-1].peak_kb, _memory_kb('VmHWM') or 0)
+        self.reset = log_path and _reset_peak()
+        self.profiler = _start_profile() if self.name == profile_phase else None
+        _stack.append(self)
+        self.wall, self.cpu = time.time(), time.process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall, cpu = time.time() - self.wall, time.process_time() - self.cpu
+        _stack.pop()
+        if self.profiler is not None:
+            _stop_profile(self.profiler, self.path)
+        if not log_path:
+            return
+        # an inner phase resets the peak counter, so carry its peak up to the outer ones
+        peak_kb = max(self.peak_kb, _memory_kb('VmHWM') or 0)
+        if _stack:
+            _stack[-1].peak_kb = max(_stack[-1].peak_kb, peak_kb)
+        record('phase', phase=self.path, wall=wall, cpu=cpu, rss_mb=(_memory_kb('VmRSS') or 0) / 1024.,
+               peak_rss_mb=peak_kb / 1024. if self.reset else None, failed=exc_info[0] is not None, **self.fields)
+
+def _start_profile():
+    if profile_kind == 'tracemalloc':
+        import tracemalloc
+        tracemalloc.start()
+        return tracemalloc
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def _stop_profile(profiler, path):
+    base = os.path.splitext(log_path or 'instrument.jsonl')[0] + '.' + path.replace('/', '.')
+    if profile_kind == 'tracemalloc':
+        snapshot = profiler.take_snapshot()
+        profiler.stop()
+        with open(base + '.tracemalloc.txt', 'w') as f:
+            for stat in snapshot.statistics('lineno')[:50]:
+                f.write(str(stat) + '\n')
+        print('Wrote', base + '.tracemalloc.txt')
+    else:
+        profiler.disable()
+        profiler.dump_stats(base + '.prof')
+        print('Wrote', base + '.prof', '(python -m pstats to read)')
+
+class StepTimer(object):
+    '''Per-step latency of a loop: call tick() once per step, close() to log
+    the count, mean and percentiles'''
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+        self.latencies = []
+        self.last = time.time()
+
+    def tick(self):
+        now = time.time()
+        self.latencies.append(now - self.last)
+        self.last = now
+
+    def close(self):
+        if not self.latencies:
+            return
+        latencies = sorted(self.latencies)
+        percentile = lambda p: latencies[min(int(p * len(latencies)), len(latencies) - 1)]
+        record('steps', phase='/'.join([outer.name for outer in _stack] + [self.name]), steps=len(latencies),
+               mean_ms=1000 * sum(latencies) / len(latencies), p50_ms=1000 * percentile(0.5),
+               p90_ms=1000 * percentile(0.9), max_ms=1000 * latencies[-1],
+               per_sec=len(latencies) / sum(latencies), **self.fields)
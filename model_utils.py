@@ -0,0 +1,101 @@
+import copy
+import time
+
+import numpy as np
+from keras import backend as K
+from keras.callbacks import Callback
+from keras.models import Sequential
+
+import instrument
+
+def _layer_configs(config):
+    # Sequential.get_config() is a list of layers in older keras, a dict in newer
+    return config if isinstance(config, list) else config['layers']
+
+def _stateful_rebuild(model, batch_size, timesteps, return_sequences=False):
+    config = copy.deepcopy(model.get_config())
+    layers = _layer_configs(config)
+
+    first = layers[0]['config']
+    first['batch_input_shape'] = (batch_size, timesteps) + tuple(first['batch_input_shape'][2:])
+    for layer in layers:
+        layer_config = layer['config']
+        if 'stateful' in layer_config:
+            layer_config['stateful'] = True
+            if return_sequences:
+                layer_config['return_sequences'] = True
+        if layer['class_name'] == 'Embedding' and layer_config.get('input_length') is not None:
+            # char id input is (timesteps, word length) and leaves input_length unset
+            layer_config['input_length'] = timesteps
+
+    custom_objects = {type(layer).__name__: type(layer) for layer in model.layers}
+    stateful = Sequential.from_config(config, custom_objects=custom_objects)
+    stateful.set_weights(model.get_weights())
+    return stateful
+
+def stateful_copy(model, batch_size=1):
+    '''Rebuild a Sequential model as a stateful stack that is fed one timestep
+    per call, with the trained weights copied over'''
+    return _stateful_rebuild(model, batch_size, 1)
+
+def tbptt_copy(model, batch_size, bptt):
+    '''Rebuild a Sequential model for truncated backprop through time: stateful,
+    fed (batch_size, bptt) chunks and predicting at every timestep. The weights
+    have the same shapes, so copy them back with model.set_weights when done'''
+    return _stateful_rebuild(model, batch_size, bptt, return_sequences=True)
+
+class ResetStates(Callback):
+    '''Start every epoch of stateful training from zero state'''
+    def on_epoch_begin(self, epoch, logs=None):
+        self.model.reset_states()
+
+class Throughput(Callback):
+    '''Log samples/sec and per-batch latency of every epoch (see instrument)'''
+    def __init__(self, name='fit'):
+        super(Throughput, self).__init__()
+        self.name = name
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.samples = 0
+        self.steps = instrument.StepTimer(self.name + '_batches', epoch=epoch)
+        self.start = time.time()
+
+    def on_batch_end(self, batch, logs=None):
+        self.samples += (logs or {}).get('size', 0)
+        self.steps.tick()
+
+    def on_epoch_end(self, epoch, logs=None):
+        seconds = time.time() - self.start
+        self.steps.close()
+        instrument.record('epoch', phase=self.name, epoch=epoch, samples=self.samples, seconds=seconds,
+                          samples_per_sec=self.samples / seconds,
+                          **{key: float(value) for key, value in (logs or {}).items()})
+
+class StatefulPredictor(object):
+    '''Beam search backend that feeds each beam one token per step through a
+    stateful copy of the model and keeps each beam's recurrent state in its row'''
+    def __init__(self, model, beam_width, to_input=lambda tokens: tokens[:, None]):
+        self.model = stateful_copy(model, batch_size=beam_width)
+        self.beam_width = beam_width
+        self.to_input = to_input
+        self.states = [state for layer in self.model.layers for state in getattr(layer, 'states', None) or []]
+
+    def _predict(self, tokens):
+        x = np.zeros(self.beam_width, dtype=np.int32)
+        x[:len(tokens)] = tokens
+        return self.model.predict_on_batch(self.to_input(x))[:len(tokens)]
+
+    def start(self, init_sentence):
+        # every beam starts from the seed, so warm all rows up together
+        self.model.reset_states()
+        for token in init_sentence[:-1]:
+            self._predict(np.full(self.beam_width, token))
+
+    def __call__(self, search):
+        return self._predict(search.last_tokens())
+
+    def reorder(self, parents):
+        values = K.batch_get_value(self.states)
+        for value in values:
+            value[:len(parents)] = value[parents]
+        K.batch_set_value(list(zip(self.states, values)))
@@ -0,0 +1,226 @@
+'''
+Generate a whole novel from an exported bundle, one chapter per task in a
+process pool, checkpointing every chunk so an interrupted run picks up where
+it stopped:
+
+    python novel.py bundles/gru_char_rnn novels/henty --words 50000 --chapters 25 --processes 8
+
+The book is planned as --chapters chapters split into --streams runs of
+consecutive chapters. A chapter continues from the end state of the one
+before it in its run, or starts from its own seed if it is the first; the
+runs are generated in parallel, so --streams 1 is one continuous text and
+the default (one run per chapter) is the most parallel. Each chunk's text
+is written to <output>/chapters/<chapter>/, followed by the model state,
+context and numpy RNG state it ended with, so a resumed chunk produces the
+same text. The finished chapters are assembled into <output>/novel.md.
+'''
+
+from __future__ import print_function
+import argparse, json, os, shutil, sys
+from multiprocessing import Pool
+
+# every process steps one row at a time, where BLAS threads only get in each other's way
+for key in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+    os.environ.setdefault(key, '1')
+
+import numpy as np
+
+import beam_utils
+import sampling
+from bundle_utils import load_bundle
+from numpy_inference import NumpyModel, NumpyPredictor, quantize_dtypes
+from quantize import quantized_file
+from tokenizer import detokenize_tokens
+
+def _chapter_dir(output, chapter):
+    return os.path.join(output, 'chapters', '{:03d}'.format(chapter))
+
+def _chunk_file(output, chapter, chunk):
+    return os.path.join(_chapter_dir(output, chapter), 'chunk_{:04d}.txt'.format(chunk))
+
+def _state_file(output, chapter):
+    return os.path.join(_chapter_dir(output, chapter), 'state.npz')
+
+def _save_state(output, chapter, state):
+    # written after the chunk's text, so a crash in between only redoes that chunk
+    rng_name, rng_keys, rng_pos, rng_has_gauss, rng_gauss = state['rng']
+    arrays = {'states_{}'.format(i): value for i, value in enumerate(state['states'])}
+    tmp = _state_file(output, chapter) + '.tmp.npz'
+    np.savez(tmp, tokens=np.asarray(state['tokens'], dtype=np.int32), chunks=state['chunks'], words=state['words'],
+             done=state['done'], n_states=len(state['states']), rng_keys=rng_keys,
+             rng_info=np.array([rng_pos, rng_has_gauss, rng_gauss]), **arrays)
+    os.replace(tmp, _state_file(output, chapter))
+
+def _load_state(output, chapter):
+    if not os.path.exists(_state_file(output, chapter)):
+        return None
+    with np.load(_state_file(output, chapter)) as f:
+        rng_pos, rng_has_gauss, rng_gauss = f['rng_info']
+        return {
+            'tokens': list(f['tokens']),
+            'chunks': int(f['chunks']),
+            'words': int(f['words']),
+            'done': bool(f['done']),
+            'states': [f['states_{}'.format(i)] for i in range(int(f['n_states']))],
+            'rng': ('MT19937', f['rng_keys'], int(rng_pos), int(rng_has_gauss), float(rng_gauss)),
+        }
+
+def plan(n_chapters, n_streams):
+    '''Runs of consecutive chapter numbers, one per stream'''
+    n_streams = min(n_streams, n_chapters)
+    return [list(range(n_chapters * s // n_streams, n_chapters * (s + 1) // n_streams)) for s in range(n_streams)]
+
+class CharChapter(object):
+    '''Steps a NumpyModel one char at a time, carrying its recurrent state from chunk to chunk'''
+    def __init__(self, meta, settings):
+        self.chars = meta['chars']
+        self.settings = settings
+        self.model = NumpyModel(meta['weights_file'], batch_size=1)
+
+    def start(self, seed):
+        self.model.reset_states()
+        for idx in seed[:-1]:
+            self.model.step([idx])
+        return [seed[-1]], [state.copy() for state in self.model.get_states()]
+
+    def chunk(self, tokens, states):
+        for state, saved in zip(self.model.get_states(), states):
+            state[...] = saved
+        s = self.settings
+        next_index, out = tokens[-1], []
+        for i in range(s['chunk']):
+            next_index = sampling.sample(self.model.step([next_index])[0], s['diversity'], s['top_k'], s['top_p'])
+            out.append(next_index)
+        text = ''.join(self.chars[idx] for idx in out)
+        return text, [next_index], [state.copy() for state in self.model.get_states()]
+
+class WordChapter(object):
+    '''Beam searches chunk words at a time; the last maxlen words carry over as
+    the next chunk's context, so the state to checkpoint is just those words'''
+    def __init__(self, meta, settings):
+        self.meta = meta
+        self.settings = settings
+        self.predictor = NumpyPredictor(meta['weights_file'], settings['beam_width'])
+
+    def start(self, seed):
+        return list(seed), []
+
+    def chunk(self, tokens, states):
+        s = self.settings
+        best = beam_utils.beam_search(self.predictor, tokens, self.meta['maxlen'], s['chunk'], s['beam_width'],
+                                      s['diversity'], sample=s['sample'], top_k=s['top_k'], top_p=s['top_p'],
+                                      no_repeat_ngram=s['no_repeat_ngram'], frequency_penalty=s['frequency_penalty'])
+        text = detokenize_tokens(self.meta['vocab'][idx] for idx in best[len(tokens):])
+        return ' ' + text, list(best[-self.meta['maxlen']:]), []
+
+def write_chapter(output, chapter, previous, meta, writer, settings, words_per_chapter):
+    state = _load_state(output, chapter)
+    if state is None:
+        if previous is None:
+            seeds = meta['seeds']
+            tokens, states = writer.start(seeds[np.random.RandomState([settings['seed'], chapter]).randint(len(seeds))])
+        else: # the same run of chapters, so the previous one has finished in this process
+            end = _load_state(output, previous)
+            tokens, states = end['tokens'], end['states']
+        rng = np.random.RandomState([settings['seed'], chapter]).get_state()
+        state = {'tokens': tokens, 'states': states, 'chunks': 0, 'words': 0, 'done': False, 'rng': rng}
+        os.makedirs(_chapter_dir(output, chapter), exist_ok=True)
+
+    while not state['done']:
+        np.random.set_state(state['rng']) # sampling draws from the global generator
+        text, tokens, states = writer.chunk(state['tokens'], state['states'])
+        if state['chunks'] == 0: # word chunks start with the space that joins them to the previous one
+            text = text.lstrip(' ')
+        with open(_chunk_file(output, chapter, state['chunks']), 'w', encoding='utf8') as f:
+            f.write(text)
+        words = state['words'] + len(text.split())
+        state = {'tokens': tokens, 'states': states, 'chunks': state['chunks'] + 1, 'words': words,
+                 'done': words >= words_per_chapter, 'rng': np.random.get_state()}
+        _save_state(output, chapter, state)
+        print('chapter {}: {} / {} words'.format(chapter + 1, words, words_per_chapter))
+        sys.stdout.flush()
+
+def write_stream(args):
+    output, chapters, settings = args
+    meta = load_bundle(settings['bundle'])
+    if settings['quantized']:
+        meta['weights_file'] = quantized_file(meta, settings['quantized'])
+    writer = (CharChapter if meta['kind'] == 'char' else WordChapter)(meta, settings)
+    words_per_chapter = -(-settings['words'] // settings['chapters'])
+    for i, chapter in enumerate(chapters):
+        write_chapter(output, chapter, chapters[i - 1] if i else None, meta, writer, settings, words_per_chapter)
+    return chapters
+
+def assemble(output, settings, path):
+    '''All chapters into one markdown file, copied chunk file by chunk file through one buffer'''
+    with open(path + '.tmp', 'w', encoding='utf8', buffering=1 << 20) as novel:
+        if settings['title']:
+            novel.write('# {}\n\n'.format(settings['title']))
+        for chapter in range(settings['chapters']):
+            novel.write('## Chapter {}\n\n'.format(chapter + 1))
+            for chunk in range(_load_state(output, chapter)['chunks']):
+                with open(_chunk_file(output, chapter, chunk), encoding='utf8') as f:
+                    shutil.copyfileobj(f, novel)
+            novel.write('\n\n')
+    os.replace(path + '.tmp', path)
+
+def load_settings(output, settings):
+    # a resumed run has to keep the settings its checkpoints were made with
+    plan_file = os.path.join(output, 'plan.json')
+    if os.path.exists(plan_file):
+        with open(plan_file, encoding='utf8') as f:
+            saved = json.load(f)
+        changed = sorted(key for key in settings if saved.get(key) != settings[key])
+        if changed:
+            raise ValueError('{} was started with different {}; use another output directory'.format(output, ', '.join(changed)))
+        print('Resuming', output)
+    else:
+        os.makedirs(output, exist_ok=True)
+        with open(plan_file + '.tmp', 'w', encoding='utf8') as f:
+            json.dump(settings, f, indent=2)
+        os.replace(plan_file + '.tmp', plan_file)
+    return settings
+
+def write_novel(output, settings, processes=None):
+    settings = load_settings(output, settings)
+    streams = plan(settings['chapters'], settings['streams'] or settings['chapters'])
+    pool = Pool(processes)
+    try:
+        for chapters in pool.imap_unordered(write_stream, [(output, chapters, settings) for chapters in streams]):
+            print('finished chapters', ', '.join(str(chapter + 1) for chapter in chapters))
+    finally:
+        pool.terminate()
+    path = os.path.join(output, 'novel.md')
+    assemble(output, settings, path)
+    print('Wrote', path)
+    return path
+
+parser = argparse.ArgumentParser(description='generate a resumable, chapter-parallel novel from a bundle')
+parser.add_argument('bundle', type=str, help='Generation bundle directory (see bundle_utils)')
+parser.add_argument('output', type=str, help='Directory for the plan, checkpoints and novel.md; rerun with the same one to resume')
+parser.add_argument('--words', type=int, default=50000, help='Length of the novel in words')
+parser.add_argument('--chapters', type=int, default=25)
+parser.add_argument('--streams', type=int, default=None, help='Runs of chapters that each continue from the previous chapter (default: every chapter starts from its own seed)')
+parser.add_argument('--processes', type=int, default=None, help='Worker processes (default: one per core)')
+parser.add_argument('--chunk', type=int, default=None, help='Chars or words generated between checkpoints (default 5000 chars or 250 words)')
+parser.add_argument('--title', type=str, default='')
+parser.add_argument('--seed', type=int, default=0, help='Seed for every chapter\'s random numbers')
+parser.add_argument('--diversity', type=float, default=None, help='Sampling temperature (default 0.6 for chars, 1.6 for words)')
+parser.add_argument('--beam_width', type=int, default=30, help='Beam width for word bundles')
+parser.add_argument('--top_k', type=int, default=None, help='Only sample among the k most likely next tokens')
+parser.add_argument('--top_p', type=float, default=None, help='Only sample among the most likely next tokens holding this much probability (nucleus sampling)')
+parser.add_argument('--no_repeat_ngram', type=int, default=0, help='Never let a beam repeat an n-gram of this many words (0 to allow repeats)')
+parser.add_argument('--frequency_penalty', type=float, default=0., help='Log-probability subtracted from a word for each time its beam already used it')
+parser.add_argument('--quantized', type=str, default=None, choices=quantize_dtypes, help='Use weights written by quantize.py')
+parser.add_argument('--deterministic', dest='sample', action='store_false', help='Keep the highest scoring beams instead of sampling them')
+
+if __name__ == '__main__':
+    FLAGS = parser.parse_args()
+    kind = load_bundle(FLAGS.bundle)['kind']
+    if kind not in ('char', 'word'):
+        sys.exit('novel.py does not support {} bundles'.format(kind))
+    settings = {key: getattr(FLAGS, key) for key in ['bundle', 'words', 'chapters', 'streams', 'title', 'seed', 'beam_width',
+                                                      'top_k', 'top_p', 'no_repeat_ngram', 'frequency_penalty', 'quantized', 'sample']}
+    settings['chunk'] = FLAGS.chunk or (5000 if kind == 'char' else 250)
+    settings['diversity'] = FLAGS.diversity or (0.6 if kind == 'char' else 1.6)
+    write_novel(FLAGS.output, settings, FLAGS.processes)
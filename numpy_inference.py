@@ -0,0 +1,366 @@
+'''
+NumPy-only forward pass for the Sequential GRU/LSTM models, so generation can
+run without importing TensorFlow or keras.
+
+export_npz() reads a trained keras model into a .npz (BatchNormalization is
+folded into the neighbouring Embedding or input kernel, Dropout is dropped),
+and NumpyModel steps it one token at a time with recurrent state per row.
+quantize_npz() stores the weight matrices as per-channel int8 or float16.
+
+    python numpy_inference.py bundles/gru_char_rnn --check
+'''
+
+from __future__ import print_function
+import argparse, json, os, sys
+
+import numpy as np
+
+def hard_sigmoid(x, out=None):
+    out = np.multiply(x, 0.2, out=out)
+    out += 0.5
+    return np.clip(out, 0., 1., out=out)
+
+def sigmoid(x, out=None):
+    out = np.negative(x, out=out)
+    np.exp(out, out=out)
+    out += 1.
+    return np.reciprocal(out, out=out)
+
+def linear(x, out=None):
+    if out is None:
+        return x
+    out[...] = x
+    return out
+
+def relu(x, out=None):
+    return np.maximum(x, 0., out=out)
+
+def softmax(x, out=None):
+    out = np.subtract(x, x.max(axis=-1, keepdims=True), out=out)
+    np.exp(out, out=out)
+    out /= out.sum(axis=-1, keepdims=True)
+    return out
+
+activations = {'hard_sigmoid': hard_sigmoid, 'sigmoid': sigmoid, 'tanh': np.tanh, 'linear': linear, 'relu': relu, 'softmax': softmax}
+
+def _batchnorm_affine(layer):
+    config = layer.get_config()
+    weights = layer.get_weights()
+    gamma = weights.pop(0) if config.get('scale', True) else 1.
+    beta = weights.pop(0) if config.get('center', True) else 0.
+    mean, var = weights
+    scale = gamma / np.sqrt(var + config['epsilon'])
+    return scale, beta - mean * scale
+
+def export_npz(model, path):
+    '''Write a Sequential model's weights and layer spec to path (.npz)'''
+    spec = []
+    arrays = {}
+    pending = None # affine transform from a BatchNormalization, applied to the next layer's input
+
+    for layer in model.layers:
+        kind = type(layer).__name__
+        config = layer.get_config()
+        if kind == 'Dropout':
+            continue
+        if kind == 'BatchNormalization':
+            scale, shift = _batchnorm_affine(layer)
+            if spec and spec[-1]['kind'] == 'Embedding' and pending is None:
+                name = spec[-1]['name']
+                arrays[name + '/embeddings'] = arrays[name + '/embeddings'] * scale + shift
+            elif pending is None:
+                pending = (scale, shift)
+            else: # two in a row compose
+                pending = (pending[0] * scale, pending[1] * scale + shift)
+            continue
+
+        name = 'layer{}'.format(len(spec))
+        weights = [w.astype(np.float32) for w in layer.get_weights()]
+        entry = {'kind': kind, 'name': name}
+        if kind == 'Embedding':
+            arrays[name + '/embeddings'] = weights[0]
+        elif kind in ('LSTM', 'GRU', 'Dense', 'SampledSoftmax'):
+            kernel, bias = weights[0], weights[-1] if config.get('use_bias', True) else None
+            if kind == 'SampledSoftmax': # a dense softmax at inference, stored (vocab, dim)
+                kernel = kernel.T
+                entry['kind'] = 'Dense'
+                config = dict(config, units=kernel.shape[1], activation='softmax')
+            if pending is not None:
+                # W (a * x + b) + c == (a[:, None] * W) x + (b W + c)
+                scale, shift = pending
+                input_bias = shift.dot(kernel)
+                kernel = kernel * scale[:, None]
+                if bias is None:
+                    bias = input_bias
+                elif bias.ndim == 2: # GRU reset_after keeps input and recurrent biases apart
+                    bias = bias.copy()
+                    bias[0] += input_bias
+                else:
+                    bias = bias + input_bias
+                pending = None
+            arrays[name + '/kernel'] = kernel.astype(np.float32)
+            if bias is not None:
+                arrays[name + '/bias'] = bias.astype(np.float32)
+            entry['units'] = config['units']
+            entry['activation'] = config['activation']
+            if kind in ('LSTM', 'GRU'):
+                arrays[name + '/recurrent_kernel'] = weights[1]
+                entry['recurrent_activation'] = config['recurrent_activation']
+                entry['reset_after'] = config.get('reset_after', False)
+        else:
+            raise ValueError('numpy_inference does not support {} layers'.format(kind))
+        spec.append(entry)
+
+    if pending is not None:
+        raise ValueError('A trailing BatchNormalization has no layer to fold into')
+    # a recurrent first layer reads one-hot vectors, which is a row lookup of its kernel
+    input_kind = 'embedding' if spec[0]['kind'] == 'Embedding' else 'one_hot'
+    meta = {'layers': spec, 'input': input_kind}
+    np.savez(path, spec=np.array(json.dumps(meta)), **arrays)
+
+quantize_dtypes = ['int8', 'float16']
+
+def _is_matrix(key):
+    return key.endswith(('/kernel', '/recurrent_kernel', '/embeddings'))
+
+def quantize_npz(path, quantized_path, dtype='int8'):
+    '''Copy an exported .npz with its weight matrices stored as dtype. int8 is
+    symmetric and per output column, with the float32 scales in '<key>/scale';
+    biases stay float32'''
+    with np.load(path) as npz:
+        arrays = {key: npz[key] for key in npz.files}
+    for key in [key for key in arrays if _is_matrix(key)]:
+        weights = arrays[key]
+        if dtype == 'float16':
+            arrays[key] = weights.astype(np.float16)
+        elif dtype == 'int8':
+            scale = np.abs(weights).max(axis=0) / 127.
+            scale[scale == 0] = 1.
+            arrays[key] = np.round(weights / scale).astype(np.int8)
+            arrays[key + '/scale'] = scale.astype(np.float32)
+        else:
+            raise ValueError('Unknown quantization dtype ' + dtype)
+    np.savez(quantized_path, **arrays)
+
+class _Table(object):
+    '''Rows gathered by token id (embeddings, or a first kernel fed one-hot
+    input). Stays in its stored dtype, only the gathered rows are converted'''
+    def __init__(self, values, scale=None):
+        self.values = values
+        self.scale = scale
+
+    def take(self, tokens, out=None):
+        rows = self.values[tokens]
+        if self.scale is not None:
+            return np.multiply(rows, self.scale, out=out)
+        if out is None:
+            return rows.astype(np.float32)
+        out[...] = rows
+        return out
+
+def _load_arrays(path):
+    '''spec and arrays of an exported .npz. Quantized matmul weights are
+    dequantized to float32 once, here: numpy has no int8 or fast float16 matmul,
+    and dequantizing inside every step was slower than float32. Quantization so
+    shrinks the file, not the matmuls; gathered tables are wrapped in _Table and
+    keep their stored dtype, since only the gathered rows are converted'''
+    with np.load(path) as npz:
+        arrays = {key: npz[key] for key in npz.files}
+    meta = json.loads(str(arrays.pop('spec')))
+    tables = {layer['name'] + '/embeddings' for layer in meta['layers'] if layer['kind'] == 'Embedding'}
+    if meta['input'] == 'one_hot':
+        tables.add(meta['layers'][0]['name'] + '/kernel')
+
+    for key in [key for key in arrays if _is_matrix(key)]:
+        scale = arrays.pop(key + '/scale', None)
+        if key in tables:
+            arrays[key] = _Table(arrays[key], scale)
+        elif scale is not None:
+            arrays[key] = arrays[key] * scale
+        else:
+            arrays[key] = arrays[key].astype(np.float32)
+    return meta, arrays
+
+class _Recurrent(object):
+    def __init__(self, entry, arrays):
+        name = entry['name']
+        self.kind = entry['kind']
+        self.units = entry['units']
+        self.kernel = arrays[name + '/kernel']
+        self.recurrent_kernel = arrays[name + '/recurrent_kernel']
+        self.bias = arrays.get(name + '/bias')
+        self.activation = activations[entry['activation']]
+        self.recurrent_activation = activations[entry['recurrent_activation']]
+        self.reset_after = entry.get('reset_after', False)
+        self.n_states = 2 if self.kind == 'LSTM' else 1
+
+        if self.kind == 'GRU' and not self.reset_after:
+            # the candidate's recurrent term needs r first, so keep its columns apart
+            self.recurrent_kernel, self.recurrent_candidate = (np.ascontiguousarray(self.recurrent_kernel[:, :2 * self.units]),
+                                                               np.ascontiguousarray(self.recurrent_kernel[:, 2 * self.units:]))
+
+    def allocate(self, batch_size):
+        gates = 4 if self.kind == 'LSTM' else 3
+        self.states = [np.zeros((batch_size, self.units), dtype=np.float32) for _ in range(self.n_states)]
+        self.x_gates = np.empty((batch_size, gates * self.units), dtype=np.float32)
+        self.h_gates = np.empty((batch_size, self.recurrent_kernel.shape[1]), dtype=np.float32)
+
+    def input_projection(self, x, tokens=None):
+        '''x W (+ input bias) into the first rows of self.x_gates; tokens selects
+        kernel rows for one-hot input'''
+        x_gates = self.x_gates[:len(x if tokens is None else tokens)]
+        if tokens is not None:
+            self.kernel.take(tokens, out=x_gates)
+        else:
+            np.dot(x, self.kernel, out=x_gates)
+        if self.bias is not None:
+            x_gates += self.bias[0] if self.bias.ndim == 2 else self.bias
+        return x_gates
+
+    def step(self, x_gates):
+        '''Advance the first len(x_gates) rows of state'''
+        u = self.units
+        n = len(x_gates)
+        if self.kind == 'LSTM':
+            h, c = self.states[0][:n], self.states[1][:n]
+            gates = x_gates
+            gates += np.dot(h, self.recurrent_kernel, out=self.h_gates[:n])
+            i = self.recurrent_activation(gates[:, :u])
+            f = self.recurrent_activation(gates[:, u:2 * u])
+            g = self.activation(gates[:, 2 * u:3 * u])
+            o = self.recurrent_activation(gates[:, 3 * u:])
+            c *= f
+            c += i * g
+            h[...] = o * self.activation(c)
+            return h
+
+        h = self.states[0][:n]
+        if self.reset_after:
+            h_gates = np.dot(h, self.recurrent_kernel, out=self.h_gates[:n])
+            if self.bias is not None:
+                h_gates += self.bias[1]
+            z = self.recurrent_activation(x_gates[:, :u] + h_gates[:, :u])
+            r = self.recurrent_activation(x_gates[:, u:2 * u] + h_gates[:, u:2 * u])
+            hh = self.activation(x_gates[:, 2 * u:] + r * h_gates[:, 2 * u:])
+        else:
+            h_zr = np.dot(h, self.recurrent_kernel, out=self.h_gates[:n])
+            z = self.recurrent_activation(x_gates[:, :u] + h_zr[:, :u])
+            r = self.recurrent_activation(x_gates[:, u:2 * u] + h_zr[:, u:])
+            hh = self.activation(x_gates[:, 2 * u:] + np.dot(r * h, self.recurrent_candidate))
+        # keras: h = z * h_prev + (1 - z) * hh
+        h -= hh
+        h *= z
+        h += hh
+        return h
+
+class NumpyModel(object):
+    '''Single-timestep, stateful forward pass of an exported model.
+    step() takes one token id per row and returns the next-token probabilities.
+    Fewer tokens than batch_size step only the first rows, leaving the rest as they are'''
+    def __init__(self, path, batch_size=1):
+        meta, arrays = _load_arrays(path)
+        self.input_kind = meta['input']
+        self.embeddings = None
+        self.recurrent = []
+        self.dense = []
+        for entry in meta['layers']:
+            if entry['kind'] == 'Embedding':
+                self.embeddings = arrays[entry['name'] + '/embeddings']
+            elif entry['kind'] in ('LSTM', 'GRU'):
+                self.recurrent.append(_Recurrent(entry, arrays))
+            else:
+                self.dense.append((arrays[entry['name'] + '/kernel'], arrays.get(entry['name'] + '/bias'), activations[entry['activation']]))
+        self.reset_states(batch_size)
+
+    def reset_states(self, batch_size=None):
+        self.batch_size = batch_size or self.batch_size
+        for layer in self.recurrent:
+            layer.allocate(self.batch_size)
+
+    def step(self, tokens):
+        tokens = np.asarray(tokens, dtype=np.intp)
+        first = self.recurrent[0]
+        if self.input_kind == 'one_hot':
+            x_gates = first.input_projection(None, tokens)
+        else:
+            x_gates = first.input_projection(self.embeddings.take(tokens))
+        x = first.step(x_gates)
+        for layer in self.recurrent[1:]:
+            x = layer.step(layer.input_projection(x))
+        for kernel, bias, activation in self.dense:
+            x = np.dot(x, kernel)
+            if bias is not None:
+                x += bias
+            x = activation(x, out=x)
+        return x
+
+    def get_states(self):
+        return [state for layer in self.recurrent for state in layer.states]
+
+    def reorder(self, rows):
+        '''Gather state rows, e.g. to follow beams after pruning'''
+        self.copy_rows(rows, np.arange(len(rows)))
+
+    def copy_rows(self, src, dst):
+        for state in self.get_states():
+            state[dst] = state[src]
+
+    def reset_rows(self, rows):
+        for state in self.get_states():
+            state[rows] = 0.
+
+class NumpyPredictor(object):
+    '''Beam search backend (see beam_utils.WindowPredictor) over a NumpyModel'''
+    def __init__(self, path, beam_width):
+        self.model = NumpyModel(path, batch_size=beam_width)
+        self.beam_width = beam_width
+
+    def _predict(self, tokens):
+        return self.model.step(tokens)
+
+    def start(self, init_sentence):
+        self.model.reset_states()
+        for token in init_sentence[:-1]:
+            self._predict(np.full(self.beam_width, token))
+
+    def __call__(self, search):
+        return self._predict(search.last_tokens())
+
+    def reorder(self, parents):
+        self.model.reorder(parents)
+
+def check(model, path, n_steps=50, batch_size=4, atol=1e-4):
+    '''Compare NumpyModel against a stateful keras copy on random tokens'''
+    from model_utils import stateful_copy
+    keras_model = stateful_copy(model, batch_size=batch_size)
+    numpy_model = NumpyModel(path, batch_size=batch_size)
+    one_hot = numpy_model.input_kind == 'one_hot'
+    n_classes = model.layers[-1].get_config().get('units') or model.output_shape[-1]
+
+    worst = 0.
+    tokens = np.random.randint(n_classes, size=(n_steps, batch_size))
+    for step_tokens in tokens:
+        if one_hot:
+            x = np.zeros((batch_size, 1, n_classes), dtype=np.float32)
+            x[np.arange(batch_size), 0, step_tokens] = 1.
+        else:
+            x = step_tokens[:, None]
+        expected = keras_model.predict_on_batch(x)
+        worst = max(worst, np.abs(numpy_model.step(step_tokens) - expected).max())
+    print('max abs difference over {} steps: {:.2e}'.format(n_steps, worst))
+    return worst <= atol
+
+parser = argparse.ArgumentParser(description='export a bundle\'s keras model for numpy-only generation')
+parser.add_argument('bundle', type=str, help='Generation bundle directory (see bundle_utils)')
+parser.add_argument('--check', action='store_true', help='Compare the numpy forward pass against keras')
+
+if __name__ == '__main__':
+    FLAGS = parser.parse_args()
+    from keras.models import load_model
+    import softmax_heads
+    model = load_model(os.path.join(FLAGS.bundle, 'model.h5'), custom_objects=softmax_heads.custom_objects)
+    path = os.path.join(FLAGS.bundle, 'weights.npz')
+    export_npz(model, path)
+    print('Wrote', path)
+    if FLAGS.check and not check(model, path):
+        sys.exit(1)
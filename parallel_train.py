@@ -0,0 +1,287 @@
+'''
+Data-parallel training on one machine's cores: N worker processes each train
+a copy of the model on their own shard of the data, and every sync_every
+batches their weights are replaced by the average over all workers (local
+SGD / model averaging; optimizer state stays per worker). Rank 0 writes the
+checkpoints.
+
+Weights are averaged through shared memory, each worker reducing its own
+slice of the parameters, or over sockets through rank 0, which is how ranks
+started on other machines (or separate local processes standing in for them)
+join a run:
+
+    python word_rnn_generation.py --parallel 4
+    python word_rnn_generation.py --parallel 4 --transport socket --address node0:6000 --ranks 0 1
+'''
+
+from __future__ import print_function
+import os, threading, time
+import multiprocessing as mp
+from multiprocessing import connection, shared_memory
+from queue import Queue
+
+import numpy as np
+
+transports = ['shm', 'socket']
+
+_thread_env = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+
+class SharedMemoryComm(object):
+    '''Ranks on one machine: a slot of parameters per rank plus one for the
+    average, in a block rank 0 creates once it knows the parameter count'''
+    def __init__(self, rank, size, name, barrier, n_params, scalar):
+        self.rank, self.size, self.name, self.barrier = rank, size, name, barrier
+        self.n_params, self.scalar = n_params, scalar # mp.Values, set by rank 0
+        self.memory = None
+
+    def _attach(self, n):
+        if self.rank == 0:
+            self.n_params.value = n
+            self.memory = shared_memory.SharedMemory(self.name, create=True, size=4 * (self.size + 1) * n)
+        self.barrier.wait()
+        if self.rank != 0:
+            self.memory = shared_memory.SharedMemory(self.name)
+        self.slots = np.ndarray((self.size + 1, self.n_params.value), dtype=np.float32, buffer=self.memory.buf)
+        lo, hi = [self.n_params.value * r // self.size for r in (self.rank, self.rank + 1)]
+        self.part = slice(lo, hi)
+
+    def average(self, flat):
+        if self.memory is None:
+            self._attach(len(flat))
+        self.slots[self.rank] = flat
+        self.barrier.wait()
+        # reduce-scatter: each rank averages its own slice of the parameters
+        np.mean(self.slots[:self.size, self.part], axis=0, out=self.slots[self.size, self.part])
+        self.barrier.wait()
+        flat[:] = self.slots[self.size]
+        return flat
+
+    def broadcast(self, flat):
+        if self.memory is None:
+            self._attach(len(flat))
+        if self.rank == 0:
+            self.slots[self.size] = flat
+        self.barrier.wait()
+        flat[:] = self.slots[self.size]
+        self.barrier.wait() # nobody writes the average slot again until all have read it
+        return flat
+
+    def minimum(self, value):
+        if self.rank == 0:
+            self.scalar.value = value
+        self.barrier.wait()
+        if self.rank != 0:
+            with self.scalar.get_lock():
+                self.scalar.value = min(self.scalar.value, value)
+        self.barrier.wait()
+        value = self.scalar.value
+        self.barrier.wait()
+        return value
+
+    def close(self):
+        if self.memory is not None:
+            del self.slots
+            self.memory.close()
+            self.barrier.wait()
+            if self.rank == 0:
+                self.memory.unlink()
+
+class SocketComm(object):
+    '''Ranks anywhere: every rank connects to rank 0, which averages and
+    sends the result back'''
+    def __init__(self, rank, size, address, authkey=b'parallel_train'):
+        self.rank, self.size = rank, size
+        if rank == 0:
+            listener = connection.Listener(address, authkey=authkey)
+            self.peers = [None] * size
+            for i in range(size - 1):
+                conn = listener.accept()
+                self.peers[conn.recv()] = conn
+            listener.close()
+        else:
+            for attempt in range(600): # rank 0 may still be loading the corpus
+                try:
+                    self.root = connection.Client(address, authkey=authkey)
+                    break
+                except (ConnectionRefusedError, FileNotFoundError):
+                    time.sleep(0.5)
+            else:
+                raise ConnectionError('rank 0 is not listening on {}'.format(address))
+            self.root.send(rank)
+
+    def average(self, flat):
+        if self.rank == 0:
+            total = flat.astype(np.float64)
+            for conn in self.peers[1:]:
+                total += np.frombuffer(conn.recv_bytes(), dtype=np.float32)
+            flat[:] = total / self.size
+            for conn in self.peers[1:]:
+                conn.send_bytes(flat)
+        else:
+            self.root.send_bytes(flat)
+            flat[:] = np.frombuffer(self.root.recv_bytes(), dtype=np.float32)
+        return flat
+
+    def broadcast(self, flat):
+        if self.rank == 0:
+            for conn in self.peers[1:]:
+                conn.send_bytes(flat)
+        else:
+            flat[:] = np.frombuffer(self.root.recv_bytes(), dtype=np.float32)
+        return flat
+
+    def minimum(self, value):
+        if self.rank == 0:
+            value = min([value] + [conn.recv() for conn in self.peers[1:]])
+            for conn in self.peers[1:]:
+                conn.send(value)
+            return value
+        self.root.send(value)
+        return self.root.recv()
+
+    def close(self):
+        for conn in (self.peers[1:] if self.rank == 0 else [self.root]):
+            conn.close()
+
+class FlatWeights(object):
+    '''A model's weights as one float32 vector and back'''
+    def __init__(self, model):
+        self.model = model
+        self.shapes = [w.shape for w in model.get_weights()]
+        self.flat = np.empty(sum(int(np.prod(shape)) for shape in self.shapes), dtype=np.float32)
+
+    def get(self):
+        offset = 0
+        for w in self.model.get_weights():
+            self.flat[offset:offset + w.size] = w.ravel()
+            offset += w.size
+        return self.flat
+
+    def set(self):
+        weights, offset = [], 0
+        for shape in self.shapes:
+            size = int(np.prod(shape))
+            weights.append(self.flat[offset:offset + size].reshape(shape))
+            offset += size
+        self.model.set_weights(weights)
+
+def _prefetch(batches, n_steps, depth=2):
+    # cut the next batches on another thread while this one trains
+    queue = Queue(depth)
+    def produce():
+        for i in range(n_steps):
+            queue.put(batches[i])
+    threading.Thread(target=produce, daemon=True).start()
+    for i in range(n_steps):
+        yield queue.get()
+
+def fit(comm, model, batches, epochs, sync_every=10, on_epoch_end=None):
+    '''Train model on this rank's batches (a keras Sequence) in step with the
+    other ranks. Every rank runs the same number of batches per epoch, the
+    smallest shard's; on_epoch_end(epoch) runs on rank 0 only, with the
+    averaged weights loaded'''
+    weights = FlatWeights(model)
+    comm.broadcast(weights.get()) # start every rank from rank 0's weights
+    weights.set()
+    n_steps = comm.minimum(len(batches))
+    for epoch in range(epochs):
+        start, losses = time.time(), []
+        for i, (x, y) in enumerate(_prefetch(batches, n_steps)):
+            loss = model.train_on_batch(x, y)
+            losses.append(loss[0] if isinstance(loss, list) else loss)
+            if (i + 1) % sync_every == 0 or i + 1 == n_steps:
+                comm.average(weights.get())
+                weights.set()
+        batches.on_epoch_end()
+        if comm.rank == 0:
+            seconds = time.time() - start
+            print('epoch {}/{}: {:.1f}s, {} batches x {} workers, loss {:.4f}'.format(
+                epoch + 1, epochs, seconds, n_steps, comm.size, float(np.mean(losses))))
+            if on_epoch_end is not None:
+                on_epoch_end(epoch)
+    return model
+
+def shard(n, rank, size):
+    '''The contiguous [lo, hi) of n items that rank reads'''
+    return n * rank // size, n * (rank + 1) // size
+
+def _limit_tf_threads(threads):
+    # TensorFlow sizes its thread pools from the session config, not the environment
+    try:
+        import tensorflow as tf
+    except ImportError:
+        return
+    if hasattr(tf, 'ConfigProto'):
+        from keras import backend as K
+        K.set_session(tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=1)))
+    else:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+
+def _worker(rank, size, comm_args, transport, worker_fn, args, threads):
+    _limit_tf_threads(threads) # before worker_fn builds a model
+    comm = SharedMemoryComm(rank, size, *comm_args) if transport == 'shm' else SocketComm(rank, size, *comm_args)
+    worker_fn(comm, *args)
+    comm.close() # not on errors: the other ranks would never reach it, and run() cleans up
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+def run(worker_fn, n_workers, args=(), transport='shm', address='127.0.0.1:6000', ranks=None, threads=None):
+    '''Start worker_fn(comm, *args) in a process per rank and wait for them.
+    worker_fn has to be a module-level function: workers are spawned fresh, so
+    they load their own data and build their own model. ranks picks which of
+    the n_workers ranks run here (socket transport only)'''
+    if transport not in transports:
+        raise ValueError('Unknown transport {}, expected one of {}'.format(transport, transports))
+    ranks = list(range(n_workers)) if ranks is None else ranks
+    if transport == 'shm' and len(ranks) != n_workers:
+        raise ValueError('Shared memory needs every rank on this machine; use the socket transport')
+    ctx = mp.get_context('spawn')
+    if transport == 'shm':
+        comm_args = ('parallel_train_{}'.format(os.getpid()), ctx.Barrier(n_workers), ctx.Value('q', 0), ctx.Value('q', 0))
+    else:
+        comm_args = (parse_address(address),)
+
+    # split the cores between the workers: BLAS/OpenMP read these when the
+    # spawned children start, TensorFlow gets them in _limit_tf_threads
+    threads = threads or max(1, (os.cpu_count() or 1) // len(ranks))
+    saved = {key: os.environ.get(key) for key in _thread_env}
+    os.environ.update({key: str(threads) for key in _thread_env})
+    try:
+        processes = [ctx.Process(target=_worker, args=(rank, n_workers, comm_args, transport, worker_fn, args, threads))
+                     for rank in ranks]
+        for process in processes:
+            process.start()
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+    # if one worker dies the others would wait for it forever
+    running = {process.sentinel: process for process in processes}
+    while running:
+        for sentinel in connection.wait(list(running)):
+            process = running.pop(sentinel)
+            process.join()
+            if process.exitcode != 0:
+                for other in running.values():
+                    other.terminate()
+                for other in running.values():
+                    other.join()
+                if transport == 'shm':
+                    try:
+                        shared_memory.SharedMemory(comm_args[0]).unlink()
+                    except FileNotFoundError:
+                        pass
+                raise RuntimeError('Worker {} exited with code {}'.format(process.name, process.exitcode))
+
+def add_arguments(parser):
+    parser.add_argument('--parallel', type=int, default=1, help='Train in this many worker processes, averaging their weights')
+    parser.add_argument('--sync_every', type=int, default=10, help='Batches each worker trains between weight averages')
+    parser.add_argument('--transport', type=str, default='shm', choices=transports, help='Average weights through shared memory or over sockets via rank 0')
+    parser.add_argument('--address', type=str, default='127.0.0.1:6000', help='host:port rank 0 listens on (socket transport)')
+    parser.add_argument('--ranks', type=int, nargs='+', default=None, help='Ranks to start in this process (socket transport; default all)')
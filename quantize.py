@@ -0,0 +1,107 @@
+'''
+Post-training quantization of a generation bundle's weights.npz, with a report
+of what it costs in perplexity and gains in size and generation speed.
+
+    python quantize.py bundles/1024_512_batchnorm --dtypes int8 float16 --report
+
+writes weights.int8.npz / weights.float16.npz next to weights.npz; generate
+from them with  python generate.py <bundle> --quantized int8
+'''
+
+from __future__ import print_function
+import argparse, json, os, time
+
+import numpy as np
+
+import beam_utils
+import sampling
+from book_utils import get_file_contents, held_out_file_name
+from bundle_utils import load_bundle
+from numpy_inference import NumpyModel, NumpyPredictor, quantize_npz, quantize_dtypes
+from tokenizer import tokenize
+
+def quantized_file(meta, dtype):
+    return meta['weights_file'] if dtype == 'float32' else meta['weights_file'][:-len('.npz')] + '.' + dtype + '.npz'
+
+def held_out(meta, n_tokens, author='George Alfred Henty'):
+    '''The last n_tokens chars or words of the author's held-out book (which the
+    training scripts leave out), as bundle ids'''
+    text = get_file_contents(held_out_file_name(author))
+    if meta['kind'] == 'char':
+        char_index = {char: idx for idx, char in enumerate(meta['chars'])}
+        ids = [char_index[char] for char in text[-n_tokens - 1:] if char in char_index]
+    else:
+        word_index = {word: idx for idx, word in enumerate(meta['vocab'])}
+        unk_index = word_index['<UNK>']
+        ids = [word_index.get(word, unk_index) for word in tokenize(text)[-n_tokens - 1:]]
+    return np.array(ids, dtype=np.intp)
+
+def perplexity(weights_file, tokens, n_lanes=32):
+    '''Per-token perplexity, reading tokens as n_lanes contiguous lanes stepped together'''
+    lane_length = (len(tokens) - 1) // n_lanes
+    lanes = tokens[:n_lanes * lane_length + 1]
+    x = lanes[:-1].reshape(n_lanes, lane_length)
+    y = lanes[1:].reshape(n_lanes, lane_length)
+
+    model = NumpyModel(weights_file, batch_size=n_lanes)
+    log_probs = np.empty((n_lanes, lane_length))
+    rows = np.arange(n_lanes)
+    for t in range(lane_length):
+        log_probs[:, t] = np.log(np.maximum(model.step(x[:, t])[rows, y[:, t]], 1e-12))
+    return float(np.exp(-log_probs.mean()))
+
+def generation_speed(meta, weights_file, n_steps, beam_width):
+    '''Generated chars or words per second: single-row sampling for char
+    bundles, beam search for word bundles'''
+    seed = meta['seeds'][0]
+    start = time.time()
+    if meta['kind'] == 'char':
+        model = NumpyModel(weights_file, batch_size=1)
+        for idx in seed:
+            preds = model.step([idx])
+        for i in range(n_steps):
+            preds = model.step(sampling.sample(preds))
+    else:
+        beam_utils.beam_search(NumpyPredictor(weights_file, beam_width), seed, meta['maxlen'], n_steps, beam_width, 1.0)
+    return n_steps / (time.time() - start)
+
+def report(meta, dtypes, args):
+    tokens = held_out(meta, args.eval_tokens)
+    results = []
+    for dtype in ['float32'] + dtypes:
+        weights_file = quantized_file(meta, dtype)
+        results.append({
+            'dtype': dtype,
+            'megabytes': os.path.getsize(weights_file) / 2.**20,
+            'perplexity': perplexity(weights_file, tokens),
+            'per_sec': generation_speed(meta, weights_file, args.steps, args.beam_width),
+        })
+    # matmul weights are float32 again once loaded, so expect speedups near 1x
+    for result in results:
+        result['speedup'] = result['per_sec'] / results[0]['per_sec']
+    unit = 'chars' if meta['kind'] == 'char' else 'words'
+    for result in results:
+        print('{dtype:>8}: {megabytes:7.1f} MB, perplexity {perplexity:8.2f}, {per_sec:7.1f} '.format(**result) + unit +
+              '/sec ({speedup:.2f}x float32)'.format(**result))
+    return results
+
+parser = argparse.ArgumentParser(description='quantize a bundle\'s numpy weights')
+parser.add_argument('bundle', type=str, help='Generation bundle directory with a weights.npz (see numpy_inference)')
+parser.add_argument('--dtypes', type=str, nargs='+', default=quantize_dtypes, choices=quantize_dtypes)
+parser.add_argument('--report', action='store_true', help='Compare size, held-out perplexity and generation speed against float32')
+parser.add_argument('--eval_tokens', type=int, default=20000, help='Length of the held-out slice for perplexity')
+parser.add_argument('--steps', type=int, default=200, help='Chars or words generated for the speed measurement')
+parser.add_argument('--beam_width', type=int, default=30)
+parser.add_argument('--output', type=str, default=None, help='Write the report as JSON to this file')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    meta = load_bundle(args.bundle)
+    for dtype in args.dtypes:
+        quantize_npz(meta['weights_file'], quantized_file(meta, dtype), dtype)
+        print('Wrote', quantized_file(meta, dtype))
+    if args.report:
+        results = report(meta, args.dtypes, args)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
@@ -0,0 +1,105 @@
+import numpy as np
+
+# Sampling over a whole (batch, vocab) matrix of predictions at once: one row
+# per beam or per generated stream, no per-row Python loop. Rows may also be a
+# single 1-D prediction. Zero probabilities become -inf log-probs, which every
+# function here treats as "never pick".
+
+def log_softmax(logits, axis=-1):
+    logits = logits - np.max(logits, axis=axis, keepdims=True)
+    return logits - np.log(np.sum(np.exp(logits), axis=axis, keepdims=True))
+
+def scale_prediction(prediction, temperature=1.0):
+    '''Log-probabilities of each row of prediction rescaled by temperature.
+    Adapted from pender/chatbot-rnn chatbot.py'''
+    with np.errstate(divide='ignore'):
+        log_preds = np.log(prediction)
+    if temperature == 1.0: return log_preds # Temperature 1.0 makes no change
+    return log_softmax(log_preds / temperature)
+
+def top_k(log_probs, k):
+    '''log_probs with everything outside each row's k most likely set to -inf.
+    k is one int for every row or an array with one per row (0 for no cut)'''
+    vocab_size = log_probs.shape[-1]
+    if np.ndim(k) == 0:
+        if k is None or k >= vocab_size:
+            return log_probs
+        kth = np.partition(log_probs, -k, axis=-1)[..., -k, None]
+    else:
+        # one partition at the largest k, then each row reads its own kth value
+        rows = np.atleast_2d(log_probs)
+        k = np.where(np.asarray(k) > 0, np.minimum(k, vocab_size), vocab_size)
+        k_max = k.max()
+        head = -np.sort(np.partition(-rows, k_max - 1, axis=1)[:, :k_max], axis=1)
+        kth = np.where(k < vocab_size, head[np.arange(len(rows)), k - 1], -np.inf)
+        kth = kth.reshape(log_probs.shape[:-1] + (1,))
+    # ties at the kth value all survive, like a threshold would
+    return np.where(log_probs >= kth, log_probs, -np.inf)
+
+def nucleus(log_probs, p, candidates=256):
+    '''log_probs with each row cut to its smallest most-likely set holding at
+    least p of the mass (top-p). Only the top `candidates` of a row are
+    sorted; rows whose nucleus is larger fall back to a full sort. p is one
+    float for every row or an array with one per row (1 for no cut)'''
+    if np.ndim(p) == 0 and (p is None or p >= 1.):
+        return log_probs
+    rows = np.atleast_2d(log_probs)
+    p = np.broadcast_to(np.asarray(p, dtype=np.float64), (len(rows),))
+    vocab_size = rows.shape[1]
+    k = min(candidates, vocab_size)
+    head = -np.sort(np.partition(-rows, k - 1, axis=1)[:, :k], axis=1)
+    mass = np.cumsum(np.exp(head - _log_mass(rows)), axis=1)
+    short = mass[:, -1] < p
+    if short.any():
+        full_head = -np.sort(-rows[short], axis=1)
+        full_mass = np.cumsum(np.exp(full_head - _log_mass(rows[short])), axis=1)
+        thresholds = np.empty(len(rows))
+        thresholds[short] = _nucleus_threshold(full_head, full_mass, p[short])
+        thresholds[~short] = _nucleus_threshold(head[~short], mass[~short], p[~short])
+    else:
+        thresholds = _nucleus_threshold(head, mass, p)
+    thresholds = np.where(p < 1., thresholds, -np.inf)
+    return np.where(log_probs >= thresholds.reshape(log_probs.shape[:-1] + (1,)), log_probs, -np.inf)
+
+def _log_mass(log_probs):
+    # log of each row's total mass, (rows, 1)
+    top = np.max(log_probs, axis=-1, keepdims=True)
+    return top + np.log(np.sum(np.exp(log_probs - top), axis=-1, keepdims=True))
+
+def _nucleus_threshold(sorted_log_probs, cumulative_mass, p):
+    # the last token needed to reach p is the first whose cumulative mass gets there
+    last = np.minimum((cumulative_mass < p[:, None]).sum(axis=1), sorted_log_probs.shape[1] - 1)
+    return sorted_log_probs[np.arange(len(sorted_log_probs)), last]
+
+def filter_log_probs(log_probs, k=None, p=None):
+    return nucleus(top_k(log_probs, k), p)
+
+def gumbel_keys(log_probs):
+    '''log_probs plus Gumbel noise; the argmax of a row is a sample from it,
+    its top k a sample of k tokens without replacement'''
+    noise = -np.log(np.random.random_sample(log_probs.shape)) # legacy standard_exponential is ~2x slower
+    return log_probs - np.log(noise.astype(log_probs.dtype))
+
+def sample_log_probs(log_probs, method='cdf'):
+    '''One token id per row of (unnormalized) log_probs. 'cdf' (inverse CDF)
+    draws one uniform per row, 'gumbel' one per entry, so cdf is the faster
+    of the two on large vocabularies'''
+    if method == 'gumbel':
+        return np.argmax(gumbel_keys(log_probs), axis=-1)
+    elif method == 'cdf':
+        rows = np.atleast_2d(log_probs)
+        cdf = np.cumsum(np.exp(rows - np.max(rows, axis=1, keepdims=True)), axis=1)
+        draws = np.random.random_sample((len(rows), 1)) * cdf[:, -1:]
+        tokens = np.minimum((cdf <= draws).sum(axis=1), rows.shape[1] - 1)
+        return tokens.reshape(log_probs.shape[:-1])
+    raise ValueError('Unknown sampling method ' + method)
+
+def sample(preds, temperature=1.0, k=None, p=None, method='cdf'):
+    '''Draw one token id per row of preds (probabilities), after temperature,
+    top-k and nucleus filtering'''
+    return sample_log_probs(filter_log_probs(scale_prediction(preds, temperature), k, p), method)
+
+def sample_without_replacement(log_probs, n):
+    '''n distinct token ids per row, like np.random.choice(p=..., replace=False)'''
+    n = min(n, log_probs.shape[-1])
+    return np.argpartition(-gumbel_keys(log_probs), n - 1, axis=-1)[..., :n]
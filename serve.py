@@ -0,0 +1,393 @@
+'''
+Local generation server: loads a bundle's numpy weights once and runs every
+queued request through shared batched forward passes.
+
+    python serve.py bundles/1024_512_batchnorm --port 8000
+    curl -N localhost:8000/generate -d '{"seed": "The enemy", "length": 60, "temperature": 1.2, "beam_width": 8}'
+    curl localhost:8000/metrics
+
+POST /generate takes JSON with any of seed (text; a random bundle seed when
+empty), length, temperature, beam_width (1 samples one token at a time),
+top_k, top_p, no_repeat_ngram and frequency_penalty (beam search only), and streams the generated text back as it is produced. With
+beam search a token is streamed once every beam agrees on it.
+
+Each request holds beam_width rows of the model's state. Requests join the
+batch at the next step if rows are free and queue otherwise; when the server
+is idle, the first request waits --window ms so concurrent ones share its
+first step.
+'''
+
+from __future__ import print_function
+import argparse, asyncio, collections, json, random, time, traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import sampling
+from beam_utils import BeamSearch
+from bundle_utils import load_bundle
+from numpy_inference import NumpyModel
+from tokenizer import detokenize_tokens, tokenize, unescapes
+
+class Request(object):
+    def __init__(self, ids, length, temperature=1.0, beam_width=1, top_k=None, top_p=None, no_repeat_ngram=0, frequency_penalty=0.):
+        self.ids = ids
+        self.length = length
+        self.temperature = temperature
+        self.beam_width = beam_width
+        self.top_k = top_k
+        self.top_p = top_p
+        self.no_repeat_ngram = no_repeat_ngram
+        self.frequency_penalty = frequency_penalty
+        self.output = asyncio.Queue() # generated token ids, None when done
+        self.cancelled = False
+        self.failed = False
+        self.submitted = time.time()
+        self.first_token = None
+
+class Stream(object):
+    '''A request admitted to the batch, stepping rows offset:offset + n_rows'''
+    def __init__(self, request, offset):
+        self.request = request
+        self.offset = offset
+        self.n_rows = request.beam_width
+        self.position = 0 # next seed token to feed
+        self.generated = 0
+        self.last_token = None
+        self.search = None
+        if request.beam_width > 1:
+            self.search = BeamSearch(request.ids, 1, request.length, request.beam_width, request.temperature,
+                                     top_k=request.top_k, top_p=request.top_p, no_repeat_ngram=request.no_repeat_ngram,
+                                     frequency_penalty=request.frequency_penalty)
+            self.committed = len(request.ids)
+
+    @property
+    def warming_up(self):
+        # True until the last seed token has been fed; its output is the first real prediction
+        return self.position < len(self.request.ids)
+
+    @property
+    def done(self):
+        return self.request.cancelled or self.generated >= self.request.length
+
+    def inputs(self):
+        tokens = np.zeros(self.n_rows, dtype=np.intp)
+        if self.position < len(self.request.ids):
+            tokens[:] = self.request.ids[self.position]
+            self.position += 1
+        elif self.search is not None:
+            tokens[:self.search.n_beams] = self.search.last_tokens()
+        else:
+            tokens[:] = self.last_token
+        return tokens
+
+    def emit(self, tokens):
+        if len(tokens) and self.request.first_token is None:
+            self.request.first_token = time.time()
+        for token in tokens:
+            self.request.output.put_nowait(int(token))
+
+    def beam_step(self, model, preds):
+        search = self.search
+        parents = search.step(preds[:search.n_beams])
+        model.copy_rows(self.offset + parents, self.offset + np.arange(len(parents)))
+        self.generated += 1
+
+        if self.done:
+            end = search.length
+        else: # stream the prefix every beam shares
+            beams = search.sentences[:search.n_beams, :search.length]
+            agree = np.all(beams == beams[0], axis=0)
+            end = self.committed + np.argmin(agree[self.committed:]) if not agree.all() else search.length
+        self.emit(search.sentences[0, self.committed:end])
+        self.committed = max(self.committed, end)
+
+class Batcher(object):
+    def __init__(self, weights_file, max_rows=256, window=0.005):
+        self.model = NumpyModel(weights_file, batch_size=max_rows)
+        self.max_rows = max_rows
+        self.window = window
+        self.pending = collections.deque()
+        self.streams = []
+        self.wakeup = asyncio.Event()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        self.started = time.time()
+        self.steps = 0
+        self.rows_stepped = 0
+        self.batch_rows = collections.Counter()
+        self.tokens_generated = 0
+        self.requests_completed = 0
+        self.requests_failed = 0
+        self.first_token_seconds = [] # of completed requests
+
+    @property
+    def rows_in_use(self):
+        return sum(stream.n_rows for stream in self.streams)
+
+    def submit(self, request):
+        if request.beam_width > self.max_rows:
+            raise ValueError('beam_width is larger than the server\'s {} rows'.format(self.max_rows))
+        self.pending.append(request)
+        self.wakeup.set()
+
+    def _admit(self):
+        while self.pending and self.rows_in_use + self.pending[0].beam_width <= self.max_rows:
+            request = self.pending.popleft()
+            if request.cancelled:
+                continue
+            stream = Stream(request, self.rows_in_use)
+            self.model.reset_rows(slice(stream.offset, stream.offset + stream.n_rows))
+            self.streams.append(stream)
+
+    def _retire(self):
+        # finished streams free their rows; later streams shift down to keep rows packed
+        offset = 0
+        streams = []
+        for stream in self.streams:
+            if stream.done:
+                stream.request.output.put_nowait(None)
+                self.requests_completed += 1
+                if stream.request.first_token is not None:
+                    self.first_token_seconds.append(stream.request.first_token - stream.request.submitted)
+                continue
+            if stream.offset != offset:
+                self.model.copy_rows(np.arange(stream.offset, stream.offset + stream.n_rows),
+                                     np.arange(offset, offset + stream.n_rows))
+                stream.offset = offset
+            offset += stream.n_rows
+            streams.append(stream)
+        self.streams = streams
+
+    def _advance(self, preds):
+        sampled = []
+        for stream in self.streams:
+            if stream.warming_up or stream.done:
+                continue
+            if stream.search is not None:
+                stream.beam_step(self.model, preds[stream.offset:stream.offset + stream.n_rows])
+                self.tokens_generated += 1
+            else:
+                sampled.append(stream)
+        if not sampled:
+            return
+
+        # one batched draw for every single-row stream, each at its own temperature, top-k and top-p
+        with np.errstate(divide='ignore'):
+            log_preds = np.log(preds[[stream.offset for stream in sampled]])
+        temperatures = np.array([stream.request.temperature for stream in sampled], dtype=log_preds.dtype)
+        log_preds = sampling.log_softmax(log_preds / temperatures[:, None])
+        ks = np.array([stream.request.top_k or 0 for stream in sampled])
+        if ks.any():
+            log_preds = sampling.top_k(log_preds, ks)
+        ps = np.array([stream.request.top_p or 1. for stream in sampled])
+        if (ps < 1.).any():
+            log_preds = sampling.nucleus(log_preds, ps)
+        tokens = sampling.sample_log_probs(log_preds)
+        for stream, token in zip(sampled, tokens):
+            stream.last_token = token
+            stream.generated += 1
+            stream.emit([token])
+        self.tokens_generated += len(sampled)
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            if not self.streams and not self.pending:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                await asyncio.sleep(self.window)
+            self._admit()
+            if not self.streams:
+                continue
+
+            try:
+                tokens = np.concatenate([stream.inputs() for stream in self.streams])
+                preds = await loop.run_in_executor(self.executor, self.model.step, tokens)
+                self._advance(preds)
+            except Exception:
+                traceback.print_exc()
+                self._fail()
+                continue
+            self.steps += 1
+            self.rows_stepped += len(tokens)
+            self.batch_rows[len(tokens)] += 1
+            self._retire()
+
+    def _fail(self):
+        # a step that raised ends the streams it was stepping, not the loop every later request needs
+        for stream in self.streams:
+            stream.request.failed = True
+            stream.request.output.put_nowait(None)
+        self.requests_failed += len(self.streams)
+        self.streams = []
+
+    def metrics(self):
+        elapsed = time.time() - self.started
+        return {
+            'queue_depth': len(self.pending),
+            'active_requests': len(self.streams),
+            'rows_in_use': self.rows_in_use,
+            'max_rows': self.max_rows,
+            'steps': self.steps,
+            'mean_batch_rows': self.rows_stepped / max(self.steps, 1),
+            'batch_rows': {str(rows): count for rows, count in sorted(self.batch_rows.items())},
+            'tokens_generated': self.tokens_generated,
+            'tokens_per_sec': self.tokens_generated / elapsed,
+            'requests_completed': self.requests_completed,
+            'requests_failed': self.requests_failed,
+            'mean_first_token_ms': 1000 * float(np.mean(self.first_token_seconds)) if self.first_token_seconds else None,
+        }
+
+class Vocab(object):
+    '''Text <-> ids for a char or word bundle'''
+    def __init__(self, meta):
+        self.kind = meta['kind']
+        self.tokens = meta['chars'] if self.kind == 'char' else meta['vocab']
+        self.index = {token: idx for idx, token in enumerate(self.tokens)}
+        self.seeds = meta['seeds']
+
+    def encode(self, text):
+        if not text:
+            return list(random.choice(self.seeds))
+        if self.kind == 'char':
+            return [self.index[char] for char in text if char in self.index]
+        unk_index = self.index['<UNK>']
+        return [self.index.get(word, unk_index) for word in tokenize(text)]
+
+    def decode(self, ids, prev=None):
+        '''Text for ids, following the token id prev'''
+        if self.kind == 'char':
+            return ''.join(self.tokens[idx] for idx in ids)
+        words = [self.tokens[idx] for idx in ids]
+        if prev is None:
+            return detokenize_tokens(words)
+        prev = self.tokens[prev]
+        return detokenize_tokens([prev] + words)[len(unescapes.get(prev, prev)):]
+
+class Server(object):
+    def __init__(self, bundle, max_rows=256, window=0.005, max_length=2000):
+        meta = load_bundle(bundle)
+        if meta['kind'] not in ('char', 'word'):
+            raise ValueError('serve.py does not support {} bundles'.format(meta['kind']))
+        self.vocab = Vocab(meta)
+        self.batcher = Batcher(meta['weights_file'], max_rows, window)
+        self.max_length = max_length
+
+    def parse_request(self, body):
+        params = json.loads(body.decode('utf8') or '{}')
+        ids = self.vocab.encode(params.get('seed', ''))
+        if not ids:
+            raise ValueError('seed has no tokens in the bundle\'s vocabulary')
+        length = int(params.get('length', 100))
+        if not 0 < length <= self.max_length:
+            raise ValueError('length must be between 1 and {}'.format(self.max_length))
+        temperature = float(params.get('temperature', 1.0))
+        if temperature <= 0:
+            raise ValueError('temperature must be positive')
+        beam_width = int(params.get('beam_width', 1))
+        no_repeat_ngram = int(params.get('no_repeat_ngram', 0))
+        if no_repeat_ngram == 1 or no_repeat_ngram < 0:
+            raise ValueError('no_repeat_ngram must be 0 (off) or at least 2')
+        if beam_width < 1:
+            raise ValueError('beam_width must be at least 1')
+        top_k = params.get('top_k')
+        if top_k is not None and (type(top_k) is not int or top_k < 1):
+            raise ValueError('top_k must be a positive integer')
+        top_p = params.get('top_p')
+        if top_p is not None and (type(top_p) not in (int, float) or not 0 < top_p <= 1):
+            raise ValueError('top_p must be a number in (0, 1]')
+        return Request(ids, length, temperature, beam_width, top_k, top_p,
+                       no_repeat_ngram, float(params.get('frequency_penalty', 0.)))
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin1').split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin1').strip()
+                if not line:
+                    break
+                key, _, value = line.partition(':')
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            if len(request_line) < 2:
+                await self.respond(writer, 400, 'Bad request\n')
+            elif request_line[:2] == ['GET', '/metrics']:
+                await self.respond(writer, 200, json.dumps(self.batcher.metrics(), indent=2) + '\n', 'application/json')
+            elif request_line[:2] == ['POST', '/generate']:
+                await self.generate(body, writer)
+            else:
+                await self.respond(writer, 404, 'Not found\n')
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, text, content_type='text/plain'):
+        reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found'}
+        data = text.encode('utf8')
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: {}; charset=utf-8\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(
+            status, reasons[status], content_type, len(data)).encode('latin1') + data)
+        await writer.drain()
+
+    async def generate(self, body, writer):
+        try:
+            request = self.parse_request(body)
+            self.batcher.submit(request)
+        except (ValueError, TypeError) as e: # bad JSON is a ValueError too, float([]) a TypeError
+            await self.respond(writer, 400, str(e) + '\n')
+            return
+
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; charset=utf-8\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n\r\n')
+        prev = request.ids[-1]
+        try:
+            while True:
+                token = await request.output.get()
+                if token is None:
+                    break
+                tokens = [token]
+                while not request.output.empty(): # send whatever else is ready in the same chunk
+                    token = request.output.get_nowait()
+                    if token is None:
+                        break
+                    tokens.append(token)
+                data = self.vocab.decode(tokens, prev).encode('utf8')
+                prev = tokens[-1]
+                writer.write('{:x}\r\n'.format(len(data)).encode('latin1') + data + b'\r\n')
+                await writer.drain()
+                if token is None:
+                    break
+            if not request.failed: # otherwise the missing last chunk tells the client it was cut short
+                writer.write(b'0\r\n\r\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            request.cancelled = True # frees the rows if the client went away early
+
+    async def start(self, host='127.0.0.1', port=8000, unix=None):
+        if unix:
+            server = await asyncio.start_unix_server(self.handle, unix)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        asyncio.ensure_future(self.batcher.run())
+        return server
+
+parser = argparse.ArgumentParser(description='serve a bundle over local HTTP with dynamic batching')
+parser.add_argument('bundle', type=str, help='Generation bundle directory with a weights.npz (see numpy_inference)')
+parser.add_argument('--host', type=str, default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8000)
+parser.add_argument('--unix', type=str, default=None, help='Listen on this Unix socket instead of TCP')
+parser.add_argument('--max_rows', type=int, default=256, help='Model rows stepped together; a request takes beam_width rows')
+parser.add_argument('--window', type=float, default=5., help='Milliseconds an idle server waits to batch the first requests')
+parser.add_argument('--max_length', type=int, default=2000, help='Longest generation a request may ask for')
+
+async def main(args):
+    server = await Server(args.bundle, args.max_rows, args.window / 1000., args.max_length).start(args.host, args.port, args.unix)
+    print('Serving', args.bundle, 'on', args.unix or '{}:{}'.format(args.host, args.port))
+    await server.serve_forever()
+
+if __name__ == '__main__':
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,175 @@
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+from keras.engine.topology import Layer
+from keras.layers import Dense, Input
+from keras.models import Model
+
+# Output heads for the word model that avoid a full vocab-sized softmax while
+# training. Called on a hidden tensor they return the full softmax, so the
+# inference model stays a plain Sequential stack. Called on [hidden, labels]
+# they return each sample's loss; use training_model() to wire that up.
+
+def _identity_loss(y_true, y_pred):
+    return K.mean(y_pred, axis=-1)
+
+class SampledSoftmax(Layer):
+    '''Softmax trained with candidates drawn from the word counts (sampled softmax)'''
+    def __init__(self, counts, num_sampled=1024, **kwargs):
+        self.counts = [int(count) for count in counts]
+        self.vocab_size = len(self.counts)
+        self.num_sampled = num_sampled
+        super(SampledSoftmax, self).__init__(**kwargs)
+
+    def build(self, input_shape):
+        if isinstance(input_shape, list):
+            input_shape = input_shape[0]
+        self.kernel = self.add_weight(name='kernel', shape=(self.vocab_size, input_shape[-1]), initializer='glorot_uniform')
+        self.bias = self.add_weight(name='bias', shape=(self.vocab_size,), initializer='zeros')
+        super(SampledSoftmax, self).build(input_shape)
+
+    def _logits(self, hidden):
+        return K.dot(hidden, K.transpose(self.kernel)) + self.bias
+
+    def call(self, inputs):
+        if not isinstance(inputs, list):
+            return K.softmax(self._logits(inputs))
+
+        hidden, labels = inputs
+        labels = K.cast(K.reshape(labels, (-1, 1)), 'int64')
+        sampled = tf.nn.fixed_unigram_candidate_sampler(labels, 1, self.num_sampled, unique=True,
+                                                        range_max=self.vocab_size, distortion=0.75,
+                                                        unigrams=self.counts)
+        sampled_loss = tf.nn.sampled_softmax_loss(self.kernel, self.bias, labels, hidden,
+                                                  self.num_sampled, self.vocab_size, sampled_values=sampled)
+        full_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=K.reshape(labels, (-1,)), logits=self._logits(hidden))
+        return K.reshape(K.in_train_phase(sampled_loss, full_loss), (-1, 1))
+
+    def compute_output_shape(self, input_shape):
+        if isinstance(input_shape, list):
+            return (input_shape[0][0], 1)
+        return (input_shape[0], self.vocab_size)
+
+    def get_config(self):
+        config = {'counts': self.counts, 'num_sampled': self.num_sampled}
+        base_config = super(SampledSoftmax, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+class AdaptiveSoftmax(Layer):
+    '''Frequency-bucketed softmax (Grave et al. 2017). The most frequent words
+    and one entry per tail cluster share the head softmax; rarer clusters get a
+    smaller projection and their own softmax, only computed for their samples.
+    cutoffs defaults to the top 10% of the vocabulary in the head and the next
+    40% in the first tail cluster (2000 and 10000 words for 20k)'''
+    def __init__(self, counts, cutoffs=None, projection_factor=4, **kwargs):
+        self.counts = [int(count) for count in counts]
+        self.vocab_size = len(self.counts)
+        if cutoffs is None:
+            cutoffs = (self.vocab_size // 10, self.vocab_size // 2)
+        self.cutoffs = sorted(set(cutoff for cutoff in cutoffs if 0 < cutoff < self.vocab_size)) + [self.vocab_size]
+        self.projection_factor = projection_factor
+
+        # words sorted by count, then split into the head and tail clusters
+        order = np.argsort(-np.asarray(self.counts), kind='stable')
+        self.cluster_of = np.zeros(self.vocab_size, dtype=np.int32)
+        self.position = np.zeros(self.vocab_size, dtype=np.int32)
+        start = 0
+        for cluster, end in enumerate(self.cutoffs):
+            self.cluster_of[order[start:end]] = cluster
+            self.position[order[start:end]] = np.arange(end - start)
+            start = end
+        # column of each word id in the concatenated per-cluster distributions
+        self.inverse_order = np.argsort(order).astype(np.int32)
+        super(AdaptiveSoftmax, self).__init__(**kwargs)
+
+    @property
+    def n_tails(self):
+        return len(self.cutoffs) - 1
+
+    def build(self, input_shape):
+        if isinstance(input_shape, list):
+            input_shape = input_shape[0]
+        dim = input_shape[-1]
+        self.head_kernel = self.add_weight(name='head_kernel', shape=(dim, self.cutoffs[0] + self.n_tails), initializer='glorot_uniform')
+        self.head_bias = self.add_weight(name='head_bias', shape=(self.cutoffs[0] + self.n_tails,), initializer='zeros')
+        self.tails = []
+        for i in range(self.n_tails):
+            projection_dim = max(dim // self.projection_factor ** (i + 1), 1)
+            size = self.cutoffs[i + 1] - self.cutoffs[i]
+            self.tails.append((
+                self.add_weight(name='tail_{}_projection'.format(i), shape=(dim, projection_dim), initializer='glorot_uniform'),
+                self.add_weight(name='tail_{}_kernel'.format(i), shape=(projection_dim, size), initializer='glorot_uniform'),
+                self.add_weight(name='tail_{}_bias'.format(i), shape=(size,), initializer='zeros'),
+            ))
+        super(AdaptiveSoftmax, self).build(input_shape)
+
+    def _head_log_probs(self, hidden):
+        return tf.nn.log_softmax(K.dot(hidden, self.head_kernel) + self.head_bias)
+
+    def _tail_logits(self, hidden, i):
+        projection, kernel, bias = self.tails[i]
+        return K.dot(K.dot(hidden, projection), kernel) + bias
+
+    def call(self, inputs):
+        if not isinstance(inputs, list):
+            head = self._head_log_probs(inputs)
+            log_probs = [head[:, :self.cutoffs[0]]]
+            for i in range(self.n_tails):
+                cluster = self.cutoffs[0] + i
+                log_probs.append(head[:, cluster:cluster + 1] + tf.nn.log_softmax(self._tail_logits(inputs, i)))
+            return K.exp(tf.gather(K.concatenate(log_probs), self.inverse_order, axis=1))
+
+        hidden, labels = inputs
+        labels = K.cast(K.reshape(labels, (-1,)), 'int32')
+        clusters = tf.gather(self.cluster_of, labels)
+        positions = tf.gather(self.position, labels)
+
+        head = self._head_log_probs(hidden)
+        head_targets = tf.where(K.equal(clusters, 0), positions, clusters - 1 + self.cutoffs[0])
+        loss = -tf.reduce_sum(head * tf.one_hot(head_targets, self.cutoffs[0] + self.n_tails), axis=1)
+
+        batch_size = tf.shape(labels)[0]
+        for i in range(self.n_tails):
+            in_cluster = tf.where(K.equal(clusters, i + 1))
+            tail_hidden = tf.gather_nd(hidden, in_cluster)
+            tail_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(
+                labels=tf.gather_nd(positions, in_cluster), logits=self._tail_logits(tail_hidden, i))
+            loss += tf.scatter_nd(tf.cast(in_cluster, 'int32'), tail_loss, tf.expand_dims(batch_size, 0))
+        return K.reshape(loss, (-1, 1))
+
+    def compute_output_shape(self, input_shape):
+        if isinstance(input_shape, list):
+            return (input_shape[0][0], 1)
+        return (input_shape[0], self.vocab_size)
+
+    def get_config(self):
+        config = {'counts': self.counts, 'cutoffs': self.cutoffs[:-1], 'projection_factor': self.projection_factor}
+        base_config = super(AdaptiveSoftmax, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+custom_objects = {'SampledSoftmax': SampledSoftmax, 'AdaptiveSoftmax': AdaptiveSoftmax}
+heads = ['dense', 'sampled', 'adaptive']
+
+def output_layer(head, counts):
+    if head == 'dense':
+        return Dense(len(counts), activation='softmax')
+    elif head == 'sampled':
+        return SampledSoftmax(counts)
+    elif head == 'adaptive':
+        return AdaptiveSoftmax(counts)
+    raise ValueError('Unknown output head ' + head)
+
+def is_label_head(model):
+    return isinstance(model.layers[-1], (SampledSoftmax, AdaptiveSoftmax))
+
+def training_model(model, optimizer='rmsprop'):
+    '''Model([x, labels]) -> per-sample loss, sharing the layers of a Sequential
+    model that ends in a SampledSoftmax or AdaptiveSoftmax head'''
+    x = Input(batch_shape=model.layers[0].batch_input_shape, dtype=model.layers[0].dtype)
+    labels = Input(batch_shape=(model.layers[0].batch_input_shape[0], 1), dtype='int32')
+    hidden = x
+    for layer in model.layers[:-1]:
+        hidden = layer(hidden)
+    train_model = Model([x, labels], model.layers[-1]([hidden, labels]))
+    train_model.compile(loss=_identity_loss, optimizer=optimizer)
+    return train_model
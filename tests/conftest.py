@@ -0,0 +1,51 @@
+import json, os, sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import book_utils
+import token_cache
+
+def write_weights(path, vocab_size, units=8, embedding_dim=6, seed=0):
+    '''A random Embedding -> LSTM -> softmax model in the export_npz format'''
+    rng = np.random.RandomState(seed)
+    spec = {'input': 'embedding', 'layers': [
+        {'kind': 'Embedding', 'name': 'embedding'},
+        {'kind': 'LSTM', 'name': 'lstm', 'units': units, 'activation': 'tanh', 'recurrent_activation': 'sigmoid'},
+        {'kind': 'Dense', 'name': 'dense', 'units': vocab_size, 'activation': 'softmax'},
+    ]}
+    arrays = {
+        'embedding/embeddings': rng.randn(vocab_size, embedding_dim),
+        'lstm/kernel': rng.randn(embedding_dim, 4 * units) * 0.5,
+        'lstm/recurrent_kernel': rng.randn(units, 4 * units) * 0.5,
+        'lstm/bias': np.zeros(4 * units),
+        'dense/kernel': rng.randn(units, vocab_size) * 2,
+        'dense/bias': np.zeros(vocab_size),
+    }
+    np.savez(path, spec=json.dumps(spec), **{key: value.astype(np.float32) for key, value in arrays.items()})
+
+@pytest.fixture
+def char_bundle(tmp_path):
+    chars = list('abcdefghijklmnopqrstuvwxyz .,\n')
+    write_weights(str(tmp_path / 'weights.npz'), len(chars))
+    with open(str(tmp_path / 'bundle.json'), 'w') as f:
+        json.dump({'kind': 'char', 'chars': chars, 'maxlen': 5, 'seeds': [[0, 1, 2, 3, 4], [5, 6, 7, 8, 9]]}, f)
+    return str(tmp_path)
+
+books = {
+    'Author A___First.txt': 'The cat sat on the mat.\nIt was warm.\n',
+    'Author B___Second.txt': 'A dog ran into the garden, barking loudly!\n',
+    'Author C___Third.txt': '"Who goes there?" cried the sentry.\n',
+}
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+    (tmp_path / 'books').mkdir()
+    for file_name, text in books.items():
+        (tmp_path / 'books' / file_name).write_text(text)
+    monkeypatch.setattr(book_utils, 'path', str(tmp_path / 'books') + '/')
+    monkeypatch.setattr(book_utils, 'index_file', str(tmp_path / 'books.json'))
+    monkeypatch.setattr(token_cache, 'cache_dir', str(tmp_path / 'tokens'))
+    return sorted(books)
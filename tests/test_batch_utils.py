@@ -0,0 +1,16 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+from batch_utils import encode_chars
+
+def test_encode_chars_is_uint8_for_small_alphabets():
+    data, chars = encode_chars(['hello', 'world'])
+    assert data.dtype == np.uint8
+    assert ''.join(chars[idx] for idx in data) == 'helloworld'
+
+def test_encode_chars_widens_instead_of_failing():
+    texts = ['plain text', ''.join(chr(0x4e00 + i) for i in range(300))]
+    data, chars = encode_chars(texts)
+    assert data.dtype == np.uint16
+    assert ''.join(chars[idx] for idx in data) == ''.join(texts)
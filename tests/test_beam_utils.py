@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from beam_utils import BeamSearch, WindowPredictor, beam_search, ngram_hashes
+
+def cyclic_predictor(vocab_size, cycle):
+    '''Almost surely predicts the token after the last one in cycle'''
+    following = {token: cycle[(i + 1) % len(cycle)] for i, token in enumerate(cycle)}
+    def predict(windows):
+        preds = np.full((len(windows), vocab_size), 1e-6, dtype=np.float32)
+        preds[np.arange(len(windows)), [following.get(int(token), cycle[0]) for token in windows[:, -1]]] = 1.
+        return preds / preds.sum(axis=1, keepdims=True)
+    return WindowPredictor(predict)
+
+def repeated_ngrams(tokens, n):
+    hashes = ngram_hashes(tokens, n)
+    return len(hashes) - len(np.unique(hashes))
+
+@pytest.mark.parametrize('sample', [True, False])
+def test_blocked_top_k_falls_back_instead_of_dropping_beams(sample):
+    # the only token inside top_k=1 soon completes a repeated 3-gram
+    np.random.seed(0)
+    best = beam_search(cyclic_predictor(10, [2, 0, 1]), [5, 6, 7], 1, 20, beam_width=1, diversity=1.0,
+                       sample=sample, top_k=1, no_repeat_ngram=3)
+    assert len(best) == 23
+    assert repeated_ngrams(best, 3) == 0
+
+def test_repeats_are_allowed_when_every_token_is_blocked():
+    # two tokens can't go long without repeating a 2-gram
+    np.random.seed(0)
+    search = BeamSearch([0, 1], 1, 10, beam_width=2, diversity=1.0, no_repeat_ngram=2)
+    predictor = cyclic_predictor(2, [0, 1])
+    for i in range(10):
+        search.step(predictor(search))
+        assert search.n_beams >= 1
+    assert search.length == 12
+
+def test_no_repeat_ngram_blocks_repeats():
+    np.random.seed(0)
+    best = beam_search(cyclic_predictor(10, [1, 2, 3]), [1, 2, 3], 1, 30, beam_width=4, diversity=1.0,
+                       no_repeat_ngram=3)
+    assert repeated_ngrams(best, 3) == 0
+
+def test_every_beam_avoids_repeats_with_random_predictions():
+    rng = np.random.RandomState(0)
+    search = BeamSearch(rng.randint(6, size=8), 4, 40, beam_width=5, diversity=1.0, no_repeat_ngram=3)
+    for i in range(40):
+        preds = rng.dirichlet(np.ones(6), size=search.n_beams).astype(np.float32)
+        search.step(preds)
+    for sentence in search.sentences[:search.n_beams, 8:search.length]:
+        assert repeated_ngrams(sentence, 3) == 0
@@ -0,0 +1,12 @@
+import numpy as np
+
+from embedding_utils import tokenize_book_shard, tokenize_books
+
+def test_shards_split_the_books_and_share_the_vocabulary(library):
+    words, word_index, idx_to_word = tokenize_books(library, 10, processes=1)
+    shards = [tokenize_book_shard(library, 10, 2, shard, processes=1) for shard in range(2)]
+    for shard_words, shard_index, shard_idx_to_word, word_counts in shards:
+        assert shard_index == word_index
+        np.testing.assert_array_equal(word_counts, np.bincount(words, minlength=len(word_index)))
+    assert sorted(np.concatenate([shard[0] for shard in shards]).tolist()) == sorted(words.tolist())
+    assert all(len(shard[0]) for shard in shards)
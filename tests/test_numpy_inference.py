@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+keras = pytest.importorskip('keras')
+from keras.models import Sequential
+from keras.layers import BatchNormalization, Dense, Embedding, GRU, LSTM
+
+from model_utils import stateful_copy
+from numpy_inference import NumpyModel, export_npz
+
+vocab_size, maxlen, batch_size = 12, 5, 3
+
+def _randomize_batchnorms(model, rng):
+    # fresh moving statistics are the identity, which would hide a wrong fold
+    for layer in model.layers:
+        if isinstance(layer, BatchNormalization):
+            gamma, beta, mean, var = [w.shape for w in layer.get_weights()]
+            layer.set_weights([rng.uniform(0.5, 1.5, gamma), rng.randn(*beta), rng.randn(*mean), rng.uniform(0.5, 2., var)])
+
+def _assert_matches_keras(model, path, n_steps=20):
+    _randomize_batchnorms(model, np.random.RandomState(0))
+    export_npz(model, path)
+    keras_model = stateful_copy(model, batch_size=batch_size)
+    numpy_model = NumpyModel(path, batch_size=batch_size)
+    tokens = np.random.RandomState(1).randint(vocab_size, size=(n_steps, batch_size))
+    for step_tokens in tokens:
+        if numpy_model.input_kind == 'one_hot':
+            x = np.zeros((batch_size, 1, vocab_size), dtype=np.float32)
+            x[np.arange(batch_size), 0, step_tokens] = 1.
+        else:
+            x = step_tokens[:, None]
+        np.testing.assert_allclose(numpy_model.step(step_tokens), keras_model.predict_on_batch(x), atol=1e-4)
+
+@pytest.mark.parametrize('reset_after', [False, True])
+def test_gru_with_batchnorm(tmp_path, reset_after):
+    model = Sequential([
+        Embedding(vocab_size, 8, input_length=maxlen),
+        BatchNormalization(),
+        GRU(16, return_sequences=True, reset_after=reset_after),
+        BatchNormalization(),
+        GRU(16, reset_after=reset_after),
+        Dense(vocab_size, activation='softmax'),
+    ])
+    _assert_matches_keras(model, str(tmp_path / 'weights.npz'))
+
+def test_one_hot_lstm_with_batchnorm(tmp_path):
+    model = Sequential([
+        LSTM(16, input_shape=(maxlen, vocab_size), return_sequences=True),
+        BatchNormalization(),
+        LSTM(16),
+        BatchNormalization(),
+        Dense(vocab_size, activation='softmax'),
+    ])
+    _assert_matches_keras(model, str(tmp_path / 'weights.npz'))
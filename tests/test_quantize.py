@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+from conftest import write_weights
+from numpy_inference import NumpyModel, quantize_npz
+
+def _dequantized(quantized_path, path):
+    # the float32 weights a quantized file stands for
+    with np.load(quantized_path) as npz:
+        arrays = {key: npz[key] for key in npz.files}
+    for key in [key for key in arrays if key.endswith('/scale')]:
+        arrays[key[:-len('/scale')]] = arrays[key[:-len('/scale')]] * arrays.pop(key)
+    np.savez(path, **{key: value if key == 'spec' else value.astype(np.float32) for key, value in arrays.items()})
+
+@pytest.mark.parametrize('dtype', ['int8', 'float16'])
+def test_quantized_weights_match_their_dequantized_values(tmp_path, dtype):
+    path, quantized_path, reference_path = [str(tmp_path / name) for name in ['w.npz', 'q.npz', 'r.npz']]
+    write_weights(path, 20, units=16)
+    quantize_npz(path, quantized_path, dtype)
+    _dequantized(quantized_path, reference_path)
+
+    model, reference = NumpyModel(quantized_path, batch_size=3), NumpyModel(reference_path, batch_size=3)
+    # matmul weights are dequantized at load; the embedding table keeps its dtype
+    kernels = [layer.recurrent_kernel for layer in model.recurrent] + [kernel for kernel, bias, activation in model.dense]
+    assert all(kernel.dtype == np.float32 for kernel in kernels)
+    assert model.embeddings.values.dtype == np.dtype(dtype)
+    for tokens in np.random.RandomState(0).randint(20, size=(10, 3)):
+        np.testing.assert_allclose(model.step(tokens), reference.step(tokens), atol=1e-5)
@@ -0,0 +1,45 @@
+import asyncio, json
+
+import pytest
+
+from serve import Server
+
+@pytest.mark.parametrize('params', [
+    {'top_k': 'abc'}, {'top_k': 0}, {'top_k': 2.5}, {'top_k': True},
+    {'top_p': 'abc'}, {'top_p': 0}, {'top_p': 1.5}, {'frequency_penalty': []},
+])
+def test_parse_request_rejects_bad_filters(char_bundle, params):
+    server = Server(char_bundle, max_rows=8)
+    with pytest.raises((ValueError, TypeError)):
+        server.parse_request(json.dumps(dict(params, seed='abc', length=5)).encode('utf8'))
+
+async def _generate(server, request):
+    server.batcher.submit(request)
+    tokens = []
+    while True:
+        token = await asyncio.wait_for(request.output.get(), 5)
+        if token is None:
+            return tokens
+        tokens.append(token)
+
+def test_batcher_survives_a_failing_step(char_bundle):
+    async def run():
+        server = Server(char_bundle, max_rows=8, window=0)
+        task = asyncio.ensure_future(server.batcher.run())
+        step = server.batcher.model.step
+        def fail_once(tokens):
+            server.batcher.model.step = step
+            raise RuntimeError('broken step')
+        server.batcher.model.step = fail_once
+
+        first = server.parse_request(b'{"seed": "abc", "length": 5}')
+        await _generate(server, first)
+        second = server.parse_request(b'{"seed": "abc", "length": 5, "top_k": 3, "top_p": 0.9}')
+        tokens = await _generate(server, second)
+        task.cancel()
+        return first, second, tokens, server.batcher.metrics()
+
+    first, second, tokens, metrics = asyncio.run(run())
+    assert first.failed and not second.failed
+    assert len(tokens) == 5
+    assert metrics['requests_failed'] == 1
@@ -0,0 +1,33 @@
+import functools, multiprocessing
+
+import book_utils
+import token_cache
+from conftest import books
+from tokenizer import tokenize
+
+def _load(file_names):
+    token_cache.load_tokens(file_names, processes=1)
+
+def test_concurrent_runs_share_one_table(library):
+    # each run adds its own book's tokens to the table at the same time
+    context = multiprocessing.get_context('fork')
+    runs = [context.Process(target=_load, args=([file_name],)) for file_name in library]
+    for run in runs:
+        run.start()
+    for run in runs:
+        run.join()
+        assert run.exitcode == 0
+
+    ids, table, counts = token_cache.load_tokens(library, processes=1)
+    for file_name, book_ids in zip(library, ids):
+        assert [table[idx] for idx in book_ids] == tokenize(books[file_name])
+    assert counts.sum() == sum(len(book_ids) for book_ids in ids)
+
+def test_tokenizing_a_book_in_chunks_matches_the_whole_text(library, monkeypatch):
+    import tokenizer
+    text = '\n'.join('"Line {}," he said... (quietly)\n'.format(i) for i in range(50))
+    with open(book_utils.path + library[0], 'w') as f:
+        f.write(text)
+    monkeypatch.setattr(tokenizer, 'stream_file_contents', functools.partial(book_utils.stream_file_contents, chunk_size=37))
+    for preserve_lines in [True, False]:
+        assert tokenizer._tokenize_file((library[0], preserve_lines)) == tokenize(text, preserve_lines)
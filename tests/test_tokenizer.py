@@ -0,0 +1,35 @@
+import io, os
+
+import pytest
+
+from tokenizer import detokenize_tokens, tokenize, tokenize_line
+
+fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def _lines(name):
+    with io.open(os.path.join(fixtures, name), encoding='utf8') as f:
+        return f.read().splitlines()
+
+# expected tokens written by hand following PTBTokenizer's rules, not captured from it
+@pytest.mark.parametrize('line, expected', list(zip(_lines('tokenizer_sample.txt'), _lines('tokenizer_sample.tok'))))
+def test_matches_expected_tokens(line, expected):
+    assert tokenize_line(line) == expected.split()
+
+def test_number_abbreviations_need_a_number():
+    assert tokenize_line('I said no.') == ['I', 'said', 'no', '.']
+    assert tokenize_line('See vol. 3, no. 2.') == ['See', 'vol.', '3', ',', 'no.', '2', '.']
+
+def test_numbers_ending_a_sentence_lose_the_period():
+    assert tokenize_line('It cost $5.50.') == ['It', 'cost', '$', '5.50', '.']
+    assert tokenize_line('He left at 3.30.') == ['He', 'left', 'at', '3.30', '.']
+
+@pytest.mark.parametrize('text', ["'Tis so.", "You gonna come?", "I wanna go, gotta run.", "Lemme see.", "Gimme that.", "We cannot fail!"])
+def test_detokenize_rejoins_split_words(text):
+    assert detokenize_tokens(tokenize_line(text)) == text
+
+def test_intended_differences():
+    assert tokenize_line('The colour of the U.S.') == ['The', 'colour', 'of', 'the', 'U.S.']
+
+def test_preserves_lines():
+    text = '\n'.join(_lines('tokenizer_sample.txt'))
+    assert tokenize(text).count('\n') == len(_lines('tokenizer_sample.txt')) - 1
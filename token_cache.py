@@ -0,0 +1,103 @@
+import fcntl
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+
+import numpy as np
+
+import book_utils
+from tokenizer import tokenize_files
+
+# Per-book token ids, cached on disk so a run only re-tokenizes books that were
+# added or changed. Ids index into one append-only token table shared by all books.
+cache_dir = 'cache/tokens'
+
+def _cache_path(*parts):
+    return os.path.join(cache_dir, *parts)
+
+def _book_file(file_name):
+    return hashlib.md5(file_name.encode('utf8')).hexdigest() + '.npy'
+
+def _book_key(file_name):
+    # the body offsets are part of the key, so caches from before the header
+    # and license were stripped get re-tokenized
+    book = book_utils.get_book(file_name)
+    return [book['size'], book['mtime_ns'], book['start'], book['end']]
+
+def _load_json(name, default):
+    try:
+        with open(_cache_path(name), encoding='utf8') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return default
+
+def _save_json(name, obj):
+    tmp = _cache_path(name + '.tmp')
+    with open(tmp, 'w', encoding='utf8') as f:
+        json.dump(obj, f)
+    os.replace(tmp, _cache_path(name))
+
+def _save_npy(name, array):
+    tmp = _cache_path(name + '.tmp.npy')
+    np.save(tmp, array)
+    os.replace(tmp, _cache_path(name))
+
+@contextmanager
+def _locked():
+    # tokens.json is read, extended and written back, so two runs sharing the
+    # cache would otherwise each append their own ids over the other's table
+    with open(_cache_path('.lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def load_tokens(file_names, processes=None):
+    '''Returns (list of memory-mapped int32 token id arrays in file order,
+    token table, int64 count of each table entry over these books)'''
+    os.makedirs(_cache_path('books'), exist_ok=True)
+    with _locked():
+        return _load_tokens(file_names, processes)
+
+def _load_tokens(file_names, processes):
+    manifest = _load_json('manifest.json', {})
+    table = _load_json('tokens.json', [])
+    token_ids = {tok: idx for idx, tok in enumerate(table)}
+
+    keys = {file_name: _book_key(file_name) for file_name in file_names}
+    stale = [file_name for file_name in file_names
+             if manifest.get(file_name) != keys[file_name]
+             or not os.path.exists(_cache_path('books', _book_file(file_name)))]
+
+    if stale:
+        print('Tokenizing {} new or changed books...'.format(len(stale)))
+        for file_name, tokens in zip(stale, tokenize_files(stale, processes=processes)):
+            ids = np.empty(len(tokens), dtype=np.int32)
+            for i, tok in enumerate(tokens):
+                idx = token_ids.get(tok)
+                if idx is None:
+                    idx = token_ids[tok] = len(table)
+                    table.append(tok)
+                ids[i] = idx
+            _save_npy(os.path.join('books', _book_file(file_name)), ids)
+            manifest[file_name] = keys[file_name]
+        # the table has to be on disk before the manifest points at books using it
+        _save_json('tokens.json', table)
+        _save_json('manifest.json', manifest)
+
+    books = [np.load(_cache_path('books', _book_file(file_name)), mmap_mode='r') for file_name in file_names]
+
+    counts_key = _load_json('counts.json', None)
+    wanted_key = {'books': sorted(file_names), 'keys': [keys[f] for f in sorted(file_names)], 'table_size': len(table)}
+    if counts_key == wanted_key and os.path.exists(_cache_path('counts.npy')):
+        counts = np.load(_cache_path('counts.npy'))
+    else:
+        counts = np.zeros(len(table), dtype=np.int64)
+        for ids in books:
+            counts += np.bincount(ids, minlength=len(table))
+        _save_npy('counts.npy', counts)
+        _save_json('counts.json', wanted_key)
+
+    return books, table, counts
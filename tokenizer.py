@@ -0,0 +1,128 @@
+import re
+from multiprocessing import Pool
+
+from book_utils import stream_file_contents
+
+# In-process replacement for the Stanford PTBTokenizer shell-out
+# (tokenize.sh runs it with -preserveLines, so one input line is one output line).
+# tests/test_tokenizer.py checks it against the hand-written expected tokens in
+# tests/fixtures/tokenizer_sample.*. Known, intended differences from PTBTokenizer:
+#  - no americanize step: "colour" stays "colour", since the corpus and the
+#    generated text are both British
+#  - an abbreviation that ends a sentence ("U.S.") is not followed by an extra "."
+#  - no Unicode normalization of quotes, dashes or ellipses
+
+bracket_escapes = {'(': '-LRB-', ')': '-RRB-', '[': '-LSB-', ']': '-RSB-', '{': '-LCB-', '}': '-RCB-'}
+bracket_unescapes = {v: k for k, v in bracket_escapes.items()}
+
+abbreviations = {
+    'mr', 'mrs', 'messrs', 'dr', 'st', 'capt', 'col', 'gen', 'lieut', 'sergt', 'sgt', 'maj', 'rev',
+    'hon', 'esq', 'jr', 'sr', 'co', 'ltd', 'ch', 'chap', 'viz', 'vs', 'etc', 'mt', 'ft',
+    'jan', 'feb', 'mar', 'apr', 'jun', 'jul', 'aug', 'sep', 'sept', 'oct', 'nov', 'dec',
+}
+# only abbreviations before a number: "No. 5", but "I said no."
+number_abbreviations = {'no', 'nos', 'vol', 'vols', 'art', 'arts', 'fig', 'figs', 'sect', 'para', 'pp', 'op', 'ca'}
+
+ellipsis_re = re.compile(r'\.\.\.+')
+open_quote_re = re.compile(r'(^|(?<=[\s(\[{<]))"')
+dash_re = re.compile(r'--+')
+punct_re = re.compile(r'([;@#$%?!\u00a3]|(?<![A-Z])&|&(?![A-Z])|(?<!\d),|,(?!\d)|(?<!\d):|:(?!\d))') # not AT&T
+bracket_re = re.compile(r'([()\[\]{}])')
+open_single_re = re.compile(r"(^|(?<=[\s(\[{<]))'(?=[A-Za-z])(?!(?:s|m|d|ll|re|ve|tis|twas|em)\b)", re.I)
+contraction_re = re.compile(r"(?i)(\w)(n't|'s|'m|'d|'ll|'re|'ve)\b")
+cannot_re = re.compile(r'(?i)\b(can)(not)\b')
+assimilation_re = re.compile(r'(?i)\b(gon|wan|got|lem|gim)(na|ta|me)\b')
+assimilations = {'gonna', 'wanna', 'gotta', 'lemme', 'gimme'}
+tis_re = re.compile(r"(?i)(^|(?<=\s))('t)(is|was)\b")
+trailing_quote_re = re.compile(r"([^\s'])'(?=\s|$)")
+
+letter_abbreviation_re = re.compile(r'^(?:[A-Za-z]\.)+[A-Za-z]$') # the stem of U.S. or e.g.
+
+def _split_period(token, next_token=None):
+    if len(token) < 2 or not token.endswith('.') or token == '...':
+        return [token]
+    stem = token[:-1]
+    if stem.lower() in abbreviations or letter_abbreviation_re.match(stem) or (len(stem) == 1 and stem.isalpha()):
+        return [token]
+    if stem.lower() in number_abbreviations and next_token is not None and next_token[:1].isdigit():
+        return [token]
+    return [stem, '.']
+
+def tokenize_line(line):
+    line = open_quote_re.sub(' `` ', line)
+    line = line.replace('"', " '' ")
+    line = ellipsis_re.sub(' ... ', line)
+    line = dash_re.sub(' -- ', line)
+    line = punct_re.sub(r' \1 ', line)
+    line = bracket_re.sub(lambda m: ' ' + bracket_escapes[m.group(1)] + ' ', line)
+    line = open_single_re.sub(' ` ', line)
+    line = contraction_re.sub(r'\1 \2', line)
+    line = cannot_re.sub(r'\1 \2', line)
+    line = assimilation_re.sub(lambda m: m.group(1) + ' ' + m.group(2) if m.group(0).lower() in assimilations else m.group(0), line)
+    line = tis_re.sub(r'\1\2 \3', line)
+    line = trailing_quote_re.sub(r"\1 ' ", line)
+
+    tokens = []
+    words = line.split()
+    for i, token in enumerate(words):
+        tokens.extend(_split_period(token, words[i + 1] if i + 1 < len(words) else None))
+    return tokens
+
+def tokenize(text, preserve_lines=True):
+    '''Tokenize like tokenize.sh, returning what
+    open('/tmp/out.txt').read().replace('\\n', ' \\n ').split(' ') used to'''
+    lines = (' '.join(tokenize_line(line)) for line in text.split('\n'))
+    if not preserve_lines:
+        return ' '.join(lines).split()
+    return '\n'.join(lines).replace('\n', ' \n ').split(' ')
+
+def _tokenize_file(args):
+    # lines tokenize independently, so the book is read a chunk at a time; the
+    # result is what tokenize(get_file_contents(file_name)) returns
+    file_name, preserve_lines = args
+    tokens = []
+    def add(line, first):
+        line_tokens = tokenize_line(line)
+        if preserve_lines:
+            tokens.extend(([] if first else ['\n']) + (line_tokens or ['']))
+        else:
+            tokens.extend(line_tokens)
+    pending, first = '', True
+    for text in stream_file_contents(file_name):
+        lines = (pending + text).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            add(line, first)
+            first = False
+    add(pending, first)
+    return tokens
+
+def tokenize_files(file_names, preserve_lines=True, processes=None):
+    '''Tokenize each book in its own worker. Yields token lists in file order'''
+    pool = Pool(processes)
+    try:
+        for tokens in pool.imap(_tokenize_file, [(name, preserve_lines) for name in file_names]):
+            yield tokens
+    finally:
+        pool.close()
+        pool.join()
+
+no_space_before = {',', '.', ';', ':', '!', '?', '%', '...', "''", "'", '-RRB-', '-RSB-', '-RCB-',
+                   "n't", "N'T", "'s", "'S", "'m", "'M", "'d", "'D", "'ll", "'LL", "'re", "'RE", "'ve", "'VE"}
+no_space_after = {'``', '`', '$', '#', '-LRB-', '-LSB-', '-LCB-'}
+unescapes = dict(bracket_unescapes, **{'``': '"', "''": '"', '`': "'"})
+# words tokenize_line splits in two, joined again without a space
+rejoined = {("'t", 'is'), ("'t", 'was'), ('gon', 'na'), ('wan', 'na'), ('got', 'ta'), ('lem', 'me'), ('gim', 'me'), ('can', 'not')}
+
+def detokenize_tokens(tokens):
+    pieces = []
+    prev = None
+    for token in tokens:
+        if pieces:
+            if token in ('\n', '') or prev in ('\n', ''):
+                pieces.append(' ')
+            elif prev not in no_space_after and token not in no_space_before and (prev.lower(), token.lower()) not in rejoined:
+                pieces.append(' ')
+        pieces.append(unescapes.get(token, token))
+        prev = token
+    return ''.join(pieces)
@@ -2,26 +2,27 @@ from __future__ import print_function
 from keras.models import Sequential, load_model
 from keras.layers import Dense, Activation, LSTM, BatchNormalization, Dropout
 from keras.optimizers import RMSprop
-from keras.utils import to_categorical
-from sklearn.utils import shuffle
 import numpy as np
 from progressbar import ProgressBar
 import os, random, sys, argparse, operator, gc
 from time import sleep
 
+import instrument
 from book_utils import *
 from embedding_utils import *
+import beam_utils
+import parallel_train
+from batch_utils import WindowBatches, LabelInputBatches, LaneBatches
+import softmax_heads
+from softmax_heads import is_label_head, training_model
+from model_utils import StatefulPredictor, tbptt_copy, ResetStates, Throughput
+from bundle_utils import export_bundle, load_bundle, sample_seeds
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '1' # filter out INFO
 
 model_file_name = 'checkpoints/1024_512_batchnorm.h5'
-
-file_names = get_file_names_written_by('George Alfred Henty')
-text = ''.join(get_files_contents(file_names))
-print('text length', len(text))
-
-print('Tokenizing...')
-words, word_index, idx_to_word = tokenize_words(text, 20000)
+bundle_path = 'bundles/1024_512_batchnorm'
+vocab_size = 20000
 
 # TODO: probably have a more random way of doing the train/val split
 #val_split = 0.05
@@ -34,33 +35,48 @@ batch_size = 1200
 # Derived using formula for length of range at stackoverflow.com/questions/31839032
 #total_train_samples = (len(train_words) - maxlen - 1) // step + 1
 #total_val_samples = (len(val_words) - maxlen - 1) // step + 1
-total_samples = (len(words) - maxlen - 1) // step + 1 
-def get_chunk(data):
-    # cut the text in semi-redundant sequences of maxlen words
-    # I derived this using the formula for the length of a range and wolfram alpha. It should work
-    words_per_batch = (batch_size - 1) * step + maxlen + 1
-    words_order = list(range(len(data) // words_per_batch - 1))
-
-    while True:
-        random.shuffle(words_order)
-        for words_idx in words_order:
-            words_batch = data[words_idx * words_per_batch : (words_idx + 1) * words_per_batch]
-            sentences = []
-            next_words = []
-
-            for i in range(0, words_per_batch - maxlen, step):
-                sentences.append(words_batch[i: i + maxlen])
-                next_words.append(words_batch[i + maxlen])
-
-            x = np.array(sentences)
-            y = to_categorical(next_words, num_classes=len(word_index))
-
-            yield shuffle(x, y)
-
-def build_model(load_weights):
+workers = 4
+
+def load_corpus(vocab_size=vocab_size, n_shards=1, shard=0):
+    # with n_shards, words only holds this shard's books; the vocabulary and
+    # word_counts still cover every book
+    global words, word_index, idx_to_word, word_counts, seeds
+    file_names = get_training_file_names('George Alfred Henty')
+    print('Tokenizing...')
+    words, word_index, idx_to_word, word_counts = tokenize_book_shard(file_names, vocab_size, n_shards, shard)
+    seeds = sample_seeds(words, maxlen)
+
+def load_generation_bundle(path):
+    # everything generate mode needs, without touching the corpus
+    global idx_to_word, seeds, model_file_name
+    meta = load_bundle(path)
+    idx_to_word = dict(enumerate(meta['vocab']))
+    seeds = meta['seeds']
+    model_file_name = meta['model_file']
+
+def export(model, bundle=None):
+    export_bundle(bundle or bundle_path, model, {
+        'kind': 'word',
+        'vocab': [idx_to_word[idx] for idx in range(len(idx_to_word))],
+        'maxlen': maxlen,
+        'seeds': seeds,
+    })
+
+def get_chunk(data, shuffle=True, labels_as_input=False):
+    # semi-redundant sequences of maxlen words, cut as strided views over the
+    # int32 token array, with integer targets for sparse_categorical_crossentropy
+    batches = LabelInputBatches if labels_as_input else WindowBatches
+    return batches(data, maxlen, step, batch_size, shuffle=shuffle)
+
+def build_model(load_weights, head='dense', model_file=None):
     print('Build model...')
     if load_weights:
-        return load_model(model_file_name)
+        model = load_model(model_file or model_file_name, custom_objects=softmax_heads.custom_objects)
+        if is_label_head(model): # trained through training_model(), so never compiled itself
+            return model
+        if model.loss != 'sparse_categorical_crossentropy': # checkpoints from before sparse targets
+            model.compile(loss='sparse_categorical_crossentropy', optimizer='rmsprop', metrics=['acc'])
+        return model
     else:
         model = Sequential([
                     get_embedding_layer(word_index, maxlen, trainable=True),
@@ -69,28 +85,56 @@ def build_model(load_weights):
                     BatchNormalization(),
                     LSTM(512, dropout=0.5),
                     BatchNormalization(),
-                    Dense(len(word_index), activation='softmax')
+                    softmax_heads.output_layer(head, word_counts)
             ])
-        model.compile(loss='categorical_crossentropy', optimizer='rmsprop', metrics=['acc'])
+        if not is_label_head(model):
+            model.compile(loss='sparse_categorical_crossentropy', optimizer='rmsprop', metrics=['acc'])
         model.summary()
         return model
 
-def train(n_iter, n_words, beam_width, load_checkpoint):
-    model = build_model(load_checkpoint)
+def train(n_iter, n_words, beam_width, load_checkpoint, head='dense', bptt=0):
+    model = build_model(load_checkpoint, head)
+    if bptt:
+        if is_label_head(model):
+            raise ValueError('Truncated BPTT training needs the dense head')
+        # a stateful copy reads the words as batch_size contiguous lanes, so each
+        # word is seen once per epoch and context isn't capped at maxlen
+        train_model = tbptt_copy(model, batch_size, bptt)
+        train_model.compile(loss='sparse_categorical_crossentropy', optimizer='rmsprop', metrics=['acc'])
+    else:
+        # sampled/adaptive heads train through a model that takes the targets as input
+        train_model = training_model(model) if is_label_head(model) else model
+
     for iteration in range(1, n_iter + 1):
         print()
         print('-' * 50)
         print('Iteration', iteration)
-        model.fit_generator(get_chunk(words),
-                            #(total_train_samples // batch_size) // 4,
-                            total_samples // batch_size,
-                            epochs=1,
-                            #validation_data=get_chunk(val_words),
-                            #validation_steps=total_val_samples // batch_size
-                            )
+        if bptt:
+            lanes = LaneBatches(words, batch_size, bptt)
+            with instrument.phase('fit', iteration=iteration):
+                train_model.fit_generator(lanes,
+                                          len(lanes),
+                                          epochs=1,
+                                          shuffle=False,
+                                          callbacks=[ResetStates(), Throughput()])
+            model.set_weights(train_model.get_weights())
+        else:
+            batches = get_chunk(words, labels_as_input=is_label_head(model))
+            with instrument.phase('fit', iteration=iteration):
+                train_model.fit_generator(batches,
+                                          len(batches),
+                                          epochs=1,
+                                          workers=workers,
+                                          use_multiprocessing=True,
+                                          callbacks=[Throughput()],
+                                          #validation_data=get_chunk(val_words, shuffle=False),
+                                          #validation_steps=len(get_chunk(val_words))
+                                          )
 
         print('Saving model...')
-        model.save(model_file_name)
+        with instrument.phase('save'):
+            model.save(model_file_name)
+            export(model)
 
         for diversity in [1.4, 1.6, 1.8, 2.0]:
             print()
@@ -99,77 +143,86 @@ def train(n_iter, n_words, beam_width, load_checkpoint):
 
     return model
 
-def scale_prediction(prediction, temperature):
-    '''stolen from pender/chatbot-rnn chatbot.py'''
-    if (temperature == 1.0): return prediction # Temperature 1.0 makes no change
-    np.seterr(divide='ignore')
-    scaled_prediction = np.log(prediction) / temperature
-    scaled_prediction = scaled_prediction - np.logaddexp.reduce(scaled_prediction)
-    scaled_prediction = np.exp(scaled_prediction)
-    np.seterr(divide='warn')
-    return (scaled_prediction / np.sum(scaled_prediction)) # renormalize
-
-def beam_search(model, n_words, beam_width, diversity, stream):
-    print('----- diversity:', diversity)
-    start_index = random.randint(0, len(words) - maxlen - 1)
-    init_sentence = np.array(words[start_index: start_index + maxlen])
-    init_sentence = np.concatenate((init_sentence, np.zeros(n_words))).astype(np.int)
+def parallel_worker(comm, n_iter, load_checkpoint, head, sync_every, model_file, bundle, vocab_size):
+    # one rank of train_parallel, in its own process: it loads the corpus itself
+    # and trains on the words of its share of the books
+    load_corpus(vocab_size, comm.size, comm.rank)
+    model = build_model(load_checkpoint, head, model_file)
+    train_model = training_model(model) if is_label_head(model) else model
+
+    def checkpoint(epoch):
+        print('Saving model...')
+        model.save(model_file)
+        export(model, bundle)
+
+    parallel_train.fit(comm, train_model, get_chunk(words, labels_as_input=is_label_head(model)),
+                       n_iter, sync_every, on_epoch_end=checkpoint)
 
-    beams = [{ 'sentence': init_sentence, 'proba': 1.0 }]
+def train_parallel(n_iter, load_checkpoint, head, n_workers, sync_every=10, vocab_size=vocab_size, **run_args):
+    parallel_train.run(parallel_worker, n_workers, (n_iter, load_checkpoint, head, sync_every, model_file_name, bundle_path, vocab_size), **run_args)
+
+def beam_search(model, n_words, beam_width, diversity, stream, sample=True, stateful=True, no_repeat_ngram=0, frequency_penalty=0.):
+    print('----- diversity:', diversity)
+    init_sentence = random.choice(seeds)
+    if stateful:
+        predictor = StatefulPredictor(model, beam_width)
+    else:
+        predictor = beam_utils.WindowPredictor(lambda x_pred: model.predict(x_pred, verbose=0, batch_size=batch_size))
 
     print('Generating with beam search...')
-    bar = ProgressBar()
-    for i in bar(range(n_words)):
-        new_beams = []
-
-        x_pred = np.array([beam['sentence'][i:i + maxlen] for beam in beams])
-        all_preds = model.predict(x_pred, verbose=0, batch_size=batch_size)
-        for preds, beam in zip(all_preds, beams):
-            beam['preds'] = preds
-
-        for idx, beam in enumerate(beams):
-            sentence = beam['sentence']
-            preds = scale_prediction(beam['preds'], diversity)
-
-            best_idxs = np.random.choice(
-                            len(preds),
-                            size=min(np.count_nonzero(preds > 0), beam_width),
-                            replace=False,
-                            p=preds
-                        )
-
-            for pred_idx in best_idxs:
-                new_sentence = np.copy(sentence)
-                new_sentence[maxlen + i] = pred_idx
-                new_beams.append({
-                                    'sentence': new_sentence,
-                                    'proba': beam['proba'] * preds[pred_idx]
-                                })
-
-        beams = list(reversed(sorted(new_beams, key=lambda beam: beam['proba'])))
-        beams = beams[:beam_width]
-        sum_probs = sum([beam['proba'] for beam in beams])
-        for beam in beams: beam['proba'] /= sum_probs # avoid going to zero
-
-    stream.write(detokenize(beams[0]['sentence'], idx_to_word))
+    with instrument.phase('beam_search', beam_width=beam_width, diversity=diversity, stateful=stateful):
+        best = beam_utils.beam_search(predictor, init_sentence, maxlen, n_words, beam_width, diversity,
+                                      sample=sample, progress=ProgressBar(),
+                                      no_repeat_ngram=no_repeat_ngram, frequency_penalty=frequency_penalty)
+
+    stream.write(detokenize(best, idx_to_word))
 
 parser = argparse.ArgumentParser(description='train/generate text with word rnn')
-parser.add_argument('--mode', type=str, default='train', help='Either "train" or "generate"')
+parser.add_argument('--mode', type=str, default='train', help='Either "train", "generate" or "export" (bundle the current checkpoint)')
 parser.add_argument('--iter', type=int, default=3, help='Number of training iterations')
 parser.add_argument('--words', type=int, default=80, help='Number of words for  beam search')
 parser.add_argument('--diversity', type=float, default=1.6, help='Temperature for beam search')
 parser.add_argument('--beam_width', type=int, default=30, help='Beam width for beam search')
 parser.add_argument('--load_checkpoint', dest='load_checkpoint', action='store_true', help='Load the model from a checkpoint file')
-parser.set_defaults(load_checkpoint=False)
-
-FLAGS = parser.parse_args()
+parser.add_argument('--deterministic', dest='sample', action='store_false', help='Keep the highest scoring beams instead of sampling them')
+parser.add_argument('--windowed', dest='stateful', action='store_false', help='Re-read the last maxlen words of each beam every step instead of carrying the recurrent state')
+parser.add_argument('--vocab_size', type=int, default=vocab_size, help='Words kept in the vocabulary (the rest become <UNK>); the adaptive head\'s clusters scale with it')
+parser.add_argument('--head', type=str, default='dense', choices=softmax_heads.heads, help='Output layer: full softmax, sampled softmax or adaptive softmax')
+parser.add_argument('--no_repeat_ngram', type=int, default=0, help='Never let a beam repeat an n-gram of this many words (0 to allow repeats)')
+parser.add_argument('--frequency_penalty', type=float, default=0., help='Log-probability subtracted from a word for each time its beam already used it')
+parser.add_argument('--bundle', type=str, default=bundle_path, help='Generation bundle to write in train/export mode and read in generate mode')
+parser.add_argument('--bptt', type=int, default=0, help='Train statefully over contiguous text with truncated BPTT of this many steps (0 to train on overlapping windows)')
+parser.set_defaults(load_checkpoint=False, sample=True, stateful=True)
+parallel_train.add_arguments(parser)
+instrument.add_arguments(parser, 'logs/word_rnn_generation.jsonl')
 
 if __name__ == '__main__':
-    if FLAGS.mode == 'train':
-        trained_model = train(FLAGS.iter, FLAGS.words, FLAGS.beam_width, FLAGS.load_checkpoint)
-        beam_search(trained_model, 1000, FLAGS.beam_width, FLAGS.diversity, open('./generated_words.md', 'w'))
+    FLAGS = parser.parse_args()
+    instrument.configure_from(FLAGS)
+    bundle_path = FLAGS.bundle
+    if FLAGS.mode == 'train' and (FLAGS.parallel > 1 or FLAGS.ranks):
+        if FLAGS.bptt:
+            raise ValueError('--parallel trains on windows, not with --bptt')
+        with instrument.phase('train', workers=FLAGS.parallel): # every worker loads its own share of the corpus
+            train_parallel(FLAGS.iter, FLAGS.load_checkpoint, FLAGS.head, FLAGS.parallel, FLAGS.sync_every, FLAGS.vocab_size,
+                           transport=FLAGS.transport, address=FLAGS.address, ranks=FLAGS.ranks)
+        if FLAGS.ranks is None or 0 in FLAGS.ranks: # rank 0 exported the bundle here
+            load_generation_bundle(FLAGS.bundle)
+            beam_search(build_model(True), 1000, FLAGS.beam_width, FLAGS.diversity, open('./generated_words.md', 'w'), FLAGS.sample, FLAGS.stateful,
+                        FLAGS.no_repeat_ngram, FLAGS.frequency_penalty)
+    elif FLAGS.mode == 'train':
+        load_corpus(FLAGS.vocab_size)
+        with instrument.phase('train'):
+            trained_model = train(FLAGS.iter, FLAGS.words, FLAGS.beam_width, FLAGS.load_checkpoint, FLAGS.head, FLAGS.bptt)
+        beam_search(trained_model, 1000, FLAGS.beam_width, FLAGS.diversity, open('./generated_words.md', 'w'), FLAGS.sample, FLAGS.stateful,
+                    FLAGS.no_repeat_ngram, FLAGS.frequency_penalty)
     elif FLAGS.mode == 'generate':
-        beam_search(build_model(True), FLAGS.words, FLAGS.beam_width, FLAGS.diversity, open('./generated_words.md', 'w'))
+        load_generation_bundle(FLAGS.bundle)
+        beam_search(build_model(True), FLAGS.words, FLAGS.beam_width, FLAGS.diversity, open('./generated_words.md', 'w'), FLAGS.sample, FLAGS.stateful,
+                    FLAGS.no_repeat_ngram, FLAGS.frequency_penalty)
+    elif FLAGS.mode == 'export':
+        load_corpus(FLAGS.vocab_size)
+        export(build_model(True))
     else:
         print('Unrecognized mode', FLAGS.mode)
         raise TypeError